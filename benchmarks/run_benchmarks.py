@@ -0,0 +1,308 @@
+"""
+Benchmarks of the data preparation entry points, on a synthetic dataset (see benchmarks/synthetic.py).
+
+Each benchmark runs in a fresh Python process, so that its peak RSS (VmHWM, read by the process itself at the
+end) is its own. Only the call to the entry point is timed; loading its inputs (e.g. the parsed table for
+reduce_data) is not. Inputs that an earlier benchmark produces are made first, in a process of their own, when a
+benchmark runs on its own.
+Results are written as JSON, with the git commit, so runs of different commits can be compared with --compare.
+
+    python -m benchmarks.run_benchmarks /tmp/bench --images 5000 --output results.json
+    python -m benchmarks.run_benchmarks /tmp/bench --images 5000 --output new.json --compare results.json
+
+Everything runs offline on the CPU.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import subprocess
+from collections import OrderedDict
+import numpy as np
+import PIL
+from benchmarks.synthetic import make_dataset, CATEGORY_CSV, ANNOTATION_CSV
+from open_images.columnar import OpenImagesTable
+from open_images.open_image_to_json import parse_open_images, reduce_data, read_catMIDtoname, openimages2coco, \
+    copy_images
+from data_tools.coco_index import load_index
+from data_tools.coco_tools import split_dataset, resize
+
+RESULT_PREFIX = 'BENCHMARK_RESULT '
+
+
+class Context(object):
+    """Paths shared by the benchmarks"""
+
+    def __init__(self, data_dir, work_dir, num_workers):
+        self.data_dir = data_dir
+        self.work_dir = work_dir
+        self.num_workers = num_workers
+        with open(os.path.join(data_dir, 'dataset.json')) as f:
+            self.image_dirs = [os.path.join(data_dir, dd) for dd in json.load(f)['image_dirs']]
+        self.annotation_csv = os.path.join(data_dir, ANNOTATION_CSV)
+        self.category_csv = os.path.join(data_dir, CATEGORY_CSV)
+
+    def path(self, name):
+        return os.path.join(self.work_dir, name)
+
+
+def bench_noop(ctx):
+    """Nothing: the RSS of the interpreter with the modules imported, to subtract from the others"""
+    return 0, 'items', 0.0
+
+
+def bench_parse_open_images(ctx):
+    start = time.perf_counter()
+    table = parse_open_images(ctx.annotation_csv, columnar=True)
+    seconds = time.perf_counter() - start
+    table.save(ctx.path('table.npz'))
+    return len(table), 'rows', seconds
+
+
+def bench_parse_open_images_dicts(ctx):
+    start = time.perf_counter()
+    rows = parse_open_images(ctx.annotation_csv, columnar=False)
+    return len(rows), 'rows', time.perf_counter() - start
+
+
+def bench_reduce_data(ctx):
+    table = OpenImagesTable.load(_require(ctx, 'table.npz'))
+    catmid2name = read_catMIDtoname(ctx.category_csv)
+    start = time.perf_counter()
+    reduced = reduce_data(table, catmid2name, keep_classes=['Human face'])
+    seconds = time.perf_counter() - start
+    reduced.save(ctx.path('reduced.npz'))
+    return len(table), 'rows', seconds
+
+
+def bench_openimages2coco(ctx):
+    table = OpenImagesTable.load(_require(ctx, 'reduced.npz'))
+    catmid2name = read_catMIDtoname(ctx.category_csv)
+    start = time.perf_counter()
+    openimages2coco(table, catmid2name, ctx.image_dirs, desc="Benchmark.", output_class_ids={'Human face': 1},
+                    max_size=880, min_ann_size=(1, 1), min_ratio=2.0, num_workers=ctx.num_workers,
+                    output_json=ctx.path('faces.json'))
+    seconds = time.perf_counter() - start
+    return len(set(table.decode('ImageID').tolist())), 'images', seconds
+
+
+def bench_split_dataset(ctx):
+    annotations = _require(ctx, 'faces.json')
+    start = time.perf_counter()
+    split_dataset(annotations, 0.8, ctx.path('split_a.json'), ctx.path('split_b.json'))
+    seconds = time.perf_counter() - start
+    return load_index(annotations).num_images, 'images', seconds
+
+
+def bench_copy_images(ctx):
+    annotations = _require(ctx, 'faces.json')
+    output_dir = ctx.path('copied')
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+    start = time.perf_counter()
+    copy_images(annotations, ctx.image_dirs, output_dir, mode='copy', num_workers=ctx.num_workers)
+    seconds = time.perf_counter() - start
+    return load_index(annotations).num_images, 'images', seconds
+
+
+def bench_resize(ctx):
+    annotations = _require(ctx, 'faces.json')
+    image_dir = _require(ctx, 'copied')
+    output_dir = ctx.path('resized')
+    if os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+    start = time.perf_counter()
+    resize(image_dir, annotations, 0.5, output_dir, ctx.path('resized.json'), num_workers=ctx.num_workers,
+           skip_existing=False)
+    seconds = time.perf_counter() - start
+    return load_index(annotations).num_images, 'images', seconds
+
+
+BENCHMARKS = OrderedDict([
+    ('noop', bench_noop),
+    ('parse_open_images', bench_parse_open_images),
+    ('parse_open_images_dicts', bench_parse_open_images_dicts),
+    ('reduce_data', bench_reduce_data),
+    ('openimages2coco', bench_openimages2coco),
+    ('split_dataset', bench_split_dataset),
+    ('copy_images', bench_copy_images),
+    ('resize', bench_resize),
+])
+
+# Benchmark that produces each file of the work directory
+PRODUCERS = {'table.npz': 'parse_open_images', 'reduced.npz': 'reduce_data', 'faces.json': 'openimages2coco',
+             'copied': 'copy_images'}
+# Files of the work directory each benchmark reads
+INPUTS = {'reduce_data': ['table.npz'], 'openimages2coco': ['reduced.npz'], 'split_dataset': ['faces.json'],
+          'copy_images': ['faces.json'], 'resize': ['faces.json', 'copied']}
+
+
+def run_benchmarks(work_dir, names=None, num_images=1000, boxes_per_image=6, image_size=(320, 240), num_workers=8,
+                   repeat=3, seed=0):
+    """
+    Run benchmarks, each repeat times in a fresh process.
+    :param work_dir: Directory for the synthetic dataset (work_dir/data) and the benchmark outputs
+    :param names: Benchmarks to run, default all (see BENCHMARKS)
+    :param num_images, boxes_per_image, image_size, seed: Size of the synthetic dataset, see make_dataset.
+        The dataset is only regenerated when these change.
+    :param num_workers: num_workers passed to the entry points
+    :param repeat: Number of runs of each benchmark. The fastest is reported.
+    :return: Results dict, as written by --output
+    """
+    assert os.path.isdir(work_dir), "Directory %s does not exist" % work_dir
+    data_dir = os.path.join(work_dir, 'data')
+    params = {'num_images': num_images, 'boxes_per_image': boxes_per_image, 'image_size': list(image_size),
+              'seed': seed}
+    description = _dataset_description(data_dir)
+    if description is None or description.get('params') != params:
+        if os.path.isdir(data_dir):
+            shutil.rmtree(data_dir)
+        os.makedirs(data_dir)
+        description = make_dataset(data_dir, num_images=num_images, boxes_per_image=boxes_per_image,
+                                   image_size=image_size, seed=seed, num_workers=num_workers)
+        description['params'] = params
+        with open(os.path.join(data_dir, 'dataset.json'), 'w') as f:
+            json.dump(description, f, indent=1)
+    outputs_dir = os.path.join(work_dir, 'outputs')
+    if os.path.isdir(outputs_dir):
+        shutil.rmtree(outputs_dir)
+    os.makedirs(outputs_dir)
+
+    results = OrderedDict()
+    for name in (names or list(BENCHMARKS)):
+        assert name in BENCHMARKS, "Unknown benchmark %s, choose from %s" % (name, list(BENCHMARKS))
+        if not all(os.path.exists(os.path.join(outputs_dir, input_name)) for input_name in INPUTS.get(name, [])):
+            # Otherwise the first run would make them and its peak RSS would include theirs
+            _run_child(name, data_dir, outputs_dir, num_workers, prepare=True)
+        runs = [_run_child(name, data_dir, outputs_dir, num_workers) for _ in range(repeat)]
+        best = min(runs, key=lambda run: run['seconds'])
+        results[name] = {'seconds': [run['seconds'] for run in runs], 'best_seconds': best['seconds'],
+                         'items': best['items'], 'item_name': best['item_name'],
+                         'items_per_second': best['items'] / best['seconds'] if best['seconds'] > 0 else None,
+                         'peak_rss_mb': max(run['peak_rss_mb'] for run in runs)}
+        print("%-24s %8.3f s %10s %s/s %8.1f MB" % (name, best['seconds'],
+                                                   _format_rate(results[name]['items_per_second']),
+                                                   best['item_name'], results[name]['peak_rss_mb']))
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': _git_commit(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'pillow': PIL.__version__, 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'num_workers': num_workers, 'repeat': repeat, 'dataset': description,
+            'benchmarks': results}
+
+
+def print_comparison(baseline, results):
+    """Print the best time and peak RSS of each benchmark against a baseline results dict"""
+    print("%-24s %10s %10s %7s %10s %10s" % ('benchmark', 'base s', 'new s', 'ratio', 'base MB', 'new MB'))
+    for name, new in results['benchmarks'].items():
+        old = baseline['benchmarks'].get(name)
+        if old is None:
+            continue
+        ratio = new['best_seconds'] / old['best_seconds'] if old['best_seconds'] > 0 else float('nan')
+        print("%-24s %10.3f %10.3f %7.2f %10.1f %10.1f" % (name, old['best_seconds'], new['best_seconds'], ratio,
+                                                         old['peak_rss_mb'], new['peak_rss_mb']))
+    if baseline.get('dataset') != results.get('dataset'):
+        print("Note: the datasets differ, so times are not directly comparable.")
+
+
+def _run_child(name, data_dir, outputs_dir, num_workers, prepare=False):
+    """
+    Run one benchmark in a new process. Returns its result, with the peak RSS the process reported.
+    With prepare, only make the inputs of the benchmark and return None.
+    """
+    command = [sys.executable, '-m', 'benchmarks.run_benchmarks', '--prepare' if prepare else '--child', name,
+               data_dir, outputs_dir, str(num_workers)]
+    proc = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+    stdout = proc.stdout
+    if proc.returncode != 0:
+        print(stdout)
+        raise RuntimeError("Benchmark %s failed with exit code %i" % (name, proc.returncode))
+    if prepare:
+        return None
+    lines = [line for line in stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+    return json.loads(lines[-1][len(RESULT_PREFIX):])
+
+
+def _prepare(name, data_dir, outputs_dir, num_workers):
+    ctx = Context(data_dir, outputs_dir, num_workers)
+    for input_name in INPUTS.get(name, []):
+        _require(ctx, input_name)
+
+
+def _child(name, data_dir, outputs_dir, num_workers):
+    items, item_name, seconds = BENCHMARKS[name](Context(data_dir, outputs_dir, num_workers))
+    print(RESULT_PREFIX + json.dumps({'items': items, 'item_name': item_name, 'seconds': seconds,
+                                      'peak_rss_mb': _peak_rss_mb()}))
+
+
+def _peak_rss_mb():
+    """
+    High-water RSS of this process, from VmHWM. ru_maxrss of a child (os.wait4) is no good here: it starts at
+    the RSS of the parent at fork and carries it over the exec.
+    """
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024.0
+    return None
+
+
+def _require(ctx, name):
+    """Path of a file of the work directory, running the benchmark that produces it (untimed) if needed"""
+    path = ctx.path(name)
+    if not os.path.exists(path):
+        BENCHMARKS[PRODUCERS[name]](ctx)
+    return path
+
+
+def _dataset_description(data_dir):
+    try:
+        with open(os.path.join(data_dir, 'dataset.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _format_rate(rate):
+    return '-' if rate is None else '%.1f' % rate
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in ('--child', '--prepare'):
+        (_child if sys.argv[1] == '--child' else _prepare)(sys.argv[2], sys.argv[3], sys.argv[4], int(sys.argv[5]))
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description="Benchmark the data preparation entry points on synthetic data.")
+    parser.add_argument('work_dir', help="Directory for the synthetic dataset and the benchmark outputs")
+    parser.add_argument('--only', nargs='+', default=None, help="Benchmarks to run: %s" % ', '.join(BENCHMARKS))
+    parser.add_argument('--images', type=int, default=1000, help="Number of synthetic images")
+    parser.add_argument('--boxes', type=float, default=6, help="Mean number of boxes per image")
+    parser.add_argument('--image-size', type=int, nargs=2, default=(320, 240), help="Typical width and height")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help="Write the results to this JSON file")
+    parser.add_argument('--compare', default=None, help="Results JSON of an earlier run to compare with")
+    args = parser.parse_args()
+
+    all_results = run_benchmarks(args.work_dir, names=args.only, num_images=args.images, boxes_per_image=args.boxes,
+                                 image_size=tuple(args.image_size), num_workers=args.workers, repeat=args.repeat,
+                                 seed=args.seed)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(all_results, f, indent=1)
+        print("Wrote %s" % args.output)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), all_results)
@@ -0,0 +1,100 @@
+"""
+Synthetic Open Images-shaped inputs for the data preparation benchmarks.
+
+make_dataset writes, into one directory, the files DATA_README.md expects in /data/open_images:
+    class-descriptions-boxable.csv   MID,name rows, including 'Human face'
+    train-annotations-bbox.csv       rows with the exact Open Images header, several boxes per image
+    train_00 ... train_0<n>          small JPEGs, spread over the directories like the train shards
+Image sizes, box counts and classes are drawn from a seeded random generator, so the same arguments give the
+same dataset. A few images are very wide, so that the min_ratio filter of openimages2coco has work to do.
+"""
+
+import os
+import csv
+import json
+import numpy as np
+from PIL import Image
+from open_images.columnar import EXPECTED_HEADER
+from data_tools.parallel import bounded_imap, Throughput
+
+FACE_MID = '/m/0dzct'
+CATEGORY_CSV = 'class-descriptions-boxable.csv'
+ANNOTATION_CSV = 'train-annotations-bbox.csv'
+SOURCES = ('xclick', 'activemil')
+
+
+def make_dataset(output_dir, num_images=1000, boxes_per_image=6, num_classes=20, face_fraction=0.3,
+                 image_size=(320, 240), num_dirs=9, seed=0, num_workers=8):
+    """
+    Write a synthetic Open Images dataset.
+    :param output_dir: Existing directory to write into
+    :param num_images: Number of images
+    :param boxes_per_image: Mean number of boxes per image (Poisson distributed, at least 1)
+    :param num_classes: Number of classes, 'Human face' being one of them
+    :param face_fraction: Fraction of the boxes that are faces
+    :param image_size: Typical (width, height) of the JPEGs. Sizes vary by up to a factor 2 either way.
+    :param num_dirs: Number of image directories, train_00 ... train_0<num_dirs - 1>
+    :param seed: Random seed
+    :param num_workers: Number of JPEGs encoded in parallel
+    :return: dict describing the dataset, also written to output_dir/dataset.json
+    """
+    assert os.path.isdir(output_dir), "Directory %s does not exist" % output_dir
+    rs = np.random.RandomState(seed)
+    mids = [FACE_MID] + ['/m/%05x' % ii for ii in range(1, num_classes)]
+    with open(os.path.join(output_dir, CATEGORY_CSV), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([FACE_MID, 'Human face'])
+        writer.writerows([mid, 'Class %i' % ii] for ii, mid in enumerate(mids[1:], 1))
+
+    image_ids = ['%016x' % vv for vv in rs.randint(0, 2 ** 62, size=num_images, dtype=np.int64)]
+    image_ids = sorted(set(image_ids))
+    num_images = len(image_ids)
+    scale = np.exp(rs.uniform(np.log(0.5), np.log(2.0), size=num_images))
+    widths = np.maximum((image_size[0] * scale).astype(np.int64), 16)
+    heights = np.maximum((image_size[1] * scale).astype(np.int64), 16)
+    wide = rs.rand(num_images) < 0.02
+    widths[wide] = np.maximum(widths[wide], 2 * heights[wide] + 1)
+
+    num_boxes = np.maximum(rs.poisson(boxes_per_image, size=num_images), 1)
+    rows = np.repeat(np.arange(num_images), num_boxes)
+    num_rows = len(rows)
+    labels = np.where(rs.rand(num_rows) < face_fraction, 0, rs.randint(1, max(num_classes, 2), size=num_rows))
+    size = np.exp(rs.uniform(np.log(0.01), np.log(0.6), size=(num_rows, 2)))
+    x_min = rs.uniform(0, 1, size=num_rows) * (1 - size[:, 0])
+    y_min = rs.uniform(0, 1, size=num_rows) * (1 - size[:, 1])
+    flags = rs.randint(-1, 2, size=(num_rows, 5))
+    sources = rs.randint(0, len(SOURCES), size=num_rows)
+    with open(os.path.join(output_dir, ANNOTATION_CSV), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPECTED_HEADER)
+        for ii, row in enumerate(rows.tolist()):
+            writer.writerow([image_ids[row], SOURCES[sources[ii]], mids[labels[ii]], 1,
+                             repr(float(x_min[ii])), repr(float(x_min[ii] + size[ii, 0])),
+                             repr(float(y_min[ii])), repr(float(y_min[ii] + size[ii, 1]))] + flags[ii].tolist())
+
+    image_dirs = ['train_0%i' % ii for ii in range(num_dirs)]
+    for image_dir in image_dirs:
+        os.makedirs(os.path.join(output_dir, image_dir), exist_ok=True)
+    tasks = ((os.path.join(output_dir, image_dirs[ii % num_dirs], image_id + '.jpg'), int(widths[ii]),
+              int(heights[ii]), seed * 1000003 + ii) for ii, image_id in enumerate(image_ids))
+    progress = Throughput(num_images)
+    for nbytes in bounded_imap(_write_jpeg, tasks, num_workers=num_workers):
+        progress.update(nbytes=nbytes)
+    print("  " + progress.summary())
+
+    description = {'num_images': num_images, 'num_rows': num_rows, 'num_classes': num_classes,
+                   'face_rows': int((labels == 0).sum()), 'image_size': list(image_size), 'image_dirs': image_dirs,
+                   'seed': seed}
+    with open(os.path.join(output_dir, 'dataset.json'), 'w') as f:
+        json.dump(description, f, indent=1)
+    print("Wrote %i images and %i annotation rows to %s" % (num_images, num_rows, output_dir))
+    return description
+
+
+def _write_jpeg(task):
+    """Write one smooth random image, which compresses and decodes like a photo more than noise does"""
+    path, width, height, seed = task
+    rs = np.random.RandomState(seed % (2 ** 32))
+    coarse = Image.fromarray(rs.randint(0, 256, size=(6, 8, 3), dtype=np.uint8))
+    coarse.resize((width, height), Image.BICUBIC).save(path, quality=90)
+    return os.path.getsize(path)
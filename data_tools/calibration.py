@@ -0,0 +1,143 @@
+"""
+Pick INT8 calibration images for export.cpp (see INT8-README.md).
+
+Calibration should see the range of inputs the engine will get, but every calibration image adds export time.
+select_calibration_images describes each image of a COCO dataset by a few cheap features: image size and aspect
+ratio, number and relative size of the face boxes (from the annotations), and brightness and contrast (from a
+reduced-resolution decode, computed on a worker pool). It then picks a small set that spreads over that feature
+space with greedy k-center selection: each new image is the one farthest from all images picked so far.
+"""
+
+import os
+import numpy as np
+from PIL import Image
+from data_tools.coco_index import load_index
+from data_tools.parallel import bounded_imap, Throughput
+
+FEATURES = ('log_width', 'log_height', 'log_num_boxes', 'median_box_scale', 'min_box_scale', 'brightness',
+            'contrast')
+
+
+def select_calibration_images(annotations, image_dir, num_images=100, num_workers=8, preview_size=64,
+                              output_cpp=None, output_list=None, path_prefix=None):
+    """
+    Choose a diverse subset of images for INT8 calibration.
+    :param annotations: COCO annotation file (e.g. from openimages2coco), or a CocoIndex
+    :param image_dir: Directory containing the images
+    :param num_images: Number of images to pick. Must be larger than the batch size of export.cpp.
+    :param num_workers: Number of images decoded in parallel
+    :param preview_size: Images are decoded at about this size to measure brightness and contrast
+    :param output_cpp: If set, write the calibration_files.push_back("..."); lines for export.cpp to this file
+    :param output_list: If set, write the image paths to this file, one per line
+    :param path_prefix: Directory written in front of file names in the outputs (where the images are on the
+        machine running export). Defaults to image_dir.
+    :return: List of the file names picked
+    """
+    assert os.path.isdir(image_dir), "Directory %s does not exist" % image_dir
+    index = load_index(annotations, verbose=True)
+    features = image_features(index, image_dir, num_workers=num_workers, preview_size=preview_size)
+    valid = np.flatnonzero(np.all(np.isfinite(features), axis=1))
+    print("Selecting %i of %i images (%i could not be read)" % (min(num_images, len(valid)), index.num_images,
+                                                                 index.num_images - len(valid)))
+    picked = valid[k_center(features[valid], num_images)]
+    _print_coverage(features[valid], features[picked])
+
+    file_names = [index.file_names[row] for row in picked.tolist()]
+    prefix = image_dir if path_prefix is None else path_prefix
+    paths = [os.path.join(prefix, file_name) for file_name in file_names]
+    if output_cpp is not None:
+        with open(output_cpp, 'w') as f:
+            f.write("vector<string> calibration_files;\n")
+            f.write("".join('calibration_files.push_back("%s");\n' % path for path in paths))
+        print("Wrote %s" % output_cpp)
+    if output_list is not None:
+        with open(output_list, 'w') as f:
+            f.write("".join(path + "\n" for path in paths))
+        print("Wrote %s" % output_list)
+    return file_names
+
+
+def image_features(index, image_dir, num_workers=8, preview_size=64):
+    """
+    Features of every image of a CocoIndex, in the order of FEATURES.
+    Box scales are sqrt(box area / image area). Images that cannot be read get NaN brightness and contrast.
+    :return: (num_images, len(FEATURES)) array
+    """
+    width = np.asarray(index.image_columns['width'], dtype=np.float64)
+    height = np.asarray(index.image_columns['height'], dtype=np.float64)
+    features = np.full((index.num_images, len(FEATURES)), np.nan)
+    features[:, 0] = np.log(width)
+    features[:, 1] = np.log(height)
+
+    ann_rows = index.ann_image_rows
+    valid = ann_rows >= 0
+    num_boxes = np.bincount(ann_rows[valid], minlength=index.num_images)
+    features[:, 2] = np.log1p(num_boxes)
+    bboxes = index.bboxes.astype(np.float64)
+    scale = np.sqrt(np.maximum(bboxes[:, 2] * bboxes[:, 3], 0) / (width * height)[np.maximum(ann_rows, 0)])
+    # Median and minimum box scale per image: sort by (image, scale) and read positions within each image
+    order = np.lexsort((scale[valid], ann_rows[valid]))
+    sorted_rows = ann_rows[valid][order]
+    sorted_scale = scale[valid][order]
+    start = np.searchsorted(sorted_rows, np.arange(index.num_images), side='left')
+    has_boxes = num_boxes > 0
+    features[:, 3] = 0.0
+    features[:, 4] = 0.0
+    features[has_boxes, 3] = sorted_scale[start[has_boxes] + num_boxes[has_boxes] // 2]
+    features[has_boxes, 4] = sorted_scale[start[has_boxes]]
+
+    tasks = ((row, os.path.join(image_dir, file_name), preview_size) for row, file_name in enumerate(index.file_names))
+    progress = Throughput(index.num_images)
+    for row, brightness, contrast in bounded_imap(_brightness, tasks, num_workers=num_workers):
+        features[row, 5] = brightness
+        features[row, 6] = contrast
+        progress.update()
+    print("  " + progress.summary())
+    return features
+
+
+def k_center(features, num_picks):
+    """
+    Greedy k-center selection on standardized features.
+    Starts from the point nearest the median and repeatedly adds the point farthest from those picked.
+    :param features: (n, d) array
+    :param num_picks: Number of points to pick
+    :return: Array of the picked rows, in the order picked
+    """
+    num_picks = min(num_picks, len(features))
+    if num_picks == 0:
+        return np.zeros(0, dtype=np.int64)
+    center = np.median(features, axis=0)
+    spread = np.percentile(features, 75, axis=0) - np.percentile(features, 25, axis=0)
+    spread = np.where(spread > 0, spread, np.maximum(features.std(axis=0), 1e-12))
+    points = (features - center) / spread
+    picked = [int(np.argmin((points ** 2).sum(axis=1)))]
+    distance = ((points - points[picked[0]]) ** 2).sum(axis=1)
+    for _ in range(num_picks - 1):
+        new = int(np.argmax(distance))
+        picked.append(new)
+        distance = np.minimum(distance, ((points - points[new]) ** 2).sum(axis=1))
+    return np.array(picked, dtype=np.int64)
+
+
+def _brightness(task):
+    """Mean and standard deviation of the luminance of a reduced-size decode. Runs on a worker."""
+    row, filepath, preview_size = task
+    try:
+        image = Image.open(filepath)
+        image.draft('L', (preview_size, preview_size))
+        image = image.convert("L")
+        image.thumbnail((preview_size, preview_size))
+        pixels = np.asarray(image, dtype=np.float64)
+    except OSError:
+        return row, np.nan, np.nan
+    return row, pixels.mean(), pixels.std()
+
+
+def _print_coverage(all_features, picked_features):
+    """Print the 5th, 50th and 95th percentile of each feature, for all images and for the picked images"""
+    print("  %16s %26s %26s" % ('feature', 'all (p5 / p50 / p95)', 'picked (p5 / p50 / p95)'))
+    for ii, name in enumerate(FEATURES):
+        a = np.percentile(all_features[:, ii], [5, 50, 95])
+        b = np.percentile(picked_features[:, ii], [5, 50, 95])
+        print("  %16s %8.3f %8.3f %8.3f %8.3f %8.3f %8.3f" % ((name,) + tuple(a) + tuple(b)))
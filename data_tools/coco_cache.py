@@ -0,0 +1,205 @@
+"""
+Binary cache of COCO annotation files.
+
+The cache of annotations.json is annotations.json.bin. It holds each column of a CocoIndex as raw contiguous
+data, so opening it memory-maps the file and builds no Python objects: numeric columns (ids, boxes, areas,
+category ids) become read-only NumPy arrays over the mapping, and string columns (file names) are decoded
+from a string table only when accessed. Conversion to and from JSON is lossless: columns mixing ints and floats
+are not arrays (see coco_index._to_array) but stored as JSON text, so 12 does not come back as 12.0.
+
+File layout:
+    8 bytes   magic, b'COCOBIN1'
+    8 bytes   little-endian uint64, length of the JSON header
+    header    JSON: size and mtime of the source file, the COCO header (info, licenses, categories),
+              field order, and the dtype, shape and offset of every column
+    data      column data, each column starting on a 64 byte boundary
+"""
+
+import os
+import json
+import mmap
+import struct
+import numpy as np
+from data_tools.coco_index import CocoIndex, load_index, _MISSING
+
+MAGIC = b'COCOBIN1'
+CACHE_SUFFIX = '.bin'
+_ALIGN = 64
+
+
+def cache_path(json_path):
+    """Path of the binary cache of a JSON annotation file"""
+    return json_path + CACHE_SUFFIX
+
+
+def write_cache(annotations, json_path):
+    """
+    Write the binary cache of json_path.
+    :param annotations: COCO dict or CocoIndex holding the contents of json_path. If None, json_path is read.
+    :param json_path: The JSON annotation file. It must exist, as the cache records its size and mtime.
+    :return: Path of the cache file
+    """
+    index = load_index(annotations if annotations is not None else json_path)
+    st = os.stat(json_path)
+    columns = []
+    blobs = []
+    for table, table_columns in (('images', index.image_columns), ('annotations', index.ann_columns)):
+        for key, column in table_columns.items():
+            desc, arrays = _encode_column(column)
+            desc.update({'table': table, 'key': key})
+            columns.append(desc)
+            blobs.append(arrays)
+
+    # Lay out the arrays after the header. The header holds the offsets, so size it with placeholder offsets first.
+    header = {'source': {'size': st.st_size, 'mtime_ns': st.st_mtime_ns},
+              'header': index.header, 'image_keys': index.image_keys, 'ann_keys': index.ann_keys,
+              'columns': columns}
+    for desc, arrays in zip(columns, blobs):
+        desc['arrays'] = [{'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': 0} for arr in arrays]
+    header_len = len(json.dumps(header).encode('utf-8')) + 32 * sum(len(arrays) for arrays in blobs)
+    offset = _aligned(16 + header_len)
+    for desc, arrays in zip(columns, blobs):
+        for arr_desc, arr in zip(desc['arrays'], arrays):
+            arr_desc['offset'] = offset
+            offset = _aligned(offset + arr.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+    assert len(header_bytes) <= header_len
+    header_bytes = header_bytes.ljust(header_len)
+
+    out_path = cache_path(json_path)
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', header_len))
+        f.write(header_bytes)
+        for desc, arrays in zip(columns, blobs):
+            for arr_desc, arr in zip(desc['arrays'], arrays):
+                f.write(b'\0' * (arr_desc['offset'] - f.tell()))
+                f.write(np.ascontiguousarray(arr).tobytes())
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def cache_is_fresh(json_path):
+    """True if json_path has a binary cache written from its current contents"""
+    path = cache_path(json_path)
+    if not os.path.isfile(path):
+        return False
+    try:
+        header = _read_header(path)[0]
+    except (IOError, ValueError):
+        return False
+    st = os.stat(json_path)
+    return header['source']['size'] == st.st_size and header['source']['mtime_ns'] == st.st_mtime_ns
+
+
+def load_cache(json_path):
+    """
+    Open the binary cache of json_path as a CocoIndex. Numeric columns are read-only arrays over a memory map
+    of the file, so only the parts that are used are read from disk.
+    """
+    path = cache_path(json_path)
+    header, _ = _read_header(path)
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    image_columns = {}
+    ann_columns = {}
+    for desc in header['columns']:
+        arrays = [np.frombuffer(mm, dtype=np.dtype(aa['dtype']), count=int(np.prod(aa['shape'], dtype=np.int64)),
+                                offset=aa['offset']).reshape(aa['shape']) for aa in desc['arrays']]
+        column = _decode_column(desc, arrays)
+        if desc['table'] == 'images':
+            image_columns[desc['key']] = column
+        else:
+            ann_columns[desc['key']] = column
+    return CocoIndex(header['header'], image_columns, ann_columns, header['image_keys'], header['ann_keys'])
+
+
+class StringColumn(object):
+    """Read-only sequence of strings stored in a string table: utf-8 data plus N + 1 offsets"""
+
+    def __init__(self, data, offsets, missing=None):
+        self.data = data
+        self.offsets = offsets
+        self.missing = missing
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        if self.missing is not None and self.missing[row]:
+            return _MISSING
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self.data[start:end].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        data = self.data.tobytes()
+        offsets = self.offsets.tolist()
+        missing = self.missing.tolist() if self.missing is not None else None
+        for row in range(len(self)):
+            if missing is not None and missing[row]:
+                yield _MISSING
+            else:
+                yield data[offsets[row]:offsets[row + 1]].decode('utf-8')
+
+
+class JsonColumn(StringColumn):
+    """Column of arbitrary JSON values, each stored as its JSON text in a string table"""
+
+    def __getitem__(self, row):
+        value = StringColumn.__getitem__(self, row)
+        return value if value is _MISSING else json.loads(value)
+
+    def __iter__(self):
+        for value in StringColumn.__iter__(self):
+            yield value if value is _MISSING else json.loads(value)
+
+
+def _encode_column(column):
+    """Return (description, list of arrays) for a column"""
+    if isinstance(column, np.ndarray):
+        if column.dtype.kind not in 'biuf':
+            raise TypeError("Cannot cache array of dtype %s" % column.dtype)
+        return {'kind': 'array'}, [column]
+    values = list(column)
+    if all(vv is None for vv in values):
+        return {'kind': 'none', 'length': len(values)}, []
+    missing = np.array([vv is _MISSING for vv in values], dtype=bool)
+    if all(isinstance(vv, str) or vv is _MISSING for vv in values):
+        kind = 'string'
+        texts = ['' if vv is _MISSING else vv for vv in values]
+    else:
+        kind = 'json'
+        texts = ['' if vv is _MISSING else json.dumps(vv) for vv in values]
+    encoded = [tt.encode('utf-8') for tt in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(ee) for ee in encoded], out=offsets[1:])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    arrays = [data, offsets]
+    if missing.any():
+        arrays.append(missing)
+    return {'kind': kind}, arrays
+
+
+def _decode_column(desc, arrays):
+    if desc['kind'] == 'array':
+        return arrays[0]
+    if desc['kind'] == 'none':
+        return [None] * desc['length']
+    missing = arrays[2] if len(arrays) > 2 else None
+    if desc['kind'] == 'string':
+        return StringColumn(arrays[0], arrays[1], missing)
+    return JsonColumn(arrays[0], arrays[1], missing)
+
+
+def _read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(8) != MAGIC:
+            raise ValueError("%s is not a COCO binary cache" % path)
+        (header_len,) = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    return header, 16 + header_len
+
+
+def _aligned(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
@@ -0,0 +1,310 @@
+"""
+Indexed, array-backed view of a COCO annotation file.
+
+A COCO file is loaded once, and each field of the images and annotations is stored as one column: a NumPy
+array for numeric fields (ids, sizes, boxes, areas, box-shaped segmentations) and a list otherwise (file
+names, urls). Lookups by image id, file name and category id are O(1).
+"""
+
+import numpy as np
+
+_MISSING = object()  # Marks a field absent from a particular image or annotation.
+
+
+class CocoIndex(object):
+    """
+    COCO annotations stored column by column, with lookup indexes.
+    Rows are numbered in file order: image_columns['id'][row] is the id of the row'th image in the file.
+    """
+
+    def __init__(self, header, image_columns, ann_columns, image_keys=None, ann_keys=None):
+        """
+        Use CocoIndex.from_file or CocoIndex.from_dict rather than calling this directly.
+        :param header: dict with everything but images and annotations (info, licenses, categories)
+        :param image_columns: dict of field: array or list, one entry per image
+        :param ann_columns: dict of field: array or list, one entry per annotation
+        :param image_keys: Order of the fields in each image dict. Defaults to the order of image_columns.
+        :param ann_keys: Order of the fields in each annotation dict. Defaults to the order of ann_columns.
+        """
+        self.header = header
+        self.image_columns = image_columns
+        self.ann_columns = ann_columns
+        self.image_keys = list(image_keys if image_keys is not None else image_columns)
+        self.ann_keys = list(ann_keys if ann_keys is not None else ann_columns)
+        self._build_index()
+
+    @classmethod
+    def from_dict(cls, anns):
+        """Build an index from a COCO dict, as returned by read_json"""
+        header = {key: value for key, value in anns.items() if key not in ('images', 'annotations')}
+        image_columns, image_keys = _to_columns(anns['images'], required=('id', 'file_name'))
+        ann_columns, ann_keys = _to_columns(anns['annotations'], required=('id', 'image_id', 'category_id', 'bbox'))
+        return cls(header, image_columns, ann_columns, image_keys, ann_keys)
+
+    @classmethod
+    def from_file(cls, coco_annotation, verbose=False):
+        """Read a COCO JSON file and build an index of it, using its binary cache if that is up to date"""
+        from data_tools.coco_cache import cache_is_fresh, load_cache
+        from data_tools.coco_tools import read_json
+        if cache_is_fresh(coco_annotation):
+            if verbose:
+                print("Reading annotaitons from binary cache of", coco_annotation)
+            return load_cache(coco_annotation)
+        return cls.from_dict(read_json(coco_annotation, verbose=verbose, prefer_cache=False))
+
+    def _build_index(self):
+        """Lookup indexes are built on first use, so opening a memory-mapped index (see coco_cache) is cheap."""
+        self._cache = {}
+
+    def _cached(self, name, build):
+        value = self._cache.get(name)
+        if value is None:
+            value = self._cache[name] = build()
+        return value
+
+    @property
+    def _imgid2row(self):
+        return self._cached('imgid2row', lambda: {imgid: row for row, imgid in enumerate(self.image_ids.tolist())})
+
+    @property
+    def _filename2row(self):
+        return self._cached('filename2row', lambda: {fn: row for row, fn in enumerate(self.image_columns['file_name'])})
+
+    @property
+    def _img_sorter(self):
+        return self._cached('img_sorter', lambda: np.argsort(self.image_ids, kind='stable'))
+
+    @property
+    def ann_image_rows(self):
+        """Image row of each annotation (-1 if its image is not in the index)"""
+        return self._cached('ann_image_rows', lambda: self.image_rows(np.asarray(self.ann_columns['image_id'])))
+
+    @property
+    def _ann_by_image(self):
+        # Annotations grouped by image row: the annotations of image row r are
+        # self._ann_by_image[self._image_ann_start[r]:self._image_ann_start[r + 1]]
+        return self._cached('ann_by_image', lambda: np.argsort(self.ann_image_rows, kind='stable'))
+
+    @property
+    def _image_ann_start(self):
+        return self._cached('image_ann_start', lambda: np.searchsorted(self.ann_image_rows[self._ann_by_image],
+                                                                       np.arange(self.num_images + 1)))
+
+    @property
+    def _ann_by_cat(self):
+        return self._cached('ann_by_cat', lambda: np.argsort(np.asarray(self.ann_columns['category_id']),
+                                                             kind='stable'))
+
+    @property
+    def _catid2slice(self):
+        def build():
+            sorted_cats = np.asarray(self.ann_columns['category_id'])[self._ann_by_cat]
+            uniq, start = np.unique(sorted_cats, return_index=True)
+            end = np.append(start[1:], len(sorted_cats))
+            return {catid: (s, e) for catid, s, e in zip(uniq.tolist(), start.tolist(), end.tolist())}
+        return self._cached('catid2slice', build)
+
+    def __len__(self):
+        return self.num_images
+
+    @property
+    def num_images(self):
+        return len(self.image_columns['id'])
+
+    @property
+    def num_annotations(self):
+        return len(self.ann_columns['id'])
+
+    @property
+    def categories(self):
+        return self.header.get('categories', [])
+
+    @property
+    def image_ids(self):
+        return np.asarray(self.image_columns['id'])
+
+    @property
+    def file_names(self):
+        return self.image_columns['file_name']
+
+    @property
+    def bboxes(self):
+        """(num_annotations, 4) array of [xmin, ymin, w, h]"""
+        return np.asarray(self.ann_columns['bbox']).reshape(-1, 4)
+
+    def image_row(self, img_id):
+        return self._imgid2row[img_id]
+
+    def image_rows(self, img_ids):
+        """Vectorised image_row. Ids that are not in the index map to -1."""
+        img_ids = np.asarray(img_ids)
+        all_ids = np.asarray(self.image_columns['id'])
+        if len(all_ids) == 0:
+            return np.full(img_ids.shape, -1, dtype=np.int64)
+        pos = np.searchsorted(all_ids, img_ids, sorter=self._img_sorter)
+        rows = self._img_sorter[np.minimum(pos, len(all_ids) - 1)]
+        return np.where(all_ids[rows] == img_ids, rows, -1)
+
+    def filename2imgid(self, filename):
+        return self.image_columns['id'][self._filename2row[filename]]
+
+    def image(self, img_id):
+        return self.image_at(self._imgid2row[img_id])
+
+    def image_at(self, row):
+        return _record(self.image_columns, self.image_keys, row)
+
+    def annotation_at(self, row):
+        return _record(self.ann_columns, self.ann_keys, row)
+
+    def ann_rows_at(self, image_row):
+        """Annotation rows of the image at image_row"""
+        return self._ann_by_image[self._image_ann_start[image_row]:self._image_ann_start[image_row + 1]]
+
+    def ann_rows(self, img_id):
+        """Annotation rows of image img_id"""
+        return self.ann_rows_at(self._imgid2row[img_id])
+
+    def annotations(self, img_id):
+        """Annotation dicts of image img_id"""
+        return [self.annotation_at(row) for row in self.ann_rows(img_id).tolist()]
+
+    def boxes(self, img_id):
+        """(k, 4) array of the [xmin, ymin, w, h] boxes of image img_id"""
+        return self.bboxes[self.ann_rows(img_id)]
+
+    def cat_ann_rows(self, cat_id):
+        """Annotation rows with category cat_id"""
+        start, end = self._catid2slice.get(cat_id, (0, 0))
+        return self._ann_by_cat[start:end]
+
+    def catid2name(self):
+        return {cat['id']: cat['name'] for cat in self.categories}
+
+    def images(self):
+        """Iterate over image dicts in file order"""
+        for row in range(self.num_images):
+            yield self.image_at(row)
+
+    def annotation_dicts(self):
+        """Iterate over annotation dicts in file order"""
+        for row in range(self.num_annotations):
+            yield self.annotation_at(row)
+
+    def copy(self):
+        """Shallow copy: columns can be replaced in the copy without touching this index"""
+        return CocoIndex(dict(self.header), dict(self.image_columns), dict(self.ann_columns),
+                         self.image_keys, self.ann_keys)
+
+    def subset(self, image_rows, renumber_from=None):
+        """
+        Return a new index with the images at image_rows (in that order) and their annotations (in file order).
+        :param image_rows: array of image rows
+        :param renumber_from: If not None, image and annotation ids are renumbered consecutively from this value.
+        """
+        image_rows = np.asarray(image_rows, dtype=np.int64)
+        keep = np.zeros(self.num_images, dtype=bool)
+        keep[image_rows] = True
+        ann_rows = np.flatnonzero(keep[self.ann_image_rows] & (self.ann_image_rows >= 0))
+        image_columns = {key: _take(col, image_rows) for key, col in self.image_columns.items()}
+        ann_columns = {key: _take(col, ann_rows) for key, col in self.ann_columns.items()}
+        if renumber_from is not None:
+            old2new = np.zeros(self.num_images, dtype=np.int64)
+            old2new[image_rows] = renumber_from + np.arange(len(image_rows))
+            image_columns['id'] = old2new[image_rows]
+            ann_columns['image_id'] = old2new[self.ann_image_rows[ann_rows]]
+            ann_columns['id'] = renumber_from + np.arange(len(ann_rows))
+        return CocoIndex(dict(self.header), image_columns, ann_columns, self.image_keys, self.ann_keys)
+
+    def to_dict(self):
+        """Return the annotations as a COCO dict, as read by read_json"""
+        anns = dict(self.header)
+        anns['images'] = _to_records(self.image_columns, self.image_keys)
+        anns['annotations'] = _to_records(self.ann_columns, self.ann_keys)
+        return anns
+
+
+def load_index(annotations, verbose=False):
+    """Return a CocoIndex for annotations, which can be a COCO JSON file, a COCO dict or a CocoIndex"""
+    if isinstance(annotations, CocoIndex):
+        return annotations
+    if isinstance(annotations, dict):
+        return CocoIndex.from_dict(annotations)
+    return CocoIndex.from_file(annotations, verbose=verbose)
+
+
+def _to_columns(records, required=()):
+    """Turn a list of dicts into a dict of columns, using arrays for fixed-shape numeric fields"""
+    keys = {}
+    for record in records:
+        for key in record:
+            keys.setdefault(key, True)
+    for key in required:
+        keys.setdefault(key, True)
+    columns = {}
+    for key in keys:
+        values = [record.get(key, _MISSING) for record in records]
+        columns[key] = _to_array(values, required=key in required)
+    return columns, list(keys)
+
+
+def _to_array(values, required=False):
+    """
+    Convert a column to a NumPy array if it is numeric with a fixed shape, else leave it as a list.
+    A column mixing ints and floats (or bools and ints) stays a list, so that e.g. area 12 is not read back as 12.0.
+    """
+    if not values:
+        return values
+    try:
+        arr = np.array(values)
+    except (ValueError, TypeError):
+        arr = None
+    if arr is not None and arr.dtype.kind in 'biuf' and not _mixed_types(values, arr.dtype.kind):
+        return arr
+    if required and any(vv is _MISSING for vv in values):
+        raise KeyError("Required field missing from some records.")
+    return values
+
+
+def _mixed_types(values, kind):
+    """Whether the scalars of a column (of dtype kind kind once converted) are not all of the matching Python type"""
+    if kind == 'b':
+        return False
+    expected = (float, np.floating) if kind == 'f' else (int, np.integer)
+    stack = list(values)
+    while stack:
+        vv = stack.pop()
+        if isinstance(vv, (list, tuple)):
+            stack.extend(vv)
+        elif isinstance(vv, (bool, np.bool_)) or not isinstance(vv, expected):
+            return True
+    return False
+
+
+def _take(column, rows):
+    if isinstance(column, np.ndarray):
+        return column[rows]
+    return [column[row] for row in rows.tolist()]
+
+
+def _record(columns, keys, row):
+    record = {}
+    for key in keys:
+        value = columns[key][row]
+        if value is _MISSING:
+            continue
+        if isinstance(value, np.ndarray):
+            value = value.tolist()
+        elif isinstance(value, np.generic):
+            value = value.item()
+        record[key] = value
+    return record
+
+
+def _to_records(columns, keys):
+    """Inverse of _to_columns"""
+    values = [columns[key].tolist() if isinstance(columns[key], np.ndarray) else columns[key] for key in keys]
+    records = []
+    for row in zip(*values):
+        records.append({key: value for key, value in zip(keys, row) if value is not _MISSING})
+    return records
@@ -0,0 +1,251 @@
+"""
+Streaming reading and writing of COCO JSON files.
+
+CocoWriter writes images and annotations as they are produced, so large outputs never have to be held in
+memory as one dict. Records are appended to a spool directory next to the output (<output>.partial/, one
+JSON record per line, flushed as written); close() assembles the final JSON file from the spool. If a
+conversion crashes, CocoWriter(..., resume=True) picks up the spool and reports which images are already
+written, so the producer can skip them.
+
+iter_json_array reads the records of one top-level array (e.g. 'annotations') one at a time, without loading
+the whole file.
+"""
+
+import os
+import json
+import shutil
+
+_CHUNK_SIZE = 1 << 20
+
+
+class CocoWriter(object):
+    """
+    Incremental COCO JSON writer.
+
+        with CocoWriter(path, {'info': ..., 'licenses': [], 'categories': cats}) as writer:
+            for img, anns in produce():
+                writer.add(img, anns)
+    """
+
+    def __init__(self, output_path, header, resume=False):
+        """
+        :param output_path: JSON file to write
+        :param header: dict of everything except images and annotations (info, licenses, categories)
+        :param resume: Continue from the spool of an earlier, interrupted writer if there is one.
+            The header of the earlier run is kept. See written_image_ids.
+        """
+        dir_ = os.path.split(output_path)[0]
+        assert os.path.isdir(dir_ or '.'), "Directory %s does not exist" % dir_
+        self.output_path = output_path
+        self.spool_dir = output_path + '.partial'
+        self.written_image_ids = set()
+        self.num_images = 0
+        self.num_annotations = 0
+
+        header_path = os.path.join(self.spool_dir, 'header.json')
+        if resume and os.path.isfile(header_path):
+            with open(header_path) as f:
+                self.header = json.load(f)
+            self._recover()
+        else:
+            if os.path.isdir(self.spool_dir):
+                shutil.rmtree(self.spool_dir)
+            os.makedirs(self.spool_dir)
+            self.header = header
+            with open(header_path, 'w') as f:
+                json.dump(header, f)
+        self._images = open(os.path.join(self.spool_dir, 'images.jsonl'), 'a')
+        self._annotations = open(os.path.join(self.spool_dir, 'annotations.jsonl'), 'a')
+
+    def _recover(self):
+        """Drop partially written lines, and annotations of images that were never written"""
+        images_path = os.path.join(self.spool_dir, 'images.jsonl')
+        for line in _complete_lines(images_path):
+            self.written_image_ids.add(json.loads(line)['id'])
+            self.num_images += 1
+        annotations_path = os.path.join(self.spool_dir, 'annotations.jsonl')
+        with open(annotations_path + '.tmp', 'w') as f:
+            for line in _complete_lines(annotations_path):
+                if json.loads(line)['image_id'] in self.written_image_ids:
+                    f.write(line)
+                    self.num_annotations += 1
+        os.replace(annotations_path + '.tmp', annotations_path)
+        print(" Resuming %s: %i images and %i annotations already written."
+              % (self.output_path, self.num_images, self.num_annotations))
+
+    def add_image(self, img):
+        self._images.write(json.dumps(img) + '\n')
+        self.written_image_ids.add(img['id'])
+        self.num_images += 1
+
+    def add_annotation(self, ann):
+        self._annotations.write(json.dumps(ann) + '\n')
+        self.num_annotations += 1
+
+    def add(self, img, anns):
+        """
+        Add an image and all of its annotations. The annotations are written first, so after a crash an image
+        is only ever found in the spool together with all of its annotations.
+        """
+        for ann in anns:
+            self.add_annotation(ann)
+        self._annotations.flush()
+        self.add_image(img)
+        self._images.flush()
+
+    def close(self):
+        """Assemble the output JSON file from the spool, then delete the spool"""
+        self._images.close()
+        self._annotations.close()
+        tmp_path = self.output_path + '.tmp'
+        with open(tmp_path, 'w') as out:
+            out.write('{')
+            for key, value in self.header.items():
+                out.write('%s: %s, ' % (json.dumps(key), json.dumps(value)))
+            out.write('"images": [')
+            _copy_lines_as_array(os.path.join(self.spool_dir, 'images.jsonl'), out)
+            out.write('], "annotations": [')
+            _copy_lines_as_array(os.path.join(self.spool_dir, 'annotations.jsonl'), out)
+            out.write(']}')
+        os.replace(tmp_path, self.output_path)
+        shutil.rmtree(self.spool_dir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Keep the spool so that the run can be resumed.
+            self._images.close()
+            self._annotations.close()
+
+
+def write_index(index, output_path):
+    """Stream a CocoIndex to a COCO JSON file, one record at a time"""
+    with CocoWriter(output_path, index.header) as writer:
+        for img in index.images():
+            writer.add_image(img)
+        for ann in index.annotation_dicts():
+            writer.add_annotation(ann)
+    return writer
+
+
+def iter_json_array(json_path, key):
+    """
+    Iterate over the items of the top-level array json_path[key] (e.g. key='annotations'), reading the file
+    incrementally. Memory use is bounded by the size of the largest single item.
+    """
+    with open(json_path) as f:
+        reader = _JsonScanner(f)
+        reader.expect('{')
+        while reader.peek() != '}':
+            this_key = reader.value()
+            reader.expect(':')
+            if this_key == key:
+                for item in reader.array_items():
+                    yield item
+                return
+            if reader.peek() == '[':
+                for _ in reader.array_items():
+                    pass
+            else:
+                reader.value()
+            if reader.peek() != '}':
+                reader.expect(',')
+    raise KeyError("%s has no top-level key %s" % (json_path, key))
+
+
+class _JsonScanner(object):
+    """Pulls JSON tokens and values from a file through a bounded buffer"""
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.f.read(_CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self):
+        """Return the next non-whitespace character, without consuming it"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                raise ValueError("Unexpected end of JSON file")
+            self._fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected %r in JSON file, found %r" % (char, self.buffer[self.pos]))
+        self.pos += 1
+
+    def value(self):
+        """Decode the next complete JSON value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise
+                self._fill()
+                continue
+            # A number at the end of the buffer may continue in the next chunk.
+            if end == len(self.buffer) and not self.eof:
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+    def array_items(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ']':
+                self.pos += 1
+                return
+            self.expect(',')
+
+
+def _complete_lines(path):
+    """Yield the newline-terminated lines of path, first truncating any partially written last line"""
+    if not os.path.isfile(path):
+        return
+    with open(path, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(end - _CHUNK_SIZE, 0)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        f.truncate(end)
+    with open(path) as f:
+        for line in f:
+            yield line
+
+
+def _copy_lines_as_array(path, out):
+    with open(path) as f:
+        first = True
+        for line in f:
+            if not first:
+                out.write(', ')
+            out.write(line.rstrip('\n'))
+            first = False
@@ -4,223 +4,435 @@ Tools for manipulating coco annotaitons
 
 import os
 import json
+import numpy as np
 from PIL import Image
-import random
-import shutil
-
-def resize(img_folder, annotations, resize_factor, output_img_folder, output_annotations):
+import hashlib
+from data_tools import instrument
+from data_tools.parallel import bounded_imap, Throughput
+from data_tools.materialize import materialize_images
+from data_tools.coco_index import CocoIndex, load_index
+from data_tools.coco_cache import cache_is_fresh, load_cache, write_cache
+from data_tools.coco_stream import CocoWriter, write_index, iter_json_array
+
+@instrument.instrumented('resize', unit='images')
+def resize(img_folder, annotations, resize_factor, output_img_folder, output_annotations,
+           num_workers=8, skip_existing=True, fast_decode=True, quality=95, use_processes=False):
     """
     Resize images to (original size * resize_factor)
     :param img_folder: Folder containing original images
-    :param annotations: File containing COCO style annotations
+    :param annotations: File containing COCO style annotations, or a CocoIndex
     :param resize_factor: factor to increase each dim size by. 0.25 = shrink by 4 x
     :param output_img_folder: Folder that will contain the new images
     :param output_annotations: File that will contain the new annotations.
+    :param num_workers: Number of images resized in parallel
+    :param skip_existing: Don't redo images whose output is newer than the original and already has the new size
+    :param fast_decode: When shrinking by 2x or more, let the JPEG decoder downscale while decoding (draft mode)
+    :param quality: JPEG quality of the saved images
+    :param use_processes: Use worker processes rather than threads
     :return:
     """
     # Check all files and directories exist
     assert os.path.isdir(img_folder), "Directory %s does not exist" % img_folder
     assert os.path.isdir(output_img_folder), "Directory %s does not exist" % output_img_folder
     assert os.path.isdir(os.path.split(output_annotations)[0]), "Directory %s does not exist" % os.path.split(output_annotations)[0]
-    assert os.path.isfile(annotations), "File %s does not exist" % annotations
+    _check_annotations(annotations)
 
     # Read in annotations
-    print("Reading annotaitons from", annotations)
-    with open(annotations) as f:
-        anns = json.load(f)
-    if not anns:
-        raise IOError("The annotation file is empty.")
-
-    new_images = []
-    old_images = anns['images']
-    # Work through each image in annotations, resizing height & width attributes and resizing and copying image.
-    for img in old_images:
-        old_filepath = os.path.join(img_folder, img['file_name'])
-        new_filepath = os.path.join(output_img_folder, img['file_name'])
-        new_w = int(resize_factor * img['width'])
-        new_h = int(resize_factor * img['height'])
-        img['width'] = new_w
-        img['height'] = new_h
-        new_images.append(img)
-
-        # Now resize
-        try:
-            image = Image.open(old_filepath).convert("RGB")
-        except FileNotFoundError:
+    index = load_index(annotations, verbose=True).copy()
+
+    # Resize height & width attributes of each image, then resize and copy the images on a worker pool.
+    new_w = (np.asarray(index.image_columns['width'], dtype=np.float64) * resize_factor).astype(np.int64)
+    new_h = (np.asarray(index.image_columns['height'], dtype=np.float64) * resize_factor).astype(np.int64)
+    index.image_columns['width'] = new_w
+    index.image_columns['height'] = new_h
+    draft = fast_decode and resize_factor <= 0.5
+    tasks = []
+    for file_name, w, h in zip(index.file_names, new_w.tolist(), new_h.tolist()):
+        tasks.append((os.path.join(img_folder, file_name), os.path.join(output_img_folder, file_name),
+                      w, h, draft, skip_existing, quality))
+
+    progress = Throughput(len(tasks))
+    instrument.set_total('resize', len(tasks))
+    counts = {'resized': 0, 'skipped': 0, 'missing': 0, 'damaged': 0}
+    for status, old_filepath, nbytes in bounded_imap(_resize_image, tasks, num_workers=num_workers,
+                                                     use_processes=use_processes):
+        counts[status] += 1
+        instrument.count('resize', status)
+        instrument.count('resize', 'bytes', nbytes)
+        instrument.count('resize', 'images')
+        if status == 'missing':
             print("Image not found:", old_filepath)
-            continue
-        except OSError:
+        elif status == 'damaged':
             print("Image damaged:", old_filepath)
-            continue
-        new_image = image.resize((new_w, new_h), Image.BILINEAR)
-        new_image.save(new_filepath, quality=95)
-
-        # print("DEBUG: Image size requested:", new_w, new_h)
-        # print("DEBUG: new_image.size", new_image.size)
-        # print("DEBUG: new_image location", new_filepath)
-        #
-        # raise NotImplementedError("TEST RESIZE)")
-
-    anns['images'] = new_images
-
-    # Work through annotations, resizing xmin, ymin, w, h.
-    old_anns = anns['annotations']
-    new_anns = []
-    for ann in old_anns:
-        [xmin, ymin, w, h] = ann['bbox']
-        xmin = int(xmin * resize_factor)
-        ymin = int(ymin * resize_factor)
-        w = int(w * resize_factor)
-        h = int(h * resize_factor)
-        xmax = xmin + w
-        ymax = ymin + h
-        ann['bbox'] = [xmin,  ymin, w, h]
-        ann['area'] = w * h
-        ann['seg'] = [xmin, ymin, xmin, ymax, xmax, ymax, xmax, ymin]
-        new_anns.append(ann)
-    anns['annotations'] = new_anns
+        progress.update(nbytes=nbytes)
+    print("  " + progress.summary())
+    print("  %(resized)i resized, %(skipped)i already up to date, %(missing)i not found, %(damaged)i damaged." % counts)
+
+    # Resize all annotation boxes at once: xmin, ymin, w, h.
+    boxes = (index.bboxes.astype(np.float64) * resize_factor).astype(np.int64)
+    xmin, ymin, w, h = boxes.T
+    index.ann_columns['bbox'] = boxes
+    index.ann_columns['area'] = w * h
+    index.ann_columns['seg'] = np.stack([xmin, ymin, xmin, ymin + h, xmin + w, ymin + h, xmin + w, ymin], axis=1)
+    for key in ('area', 'seg'):
+        if key not in index.ann_keys:
+            index.ann_keys.append(key)
     # Save out new annotations.
 
     print("All images resized and copied.")
-    with open(output_annotations, 'w') as outfile:
-        json.dump(anns, outfile)
+    with instrument.timer('resize', 'write_annotations'):
+        write_index(index, output_annotations)
 
 
-def split_dataset(input_annotations, frac_split_a, a_output_path, b_output_path):
+def _resize_image(task):
+    """
+    Resize one image. Runs on a worker.
+    :return: (status, old_filepath, bytes read), status being one of resized, skipped, missing, damaged
+    """
+    old_filepath, new_filepath, new_w, new_h, draft, skip_existing, quality = task
+    try:
+        old_stat = os.stat(old_filepath)
+    except FileNotFoundError:
+        return 'missing', old_filepath, 0
+    if skip_existing:
+        try:
+            if os.stat(new_filepath).st_mtime >= old_stat.st_mtime:
+                # Only the header is read. An output of another resize_factor is redone.
+                with Image.open(new_filepath) as existing:
+                    if existing.size == (new_w, new_h):
+                        return 'skipped', old_filepath, 0
+        except (OSError, SyntaxError):
+            pass
+    try:
+        with instrument.timer('resize', 'decode'):
+            image = Image.open(old_filepath)
+            if draft:
+                # JPEG only: decode at the smallest 1/2, 1/4 or 1/8 scale that is still >= the requested size.
+                image.draft('RGB', (new_w, new_h))
+            image = image.convert("RGB")
+        with instrument.timer('resize', 'resize'):
+            new_image = image.resize((new_w, new_h), Image.BILINEAR)
+        with instrument.timer('resize', 'encode'):
+            new_image.save(new_filepath, quality=quality)
+    except OSError:
+        return 'damaged', old_filepath, old_stat.st_size
+    return 'resized', old_filepath, old_stat.st_size
+
+
+def crop_faces(img_folder, annotations, output_img_folder, output_annotations, crop_size=512,
+               scales=(1.0, 0.5, 0.25), min_anchor_size=16, max_anchor_frac=0.5, min_ann_size=(2, 2),
+               max_crops_per_image=8, jitter=0.5, seed=0, anchor_categories=None, num_workers=8, skip_existing=True,
+               quality=95, use_processes=False):
+    """
+    Cut fixed-size training crops around the annotated boxes, at several scales.
+    At scale s, a crop covers a (crop_size / s) square of the original image, resized to crop_size x crop_size:
+    scale 1 keeps small faces at full resolution, smaller scales give larger faces more context. Crops are placed
+    around the boxes that are between min_anchor_size and max_anchor_frac * crop_size after scaling, skipping boxes
+    already inside a crop of the same scale. Every box of the image is remapped into each crop and clipped to it.
+    Parts of a crop beyond the image edge (when the scaled image is smaller than crop_size) are black.
+    :param img_folder: Folder containing original images
+    :param annotations: File containing COCO style annotations, or a CocoIndex
+    :param output_img_folder: Folder that will contain the crops, named <image>_s<scale>_<n>.jpg
+    :param output_annotations: File that will contain the crop annotations. Image and annotation ids are numbered
+        from 1. Each image records its source_file_name, the crop box [x, y, w, h] in the source image, and scale.
+    :param crop_size: Width and height of the crops in pixels
+    :param scales: Scale factors from original image to crop
+    :param min_anchor_size, max_anchor_frac: Size range (larger side, after scaling) of boxes that crops are placed
+        around
+    :param min_ann_size: (min width, min height) of boxes kept in a crop, after clipping and scaling
+    :param max_crops_per_image: Maximum number of crops of each image, over all scales
+    :param jitter: Move each crop at random by up to this fraction of the room around its box, so that boxes are
+        not always in the center. 0 centers every crop on its box.
+    :param seed: Seed of the jitter
+    :param anchor_categories: Category ids of the boxes crops are placed around (e.g. [1] for faces). Defaults to
+        all. Boxes of other categories are still remapped into the crops.
+    :param num_workers: Number of images cropped in parallel
+    :param skip_existing: Don't redo crops that are newer than the original
+    :param quality: JPEG quality of the saved crops
+    :param use_processes: Use worker processes rather than threads
+    :return: dict of counts per outcome (cropped, skipped, missing, damaged, no_crops)
+    """
+    assert os.path.isdir(img_folder), "Directory %s does not exist" % img_folder
+    assert os.path.isdir(output_img_folder), "Directory %s does not exist" % output_img_folder
+    output_dir = os.path.split(output_annotations)[0]
+    assert os.path.isdir(output_dir), "Directory %s does not exist" % output_dir
+    _check_annotations(annotations)
+    index = load_index(annotations, verbose=True)
+    width = np.asarray(index.image_columns['width'], dtype=np.float64)
+    height = np.asarray(index.image_columns['height'], dtype=np.float64)
+    bboxes = index.bboxes.astype(np.float64)
+    is_anchor = np.ones(index.num_annotations, dtype=bool)
+    if anchor_categories is not None:
+        is_anchor = np.isin(np.asarray(index.ann_columns['category_id']), list(anchor_categories))
+    counts = {'cropped': 0, 'skipped': 0, 'missing': 0, 'damaged': 0, 'no_crops': 0}
+
+    def tasks():
+        for row, file_name in enumerate(index.file_names):
+            ann_rows = index.ann_rows_at(row)
+            ann_rows = ann_rows[is_anchor[ann_rows]]
+            crops = plan_crops(bboxes[ann_rows], width[row], height[row], crop_size, scales, min_anchor_size,
+                               max_anchor_frac, max_crops_per_image, jitter, np.random.RandomState([seed, row]))
+            if not crops:
+                counts['no_crops'] += 1
+                continue
+            root = os.path.splitext(file_name)[0]
+            crop_names = ["%s_s%i_%i.jpg" % (root, scales.index(scale), ii) for ii, (scale, _) in enumerate(crops)]
+            yield (row, os.path.join(img_folder, file_name), output_img_folder, crop_names, crops, crop_size,
+                   skip_existing, quality)
+
+    header = dict(index.header)
+    header['info'] = "%s Crops of %i pixels at scales %s." % (index.header.get('info', ''), crop_size, list(scales))
+    progress = Throughput(index.num_images)
+    with CocoWriter(output_annotations, header) as writer:
+        for status, row, crop_names, crops, nbytes in bounded_imap(_crop_image, tasks(), num_workers=num_workers,
+                                                                   use_processes=use_processes, ordered=True):
+            counts[status] += 1
+            if status == 'missing':
+                print("Image not found:", os.path.join(img_folder, index.file_names[row]))
+            elif status == 'damaged':
+                print("Image damaged:", os.path.join(img_folder, index.file_names[row]))
+            else:
+                for crop_name, (scale, window) in zip(crop_names, crops):
+                    _add_crop(writer, index, row, crop_name, scale, window, crop_size, min_ann_size)
+            progress.update(nbytes=nbytes)
+    print("  " + progress.summary())
+    print("  %(cropped)i cropped, %(skipped)i already up to date, %(missing)i not found, %(damaged)i damaged, "
+          "%(no_crops)i without boxes to crop around." % counts)
+    print("Wrote %i crops with %i annotations." % (writer.num_images, writer.num_annotations))
+    return counts
+
+
+def plan_crops(bboxes, width, height, crop_size, scales, min_anchor_size=16, max_anchor_frac=0.5,
+               max_crops=8, jitter=0.0, random_state=None):
+    """
+    Choose the crops of one image, see crop_faces.
+    :param bboxes: (n, 4) array of COCO [x, y, w, h] boxes to place crops around
+    :return: List of (scale, [x0, y0, x1, y1] window in the original image)
+    """
+    crops = []
+    box_size = np.maximum(bboxes[:, 2], bboxes[:, 3])
+    for scale in scales:
+        side = crop_size / float(scale)
+        anchors = np.flatnonzero((box_size * scale >= min_anchor_size)
+                                 & (box_size * scale <= max_anchor_frac * crop_size))
+        windows = []
+        # Largest boxes first, so that the crops of a scale cover as many boxes as possible
+        for ann in anchors[np.argsort(-box_size[anchors], kind='stable')].tolist():
+            if len(crops) >= max_crops:
+                return crops
+            x, y, w, h = bboxes[ann].tolist()
+            if any(x >= wx0 and y >= wy0 and x + w <= wx1 and y + h <= wy1 for wx0, wy0, wx1, wy1 in windows):
+                continue
+            origin = []
+            for start, size, image_size in ((x, w, width), (y, h, height)):
+                lo = start + size / 2.0 - side / 2.0
+                if jitter and random_state is not None:
+                    lo += random_state.uniform(-0.5, 0.5) * jitter * (side - size)
+                # Keep the box in the crop, and the crop in the image where it fits
+                lo = min(max(lo, start + size - side), start)
+                lo = min(max(lo, 0.0), max(image_size - side, 0.0))
+                origin.append(lo)
+            window = [origin[0], origin[1], origin[0] + side, origin[1] + side]
+            windows.append(window)
+            crops.append((scale, window))
+    return crops
+
+
+def _add_crop(writer, index, row, crop_name, scale, window, crop_size, min_ann_size):
+    """Write the image and annotation records of one crop of image row"""
+    x0, y0, x1, y1 = window
+    ann_rows = index.ann_rows_at(row)
+    img = {'id': writer.num_images + 1, 'file_name': crop_name, 'width': crop_size, 'height': crop_size,
+           'source_file_name': index.file_names[row], 'crop': [x0, y0, x1 - x0, y1 - y0], 'scale': scale}
+    boxes = index.bboxes[ann_rows].astype(np.float64)
+    left = (np.clip(boxes[:, 0], x0, x1) - x0) * scale
+    top = (np.clip(boxes[:, 1], y0, y1) - y0) * scale
+    right = (np.clip(boxes[:, 0] + boxes[:, 2], x0, x1) - x0) * scale
+    bottom = (np.clip(boxes[:, 1] + boxes[:, 3], y0, y1) - y0) * scale
+    keep = (right - left >= min_ann_size[0]) & (bottom - top >= min_ann_size[1])
+    category_ids = np.asarray(index.ann_columns['category_id'])[ann_rows]
+    anns = []
+    for ii in np.flatnonzero(keep).tolist():
+        bw, bh = right[ii] - left[ii], bottom[ii] - top[ii]
+        anns.append({'id': writer.num_annotations + len(anns) + 1, 'image_id': img['id'],
+                     'category_id': int(category_ids[ii]),
+                     'segmentation': [left[ii], top[ii], left[ii], bottom[ii], right[ii], bottom[ii], right[ii],
+                                      top[ii]],
+                     'area': bw * bh, 'bbox': [left[ii], top[ii], bw, bh], 'iscrowd': 0})
+    writer.add(img, anns)
+
+
+def _crop_image(task):
+    """
+    Cut and save the crops of one image. Runs on a worker.
+    :return: (status, row, crop file names, crops, bytes read), status being one of cropped, skipped, missing or
+        damaged
+    """
+    row, filepath, output_folder, crop_names, crops, crop_size, skip_existing, quality = task
+    try:
+        old_stat = os.stat(filepath)
+    except FileNotFoundError:
+        return 'missing', row, crop_names, crops, 0
+    output_paths = [os.path.join(output_folder, crop_name) for crop_name in crop_names]
+    if skip_existing:
+        try:
+            if all(os.stat(path).st_mtime >= old_stat.st_mtime for path in output_paths):
+                return 'skipped', row, crop_names, crops, 0
+        except FileNotFoundError:
+            pass
+    try:
+        image = Image.open(filepath)
+        full_size = image.size
+        # JPEG only: decode at the smallest 1/2, 1/4 or 1/8 scale that the largest crop scale still needs
+        max_scale = max(scale for scale, _ in crops)
+        image.draft('RGB', (int(full_size[0] * max_scale), int(full_size[1] * max_scale)))
+        image = image.convert("RGB")
+        decode_scale = image.size[0] / float(full_size[0])
+        for path, (scale, window) in zip(output_paths, crops):
+            box = tuple(int(round(vv * decode_scale)) for vv in window)
+            image.crop(box).resize((crop_size, crop_size), Image.BILINEAR).save(path, quality=quality)
+    except OSError:
+        return 'damaged', row, crop_names, crops, old_stat.st_size
+    return 'cropped', row, crop_names, crops, old_stat.st_size
+
+
+def split_dataset(input_annotations, frac_split_a, a_output_path, b_output_path, salt="", stratify=False):
     """
     Split the dataset into two fractions, a and b.
-    :param input_annotations:
+    Images are assigned by a hash of their file_name, so the split is reproducible and adding images to the
+    dataset never moves existing images between a and b. See split_dataset_nway.
+    :param input_annotations: COCO annotation file, or a CocoIndex
     :param frac_split_a: 0.8 = 80% of data goes to a, 20% to b
     :param a_output_path:
     :param b_output_path:
+    :param salt: Changing the salt gives a different (but still reproducible) split
+    :param stratify: Balance the split of each category, see split_dataset_nway
     :return:
     """
-    # Check all files and directories exist
-    assert os.path.isdir(os.path.split(a_output_path)[0]), "Directory %s does not exist" % os.path.split(a_output_path)[0]
-    assert os.path.isdir(os.path.split(b_output_path)[0]), "Directory %s does not exist" % os.path.split(b_output_path)[0]
-    assert os.path.isfile(input_annotations), "File %s does not exist" % input_annotations
     assert 0 < frac_split_a < 1, "frac_split must be between 0 and 1"
+    split_dataset_nway(input_annotations, [frac_split_a, 1 - frac_split_a], [a_output_path, b_output_path],
+                       salt=salt, stratify=stratify, names=['A', 'B'])
 
-    # Read in annotations
-    print("Reading annotaitons from", input_annotations)
-    with open(input_annotations) as f:
-        input_anns = json.load(f)
-    if not input_anns:
-        raise IOError("The annotation file is empty.")
 
-    # Loop through images, assigning each to either 'a' or 'b'.
-    image_split_dict = {}
-    for im in input_anns['images']:
-        if random.random() < frac_split_a:
-            image_split_dict[im['id']] = 'a'
-        else:
-            image_split_dict[im['id']] = 'b'
-
-    # Now create two outputs and assign image and annotations to each.
-    output_a = {'info':
-                  input_anns['info'] + ' Split ' + str(frac_split_a),
-              'licenses': input_anns['licenses'],
-              'images': [],
-              'annotations': [],
-              'categories': input_anns['categories']}  # Prepare output
-    output_b = {'info':
-                  input_anns['info'] + ' Split ' + str(1 - frac_split_a),
-              'licenses': input_anns['licenses'],
-              'images': [],
-              'annotations': [],
-              'categories': input_anns['categories']}  # Prepare output
-
-    output_a_raw_images = []
-    output_b_raw_images = []
-
-    for im in input_anns['images']:
-        if image_split_dict[im['id']] == 'a':
-            output_a_raw_images.append(im)
-        elif image_split_dict[im['id']] == 'b':
-            output_b_raw_images.append(im)
-        else:
-            raise SyntaxError('im not assigned to a nor b.', im)
-
-    output_a_raw_anns = []
-    output_b_raw_anns = []
-
-    for ann in input_anns['annotations']:
-        if image_split_dict[ann['image_id']] == 'a':
-            output_a_raw_anns.append(ann)
-        elif image_split_dict[ann['image_id']] == 'b':
-            output_b_raw_anns.append(ann)
-        else:
-            raise SyntaxError('ann not assigned to a nor b.', ann)
-
-    # Now renumber the annotations and images in each
-    output_a_images = []
-    a_oldimgid2newimgid = {} # to use to convert annotations
-    for indx, aa in enumerate(output_a_raw_images):
-        a_oldimgid2newimgid[aa['id']] = indx
-        aa['id'] = indx
-        output_a_images.append(aa)
-    output_b_images = []
-    b_oldimgid2newimgid = {} # to use to convert annotations
-    for indx, bb in enumerate(output_b_raw_images):
-        b_oldimgid2newimgid[bb['id']] = indx
-        bb['id'] = indx
-        output_b_images.append(bb)
-
-    output_a_annotations = []
-    for indx, aa in enumerate(output_a_raw_anns):
-        new_image_id = a_oldimgid2newimgid[aa['image_id']]
-        aa['image_id'] = new_image_id
-        aa['id'] = indx
-        output_a_annotations.append(aa)
-
-    output_b_annotations = []
-    for indx, bb in enumerate(output_b_raw_anns):
-        new_image_id = b_oldimgid2newimgid[bb['image_id']]
-        bb['image_id'] = new_image_id
-        bb['id'] = indx
-        output_b_annotations.append(bb)
-
-    output_a['images'] = output_a_images
-    output_a['annotations'] = output_a_annotations
-
-    output_b['images'] = output_b_images
-    output_b['annotations'] = output_b_annotations
-
-    # Write some info
-    print("Split A contains %i images and %i annotations." % (len(output_a['images']), len(output_a['annotations'])))
-    print("Split B contains %i images and %i annotations." % (len(output_b['images']), len(output_b['annotations'])))
-
-    # Write each out
-    with open(a_output_path, 'w') as outfile:
-        json.dump(output_a, outfile)
-    with open(b_output_path, 'w') as outfile:
-        json.dump(output_b, outfile)
-
-
-def copy_images(all_img_dir, new_img_dir, ann_file):
+def split_dataset_nway(input_annotations, fractions, output_paths, salt="", stratify=False, names=None):
     """
-    Copy all images mentioned in ann_file from all_img_dir to new_img_dir
+    Split the dataset into len(fractions) parts (e.g. train/val/test) in a single pass, renumbering the image
+    and annotation ids of each part from 0.
+    :param input_annotations: COCO annotation file, or a CocoIndex
+    :param fractions: Fraction of the images in each part, e.g. [0.8, 0.1, 0.1]. Must sum to 1.
+    :param output_paths: Output annotation file of each part
+    :param salt: Changing the salt gives a different (but still reproducible) split
+    :param stratify: If False, each image goes to the part its file_name hash falls in, so adding images never
+        moves existing ones. If True, each image is grouped by its rarest category and the images of each group
+        are divided in hash order, so that every category (even rare ones) is split in the requested fractions.
+        Adding images can then move existing images near the group boundaries.
+    :param names: Names used when printing a summary of each part
+    :return: Array with the part of each image, in file order
+    """
+    # Check all files and directories exist
+    assert len(fractions) == len(output_paths), "Need one output path per fraction"
+    assert all(ff > 0 for ff in fractions) and abs(sum(fractions) - 1) < 1e-6, "fractions must be positive and sum to 1"
+    for path in output_paths:
+        assert os.path.isdir(os.path.split(path)[0]), "Directory %s does not exist" % os.path.split(path)[0]
+    _check_annotations(input_annotations)
+    if names is None:
+        names = [str(ii) for ii in range(len(fractions))]
+
+    # Read in annotations
+    index = load_index(input_annotations, verbose=True)
+
+    # Assign each image to a part.
+    bounds = np.cumsum(fractions)[:-1]
+    position = _hash_fractions(index.file_names, salt)
+    if stratify:
+        position = _stratified_positions(index, position)
+    image_split = np.searchsorted(bounds, position, side='right')
+
+    # Write all parts in one sweep over the images.
+    writers = []
+    for frac, path in zip(fractions, output_paths):
+        header = dict(index.header)
+        header['info'] = index.header['info'] + ' Split ' + str(frac)
+        writers.append(CocoWriter(path, header))
+    for row, part in enumerate(image_split.tolist()):
+        writer = writers[part]
+        img = index.image_at(row)
+        img['id'] = writer.num_images
+        anns = []
+        for ann_row in index.ann_rows_at(row).tolist():
+            ann = index.annotation_at(ann_row)
+            ann['id'] = writer.num_annotations + len(anns)
+            ann['image_id'] = img['id']
+            anns.append(ann)
+        writer.add(img, anns)
+    for name, writer in zip(names, writers):
+        writer.close()
+        # Write some info
+        print("Split %s contains %i images and %i annotations." % (name, writer.num_images, writer.num_annotations))
+    return image_split
+
+
+def _hash_fractions(file_names, salt=""):
+    """Map each file name to a stable pseudo-random number in [0, 1)"""
+    digests = b''.join(hashlib.blake2b((salt + fn).encode('utf-8'), digest_size=8).digest() for fn in file_names)
+    return np.frombuffer(digests, dtype='>u8') / float(2 ** 64)
+
+
+def _stratified_positions(index, position):
+    """
+    Replace the hash position of each image by its rank within its stratum (the image's rarest category),
+    scaled to [0, 1). Images without annotations form one more stratum.
+    """
+    cat_ids = np.asarray(index.ann_columns['category_id'])
+    uniq, cat_codes, cat_counts = np.unique(cat_ids, return_inverse=True, return_counts=True)
+    stratum = np.full(index.num_images, len(uniq), dtype=np.int64)
+    valid = index.ann_image_rows >= 0
+    # Rarest category of each image: minimum over its annotations of (count, category) encoded as one integer.
+    key = cat_counts[cat_codes].astype(np.int64) * (len(uniq) + 1) + cat_codes
+    best = np.full(index.num_images, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(best, index.ann_image_rows[valid], key[valid])
+    has_ann = best != np.iinfo(np.int64).max
+    stratum[has_ann] = best[has_ann] % (len(uniq) + 1)
+
+    # Rank images by hash within each stratum.
+    order = np.lexsort((position, stratum))
+    sorted_stratum = stratum[order]
+    starts = np.searchsorted(sorted_stratum, sorted_stratum, side='left')
+    sizes = np.searchsorted(sorted_stratum, sorted_stratum, side='right') - starts
+    ranked = np.empty(len(position), dtype=np.float64)
+    ranked[order] = (np.arange(len(order)) - starts + 0.5) / sizes
+    return ranked
+
+
+def copy_images(all_img_dir, new_img_dir, ann_file, mode='copy', num_workers=8):
+    """
+    Copy all images mentioned in ann_file (a COCO annotation file or CocoIndex) from all_img_dir to new_img_dir
+    :param mode: copy, hardlink, symlink or reflink. See materialize.materialize_images.
+    :param num_workers: Number of files handled in parallel
     """
     assert os.path.isdir(all_img_dir), "Directory %s does not exist" % all_img_dir
     assert os.path.isdir(new_img_dir), "Directory %s does not exist" % new_img_dir
-    assert os.path.isfile(ann_file), "File %s does not exist" % ann_file
-
-    print("Reading annotaitons from", ann_file)
-    with open(ann_file) as f:
-        input_anns = json.load(f)
-    if not input_anns:
-        raise IOError("The annotation file is empty.")
+    _check_annotations(ann_file)
 
     # Get list of images
-    img_list = [im['file_name'] for im in input_anns['images']]
+    img_list = load_index(ann_file, verbose=True).file_names
 
     # Work through list
-    for im in img_list:
-        old_path = os.path.join(all_img_dir, im)
-        new_path = os.path.join(new_img_dir, im)
-        shutil.copy(old_path, new_path)
+    summary = materialize_images(img_list, all_img_dir, new_img_dir, mode=mode, num_workers=num_workers)
+    if summary['missing']:
+        raise FileNotFoundError("%i images not found in %s, e.g. %s"
+                                % (len(summary['missing']), all_img_dir, summary['missing'][0]))
+    return summary
 
-def read_json(coco_annotation, verbose=False):
+def read_json(coco_annotation, verbose=False, prefer_cache=True):
+    """
+    Read a COCO JSON file.
+    :param prefer_cache: If the file has an up to date binary cache (see write_cache), read that instead.
+    """
+    if prefer_cache and cache_is_fresh(coco_annotation):
+        if verbose:
+            print("Reading annotaitons from binary cache of", coco_annotation)
+        return load_cache(coco_annotation).to_dict()
     if verbose:
         print("Reading annotaitons from", coco_annotation)
     with open(coco_annotation) as f:
@@ -229,37 +441,52 @@ def read_json(coco_annotation, verbose=False):
         raise IOError("The annotation file is empty.")
     return anns
 
-def write_json(data, filepath):
-    """Write JSON file"""
+def iter_json(coco_annotation, key):
+    """
+    Iterate over the records of one top-level array of a COCO JSON file (key='images' or 'annotations')
+    without loading the whole file.
+    """
+    return iter_json_array(coco_annotation, key)
+
+def write_json(data, filepath, cache=False):
+    """
+    Write JSON file. COCO dicts are streamed record by record (see coco_stream.CocoWriter).
+    :param cache: Also write a binary cache of the file, which read_json and CocoIndex.from_file open much faster.
+    """
     dir_ = os.path.split(filepath)[0]
     assert os.path.isdir(dir_), "Directory %s does not exist" % dir_
 
-    with open(filepath, 'w') as outfile:
-        json.dump(data, outfile)
+    if isinstance(data, dict) and 'images' in data and 'annotations' in data:
+        header = {key: value for key, value in data.items() if key not in ('images', 'annotations')}
+        with CocoWriter(filepath, header) as writer:
+            for img in data['images']:
+                writer.add_image(img)
+            for ann in data['annotations']:
+                writer.add_annotation(ann)
+    else:
+        with open(filepath, 'w') as outfile:
+            json.dump(data, outfile)
+    if cache:
+        write_cache(data, filepath)
 
 def get_filename2imgid(annfile, verbose=False):
-    anns = read_json(annfile, verbose=verbose)
-    filename2imgid = {}
-    for img in anns['images']:
-        filename2imgid[img['file_name']] = img['id']
-    return filename2imgid
+    index = load_index(annfile, verbose=verbose)
+    return dict(zip(index.file_names, index.image_ids.tolist()))
 
 def get_imgid2anns(annfile, verbose=False):
-    anns = read_json(annfile, verbose=verbose)
+    index = load_index(annfile, verbose=verbose)
     imgid2anns = {}
-    for ann in anns['annotations']:
-        imgid = ann['image_id']
-        if imgid not in imgid2anns:
-            imgid2anns[imgid] = []
-        imgid2anns[imgid].append(ann)
+    for row, imgid in enumerate(index.image_ids.tolist()):
+        ann_rows = index.ann_rows_at(row)
+        if len(ann_rows):
+            imgid2anns[imgid] = [index.annotation_at(ann_row) for ann_row in ann_rows.tolist()]
     return imgid2anns
 
 def get_imgid2img(annfile, verbose=False):
-    anns = read_json(annfile, verbose=verbose)
-    imgid2img = {}
-    for img in anns['images']:
-        imgid2img[img['id']] = img
-    return imgid2img
-
-
+    index = load_index(annfile, verbose=verbose)
+    return {img['id']: img for img in index.images()}
 
+def _check_annotations(annotations):
+    """Check that annotations is an existing file, unless it is already a CocoIndex"""
+    if not isinstance(annotations, CocoIndex):
+        assert os.path.isfile(annotations), "File %s does not exist" % annotations
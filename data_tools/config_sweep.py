@@ -0,0 +1,697 @@
+"""
+Sweep the redaction app over generated DeepStream configs to find how many streams a GPU can take.
+
+The test_source*.txt configs keep several settings consistent by hand: the number of streams of the [source*]
+sections, batch-size of [streammux] and [primary-gie], the rows and columns of [tiled-display], the engine
+file (built for one batch size and precision) and the model config of the precision. This module reads such a
+config with DsConfig and writes variants of it with all of these changed together:
+
+    variants, skipped = make_variants(sources=(1, 2, 4, 8, 16), batch_sizes=None, precisions=('fp16', 'int8'),
+                                      intervals=(0, 2))
+    rows = run_sweep('configs/test_source4_fp16.txt', variants, AppRunner('deepstream-redaction-app -c {config}'),
+                     'sweep', engine='/models/retinanet_{precision}_b{batch_size}.plan', fake_sink=True)
+    print_table(rows)
+    max_streams(rows, min_fps=30)  # 30 FPS sources; streams measuring 28.5 FPS or more keep up
+
+Each variant is run by a runner, a callable runner(config_path, log_path) that runs the app (or anything that
+writes its performance output) and writes the log. AppRunner runs the app for a fixed time; SimulatedRunner
+writes a log from a simple cost model without a GPU, to try out a sweep. Logs are summarized with latency_log,
+and the results of all variants are collected into one table of FPS, latency and batch fill.
+
+check_config reports the inconsistencies that the hand-written configs can have, e.g.
+    python -m data_tools.config_sweep --check configs/test_source*.txt
+"""
+
+import os
+import re
+import csv
+import json
+import time
+import shlex
+import signal
+import itertools
+import subprocess
+import numpy as np
+from data_tools.latency_log import parse_log
+
+SECTION_LINE = re.compile(r'^\s*\[([^\]]+)\]\s*$')
+KEY_LINE = re.compile(r'^\s*([^#;=\s][^=]*?)\s*=\s*(.*?)\s*$')
+SOURCE_SECTION = re.compile(r'^source\d+$')
+SINK_SECTION = re.compile(r'^sink\d+$')
+NETWORK_MODES = {'fp32': 0, 'int8': 1, 'fp16': 2}
+URI_SOURCE_TYPES = (2, 3, 4)
+MULTI_URI = 3
+FAKE_SINK = 1
+# Values DeepStream reads relative to the directory of the config file
+PATH_KEYS = ('model-engine-file', 'int8-calib-file', 'labelfile-path', 'll-config-file', 'custom-lib-path',
+             'onnx-file', 'model-file', 'proto-file', 'uff-file', 'mean-file')
+TABLE_COLUMNS = ('name', 'sources', 'batch_size', 'precision', 'interval', 'tiler', 'status', 'fps_total',
+                 'fps_min', 'latency_mean', 'latency_p50', 'latency_p95', 'latency_p99', 'batch_fill')
+
+
+class DsConfig(object):
+    """
+    A DeepStream key file (deepstream-app or nvinfer config), kept line by line so that comments and the
+    order of sections and keys survive a rewrite.
+    """
+
+    def __init__(self, lines, path=None):
+        self.path = path
+        self.preamble = []
+        self.sections = []
+        for line in lines:
+            line = line.rstrip('\n')
+            match = SECTION_LINE.match(line)
+            if match is not None:
+                self.sections.append([match.group(1), []])
+            elif self.sections:
+                self.sections[-1][1].append(line)
+            else:
+                self.preamble.append(line)
+
+    @classmethod
+    def read(cls, path):
+        assert os.path.isfile(path), "File %s does not exist" % path
+        with open(path) as f:
+            return cls(f.readlines(), path=os.path.abspath(path))
+
+    def section_names(self, pattern=None):
+        return [name for name, _ in self.sections if pattern is None or pattern.match(name)]
+
+    def has_section(self, section):
+        return self._find(section) is not None
+
+    def get(self, section, key, default=None):
+        lines = self._lines(section)
+        if lines is None:
+            return default
+        for line in lines:
+            match = KEY_LINE.match(line)
+            if match is not None and match.group(1) == key:
+                return match.group(2)
+        return default
+
+    def get_int(self, section, key, default=None):
+        value = self.get(section, key)
+        return default if value is None else int(value)
+
+    def items(self, section):
+        """The (key, value) pairs of a section, in file order"""
+        return [(match.group(1), match.group(2)) for match in map(KEY_LINE.match, self._lines(section) or [])
+                if match is not None]
+
+    def set(self, section, key, value):
+        """Set a key, in place if it is already set, else after the last key of the section"""
+        lines = self._lines(section)
+        if lines is None:
+            self.sections.append([section, []])
+            lines = self.sections[-1][1]
+        last_key = -1
+        for ii, line in enumerate(lines):
+            match = KEY_LINE.match(line)
+            if match is None:
+                continue
+            if match.group(1) == key:
+                lines[ii] = "%s=%s" % (key, value)
+                return
+            last_key = ii
+        lines.insert(last_key + 1, "%s=%s" % (key, value))
+
+    def remove_section(self, section):
+        index = self._find(section)
+        if index is not None:
+            del self.sections[index]
+        return index
+
+    def insert_section(self, index, section, lines):
+        self.sections.insert(index, [section, list(lines)])
+
+    def copy_section(self, section):
+        return list(self._lines(section))
+
+    def enabled(self, section):
+        return self.has_section(section) and self.get_int(section, 'enable', 1) != 0
+
+    def resolve(self, value):
+        """Absolute path of a path value, which DeepStream reads relative to the config file"""
+        if self.path is None or os.path.isabs(value) or '://' in value:
+            return value
+        return os.path.normpath(os.path.join(os.path.dirname(self.path), value))
+
+    def absolute_paths(self):
+        """Make the path values absolute, so that the config can be written to another directory"""
+        for section in self.section_names():
+            for key, value in self.items(section):
+                if key in PATH_KEYS and value:
+                    self.set(section, key, self.resolve(value))
+
+    def text(self):
+        lines = list(self.preamble)
+        for name, section_lines in self.sections:
+            lines.append("[%s]" % name)
+            lines.extend(section_lines)
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            f.write(self.text())
+        self.path = os.path.abspath(path)
+
+    def _find(self, section):
+        for ii, (name, _) in enumerate(self.sections):
+            if name == section:
+                return ii
+        return None
+
+    def _lines(self, section):
+        index = self._find(section)
+        return None if index is None else self.sections[index][1]
+
+
+def num_streams(config):
+    """Number of streams of the enabled source sections: num-sources for MultiURI, else one per section"""
+    streams = 0
+    for section in config.section_names(SOURCE_SECTION):
+        if config.enabled(section):
+            if config.get_int(section, 'type') == MULTI_URI:
+                streams += config.get_int(section, 'num-sources', 1)
+            else:
+                streams += 1
+    return streams
+
+
+def check_config(config, model_config=None, max_batch_size=None, check_files=False):
+    """
+    Check that the settings of a deepstream-app config agree with each other.
+    :param config: DsConfig or file name of the pipeline config
+    :param model_config: DsConfig or file name of the nvinfer config. Defaults to config-file of [primary-gie].
+    :param max_batch_size: Largest batch the engine was built for
+    :param check_files: Also check that the engine, model config and library files exist
+    :return: list of problems, empty if the config is consistent
+    """
+    if not isinstance(config, DsConfig):
+        config = DsConfig.read(config)
+    problems = []
+    streams = num_streams(config)
+    mux_batch = config.get_int('streammux', 'batch-size', 1)
+    gie_batch = config.get_int('primary-gie', 'batch-size', mux_batch)
+    if streams == 0:
+        problems.append("no enabled source")
+    if mux_batch != gie_batch:
+        problems.append("batch-size is %i in [streammux] but %i in [primary-gie]" % (mux_batch, gie_batch))
+    if mux_batch > streams > 0:
+        problems.append("batch-size %i is larger than the %i streams, so batches never fill and wait for "
+                        "batched-push-timeout" % (mux_batch, streams))
+    if max_batch_size is not None and gie_batch > max_batch_size:
+        problems.append("batch-size %i is larger than the engine batch size %i" % (gie_batch, max_batch_size))
+    engine = config.get('primary-gie', 'model-engine-file')
+    engine_batch = re.search(r'batchsize-(\d+)', engine or '')
+    if engine_batch is not None and int(engine_batch.group(1)) < gie_batch:
+        problems.append("engine %s is named for batch size %s, smaller than batch-size %i" % (
+            engine, engine_batch.group(1), gie_batch))
+    if config.enabled('tiled-display'):
+        rows = config.get_int('tiled-display', 'rows', 1)
+        columns = config.get_int('tiled-display', 'columns', 1)
+        if rows * columns < streams:
+            problems.append("tiler of %ix%i shows only %i of the %i streams" % (rows, columns, rows * columns,
+                                                                                 streams))
+    interval = config.get_int('primary-gie', 'interval', 0)
+    if interval < 0:
+        problems.append("interval %i is negative" % interval)
+
+    if model_config is None and config.get('primary-gie', 'config-file'):
+        model_config = config.resolve(config.get('primary-gie', 'config-file'))
+    if isinstance(model_config, str):
+        if not os.path.isfile(model_config):
+            problems.append("model config %s does not exist" % model_config)
+            model_config = None
+        else:
+            model_config = DsConfig.read(model_config)
+    if model_config is not None:
+        mode = model_config.get_int('property', 'network-mode', 0)
+        precision = [name for name, value in NETWORK_MODES.items() if value == mode]
+        for name in NETWORK_MODES:
+            if engine and name in os.path.basename(engine) and name not in precision:
+                problems.append("engine %s is named for %s but network-mode=%i is %s" % (
+                    engine, name, mode, precision[0] if precision else 'unknown'))
+        model_interval = model_config.get_int('property', 'interval')
+        if model_interval is not None and model_interval != interval:
+            problems.append("interval is %i in [primary-gie] but %i in the model config, which it overrides" % (
+                interval, model_interval))
+    if check_files:
+        for section, key, source in (('primary-gie', 'model-engine-file', config),
+                                     ('property', 'custom-lib-path', model_config)):
+            value = source.get(section, key) if source is not None else None
+            if value and not os.path.exists(source.resolve(value)):
+                problems.append("%s %s does not exist" % (key, source.resolve(value)))
+    return problems
+
+
+def make_variants(sources, batch_sizes=None, precisions=('fp16',), intervals=(0,), tilers=None,
+                  max_batch_size=None):
+    """
+    All combinations of the given settings, without the ones that can't work.
+    :param sources: Numbers of streams
+    :param batch_sizes: Batch sizes of [streammux] and [primary-gie]. None for batch size = number of streams.
+    :param precisions: 'fp16' and/or 'int8'
+    :param intervals: interval values of [primary-gie], the number of batches skipped between inferences
+    :param tilers: (rows, columns) of [tiled-display]. None for the smallest near-square grid of the streams.
+    :param max_batch_size: Largest batch size the engines support
+    :return: (list of variant dicts, list of (variant, reason) that were left out)
+    """
+    variants = []
+    skipped = []
+    for num, batch, precision, interval, tiler in itertools.product(
+            sources, batch_sizes or [None], precisions, intervals, tilers or [None]):
+        variant = {'sources': num, 'batch_size': num if batch is None else batch, 'precision': precision,
+                   'interval': interval, 'tiler': tuple(tiler) if tiler is not None else auto_tiler(num)}
+        reason = _variant_problem(variant, max_batch_size)
+        if reason is None:
+            variant['name'] = variant_name(variant)
+            variants.append(variant)
+        else:
+            skipped.append((variant, reason))
+    return variants, skipped
+
+
+def auto_tiler(streams):
+    """(rows, columns) of the smallest grid with at least streams tiles, at most one column wider than tall"""
+    columns = int(np.ceil(np.sqrt(streams)))
+    return int(np.ceil(streams / float(columns))), columns
+
+
+def variant_name(variant):
+    return "s%i_b%i_%s_i%i_t%ix%i" % ((variant['sources'], variant['batch_size'], variant['precision'],
+                                       variant['interval']) + tuple(variant['tiler']))
+
+
+def build_variant(base_config, variant, output_dir, model_configs=None, engine=None, uri=None, fake_sink=False,
+                  overrides=None):
+    """
+    Write the pipeline config and the model config of one variant.
+    :param base_config: DsConfig or file name of the pipeline config to start from, e.g. test_source4_fp16.txt
+    :param variant: dict from make_variants
+    :param output_dir: Directory to write pipeline.txt and the model config into
+    :param model_configs: dict of precision: model config file. Defaults to the config-file of the base config
+        with its precision replaced, e.g. odtk_model_config_int8.txt for 'int8'.
+    :param engine: Engine file name, formatted with precision and batch_size, e.g.
+        '/models/retinanet_{precision}_b{batch_size}.plan'. Defaults to the engine of the base config with the
+        precision and 'batchsize-<n>' in its name replaced.
+    :param uri: Stream every source from this URI, as one MultiURI source. By default the URI sources of the
+        base config are repeated, one stream each, until there are enough.
+    :param fake_sink: Replace the sinks by one FakeSink without sync, so that display and encoding don't limit
+        the frame rate
+    :param overrides: dict of section: {key: value} to set last, e.g. {'tests': {'file-loop': 1}}
+    :return: File name of the pipeline config
+    """
+    if not isinstance(base_config, DsConfig):
+        base_config = DsConfig.read(base_config)
+    assert os.path.isdir(output_dir), "Directory %s does not exist" % output_dir
+    config = DsConfig(base_config.text().splitlines(), path=base_config.path)
+    config.absolute_paths()
+    precision = variant['precision']
+    batch = variant['batch_size']
+
+    _set_sources(config, variant['sources'], uri)
+    config.set('streammux', 'batch-size', batch)
+    config.set('primary-gie', 'batch-size', batch)
+    config.set('primary-gie', 'interval', variant['interval'])
+    if engine is not None:
+        config.set('primary-gie', 'model-engine-file', os.path.abspath(engine.format(precision=precision,
+                                                                                     batch_size=batch)))
+    elif config.get('primary-gie', 'model-engine-file'):
+        config.set('primary-gie', 'model-engine-file',
+                   _rename_engine(config.get('primary-gie', 'model-engine-file'), precision, batch))
+    if config.has_section('tiled-display'):
+        rows, columns = variant['tiler']
+        config.set('tiled-display', 'rows', rows)
+        config.set('tiled-display', 'columns', columns)
+    config.set('application', 'enable-perf-measurement', 1)
+    if fake_sink:
+        _set_fake_sink(config)
+
+    model_file = (model_configs or {}).get(precision)
+    if model_file is None:
+        base_model = base_config.get('primary-gie', 'config-file')
+        assert base_model, "No config-file in [primary-gie] of %s, pass model_configs" % base_config.path
+        model_file = _rename_precision(base_config.resolve(base_model), precision)
+    model_config = DsConfig.read(model_file)
+    model_config.absolute_paths()
+    model_config.set('property', 'network-mode', NETWORK_MODES[precision])
+    model_config.set('property', 'batch-size', batch)
+    model_config.set('property', 'interval', variant['interval'])
+    if model_config.get('property', 'model-engine-file'):
+        model_config.set('property', 'model-engine-file', config.get('primary-gie', 'model-engine-file'))
+    model_name = os.path.basename(model_file)
+    model_config.write(os.path.join(output_dir, model_name))
+    config.set('primary-gie', 'config-file', model_name)
+
+    for section, values in (overrides or {}).items():
+        for key, value in values.items():
+            config.set(section, key, value)
+    config_path = os.path.join(output_dir, 'pipeline.txt')
+    config.write(config_path)
+    problems = check_config(config, model_config)
+    assert not problems, "Config %s is inconsistent: %s" % (config_path, '; '.join(problems))
+    return config_path
+
+
+def run_sweep(base_config, variants, runner, output_dir, skip_existing=True, **build_kwargs):
+    """
+    Build every variant, run it and summarize its log.
+    :param base_config: Pipeline config to start from
+    :param variants: list of variant dicts from make_variants
+    :param runner: Callable runner(config_path, log_path) that runs the app on the config and writes its
+        output to log_path, e.g. AppRunner or SimulatedRunner
+    :param output_dir: Directory for one subdirectory per variant (configs, app.log and summary.json) and
+        sweep.csv, the table of all variants. The log of a failed run is kept as app.log.failed.
+    :param skip_existing: Don't run variants again whose log already exists, only summarize them
+    :param build_kwargs: Passed on to build_variant: model_configs, engine, uri, fake_sink, overrides
+    :return: list of table rows, one dict per variant
+    """
+    if not isinstance(base_config, DsConfig):
+        base_config = DsConfig.read(base_config)
+    os.makedirs(output_dir, exist_ok=True)
+    rows = []
+    for ii, variant in enumerate(variants):
+        variant_dir = os.path.join(output_dir, variant['name'])
+        os.makedirs(variant_dir, exist_ok=True)
+        config_path = build_variant(base_config, variant, variant_dir, **build_kwargs)
+        with open(os.path.join(variant_dir, 'variant.json'), 'w') as f:
+            json.dump(variant, f, indent=1)
+        log_path = os.path.join(variant_dir, 'app.log')
+        status = 'ok'
+        if not (skip_existing and os.path.isfile(log_path)):
+            print("Running %s (%i/%i)" % (variant['name'], ii + 1, len(variants)))
+            try:
+                runner(config_path, log_path + '.running')
+                os.replace(log_path + '.running', log_path)
+            except Exception as e:
+                status = 'failed: %s' % e
+                print(" ", status)
+                if os.path.isfile(log_path + '.running'):
+                    os.replace(log_path + '.running', log_path + '.failed')
+        if status == 'ok':
+            interval = DsConfig.read(config_path).get('application', 'perf-measurement-interval-sec')
+            parser = parse_log(log_path, interval=float(interval) if interval else None,
+                               batch_size=variant['batch_size'])
+            parser.write_report(os.path.join(variant_dir, 'summary.json'))
+            row = summary_row(variant, parser.summary())
+        else:
+            row = summary_row(variant, None, status)
+        rows.append(row)
+    write_table(rows, os.path.join(output_dir, 'sweep.csv'))
+    return rows
+
+
+def summary_row(variant, summary, status='ok'):
+    """One row of the sweep table from a variant and the summary of latency_log"""
+    row = {'name': variant['name'], 'sources': variant['sources'], 'batch_size': variant['batch_size'],
+           'precision': variant['precision'], 'interval': variant['interval'],
+           'tiler': "%ix%i" % tuple(variant['tiler']), 'status': status}
+    if summary is None:
+        return row
+    fps = [stats['mean'] for stats in summary['fps'].values()]
+    if not fps:
+        row['status'] = 'no FPS output'
+    else:
+        row['fps_total'] = sum(fps)
+        row['fps_min'] = min(fps)
+    latency = summary['latency']['all']
+    if latency['frames']:
+        row.update({'latency_mean': latency['mean'], 'latency_p50': latency['p50'],
+                    'latency_p95': latency['p95'], 'latency_p99': latency['p99']})
+    row['batch_fill'] = summary['batches']['fill'] if summary['batches']['count'] else None
+    return row
+
+
+def write_table(rows, output_file):
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=TABLE_COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: _format(row.get(key)) for key in TABLE_COLUMNS})
+    print("Wrote table of %i variants to %s" % (len(rows), output_file))
+
+
+def print_table(rows):
+    print("%-24s %7s %5s %5s %8s %6s %9s %8s %9s %9s %9s %6s  %s" % (
+        'variant', 'sources', 'batch', 'prec', 'interval', 'tiler', 'fps total', 'fps min', 'mean ms', 'p95 ms',
+        'p99 ms', 'fill', 'status'))
+    for row in rows:
+        print("%-24s %7i %5i %5s %8i %6s %9s %8s %9s %9s %9s %6s  %s" % (
+            row['name'], row['sources'], row['batch_size'], row['precision'], row['interval'], row['tiler'],
+            _format(row.get('fps_total'), '%.1f'), _format(row.get('fps_min'), '%.1f'),
+            _format(row.get('latency_mean'), '%.1f'), _format(row.get('latency_p95'), '%.1f'),
+            _format(row.get('latency_p99'), '%.1f'), _format(row.get('batch_fill'), '%.2f'), row['status']))
+
+
+def max_streams(rows, min_fps, max_latency=None, tolerance=0.05):
+    """
+    The most streams that run at min_fps on every stream, for each precision and interval.
+    :param rows: Table rows from run_sweep
+    :param min_fps: Frame rate every stream must reach, e.g. the frame rate of the sources
+    :param tolerance: Fraction of min_fps a stream may fall short by and still count. Measured FPS jitters just
+        below the source rate even when the app keeps up.
+    :param max_latency: If set, the p95 latency in ms must also be below this
+    :return: dict of (precision, interval): best row, or None if no variant reached min_fps
+    """
+    threshold = min_fps * (1 - tolerance)
+    best = {}
+    for row in rows:
+        key = (row['precision'], row['interval'])
+        best.setdefault(key, None)
+        if row['status'] != 'ok' or row.get('fps_min') is None or row['fps_min'] < threshold:
+            continue
+        if max_latency is not None and not row.get('latency_p95', float('inf')) < max_latency:
+            continue
+        if best[key] is None or (row['sources'], row['fps_min']) > (best[key]['sources'], best[key]['fps_min']):
+            best[key] = row
+    for (precision, interval), row in sorted(best.items()):
+        if row is None:
+            print("%s, interval %i: no variant reaches %.1f FPS per stream" % (precision, interval, threshold))
+        else:
+            print("%s, interval %i: %i streams with %s (%.1f FPS per stream, p95 latency %s ms)" % (
+                precision, interval, row['sources'], row['name'], row['fps_min'],
+                _format(row.get('latency_p95'), '%.1f')))
+    return best
+
+
+class AppRunner(object):
+    """
+    Runs the app on a config for a fixed time, with latency measurement on, writing its output to the log.
+    :param command: Command line, formatted with config (the config file name), e.g.
+        './deepstream-redaction-app -c {config}'
+    :param duration: Seconds to let the app run before stopping it with SIGINT. None to wait for it to exit.
+    :param cwd: Working directory of the app. Defaults to the directory of the config.
+    :param env: Extra environment variables
+    """
+
+    def __init__(self, command, duration=60.0, cwd=None, env=None):
+        self.command = command
+        self.duration = duration
+        self.cwd = cwd
+        self.env = dict(os.environ, NVDS_ENABLE_LATENCY_MEASUREMENT='1', **(env or {}))
+
+    def __call__(self, config_path, log_path):
+        args = shlex.split(self.command.format(config=os.path.abspath(config_path)))
+        with open(log_path, 'w') as log:
+            proc = subprocess.Popen(args, stdout=log, stderr=subprocess.STDOUT, env=self.env,
+                                    cwd=self.cwd or os.path.dirname(os.path.abspath(config_path)))
+            try:
+                proc.wait(timeout=self.duration)
+            except subprocess.TimeoutExpired:
+                proc.send_signal(signal.SIGINT)
+                try:
+                    proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    proc.wait()
+                return
+        if proc.returncode != 0:
+            raise RuntimeError("%s exited with code %i" % (args[0], proc.returncode))
+
+
+class SimulatedRunner(object):
+    """
+    Stand-in for the app that writes its performance output from a simple cost model instead of running it.
+    It reads the streams, batch size, interval and precision from the config like the app would, so a sweep can
+    be tried out, and the config generation checked, without a GPU. The numbers are made up.
+
+    Each batch costs batch_ms plus frame_ms[precision] per frame when the detector runs on it (every
+    interval + 1 batches) and tracker_ms per frame otherwise. Streams get source_fps unless the batches take
+    longer than that allows, and latency grows as the load approaches capacity.
+    :param duration: Seconds of output to write
+    :param source_fps: Frame rate of the sources
+    :param perf_interval: Seconds between FPS reports, if the config doesn't set perf-measurement-interval-sec
+    :param seed: Random seed of the noise
+    """
+
+    def __init__(self, duration=30.0, source_fps=30.0, batch_ms=2.0, frame_ms=None, tracker_ms=0.4,
+                 perf_interval=5.0, seed=0):
+        self.duration = duration
+        self.source_fps = source_fps
+        self.batch_ms = batch_ms
+        self.frame_ms = frame_ms or {'fp32': 12.0, 'fp16': 5.0, 'int8': 3.0}
+        self.tracker_ms = tracker_ms
+        self.perf_interval = perf_interval
+        self.seed = seed
+
+    def __call__(self, config_path, log_path):
+        config = DsConfig.read(config_path)
+        streams = num_streams(config)
+        batch = config.get_int('streammux', 'batch-size', 1)
+        interval = config.get_int('primary-gie', 'interval', 0)
+        model_config = DsConfig.read(config.resolve(config.get('primary-gie', 'config-file')))
+        mode = model_config.get_int('property', 'network-mode', 0)
+        frame_ms = self.frame_ms[[name for name, value in NETWORK_MODES.items() if value == mode][0]]
+        perf_interval = float(config.get('application', 'perf-measurement-interval-sec', self.perf_interval))
+        rs = np.random.RandomState(self.seed)
+
+        infer_ms = self.batch_ms + frame_ms * batch
+        track_ms = self.batch_ms + self.tracker_ms * batch
+        ms_per_batch = (infer_ms + interval * track_ms) / (interval + 1)
+        capacity = 1000.0 * batch / ms_per_batch
+        fps = min(self.source_fps, capacity / streams)
+        load = min(streams * self.source_fps / capacity, 0.95)
+
+        num_batches = int(self.duration * fps * streams / batch)
+        lines = []
+        frame = np.zeros(streams, dtype=np.int64)
+        for bb in range(num_batches):
+            lines.append("************BATCH-NUM = %i**************" % bb)
+            batch_time = infer_ms if bb % (interval + 1) == 0 else track_ms
+            for ss in (np.arange(bb * batch, (bb + 1) * batch) % streams):
+                latency = (batch_time + ms_per_batch) / (1 - load) * rs.lognormal(0, 0.1)
+                lines.append("Source id = %i Frame_num = %i Frame latency = %f (ms)" % (ss, frame[ss], latency))
+                frame[ss] += 1
+        for rr in range(1, int(self.duration / perf_interval) + 1):
+            values = np.maximum(fps * rs.normal(1, 0.01, size=streams), 0)
+            lines.append("**PERF: " + "\t".join("%.2f (%.2f)" % (vv, fps) for vv in values))
+        with open(log_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def _variant_problem(variant, max_batch_size):
+    if variant['sources'] < 1 or variant['batch_size'] < 1:
+        return "sources and batch size must be positive"
+    if variant['batch_size'] > variant['sources']:
+        return "batch size larger than the number of streams"
+    if max_batch_size is not None and variant['batch_size'] > max_batch_size:
+        return "batch size larger than the engine batch size %i" % max_batch_size
+    if variant['precision'] not in NETWORK_MODES:
+        return "unknown precision %s" % variant['precision']
+    if variant['interval'] < 0:
+        return "negative interval"
+    rows, columns = variant['tiler']
+    if rows * columns < variant['sources']:
+        return "tiler of %ix%i too small for the streams" % (rows, columns)
+    return None
+
+
+def _set_sources(config, streams, uri):
+    """Replace the source sections by streams streams, from uri or from the URI sources of the config"""
+    sections = config.section_names(SOURCE_SECTION)
+    templates = [config.copy_section(name) for name in sections
+                 if config.enabled(name) and config.get_int(name, 'type') in URI_SOURCE_TYPES]
+    index = min(config.remove_section(name) for name in sections) if sections else len(config.sections)
+    if uri is not None or not templates:
+        assert uri is not None or templates, "No URI source in %s, pass uri" % config.path
+        lines = templates[0] if templates else ['enable=1']
+        config.insert_section(index, 'source0', lines)
+        config.set('source0', 'type', MULTI_URI)
+        config.set('source0', 'num-sources', streams)
+        if uri is not None:
+            config.set('source0', 'uri', uri)
+        return
+    for ss in range(streams):
+        name = 'source%i' % ss
+        config.insert_section(index + ss, name, templates[ss % len(templates)])
+        config.set(name, 'num-sources', 1)
+
+
+def _set_fake_sink(config):
+    sinks = [name for name in config.section_names(SINK_SECTION) if config.enabled(name)]
+    for ii, name in enumerate(sinks):
+        if ii == 0:
+            config.set(name, 'type', FAKE_SINK)
+            config.set(name, 'sync', 0)
+        else:
+            config.set(name, 'enable', 0)
+
+
+def _rename_precision(path, precision):
+    name = os.path.basename(path)
+    for other in NETWORK_MODES:
+        name = name.replace(other, precision)
+    return os.path.join(os.path.dirname(path), name)
+
+
+def _rename_engine(path, precision, batch_size):
+    path = _rename_precision(path, precision)
+    return os.path.join(os.path.dirname(path),
+                        re.sub(r'batchsize-\d+', 'batchsize-%i' % batch_size, os.path.basename(path)))
+
+
+def _format(value, fmt='%.3f'):
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return fmt % value
+    return value
+
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(description="Sweep the redaction app over generated DeepStream configs")
+    arg_parser.add_argument('config', nargs='?', help="Pipeline config to start from")
+    arg_parser.add_argument('output_dir', nargs='?', help="Directory for the variants and sweep.csv")
+    arg_parser.add_argument('--check', nargs='+', default=None, metavar='CONFIG',
+                            help="Only check that the given pipeline configs are consistent")
+    arg_parser.add_argument('--sources', type=int, nargs='+', default=[1, 2, 4, 8])
+    arg_parser.add_argument('--batch-sizes', type=int, nargs='+', default=None,
+                            help="Defaults to batch size = number of streams")
+    arg_parser.add_argument('--precisions', nargs='+', default=['fp16'], choices=['fp16', 'int8'])
+    arg_parser.add_argument('--intervals', type=int, nargs='+', default=[0])
+    arg_parser.add_argument('--tilers', nargs='+', default=None, help="rows x columns, e.g. 2x2")
+    arg_parser.add_argument('--max-batch-size', type=int, default=None)
+    arg_parser.add_argument('--engine', default=None, help="Engine file name with {precision} and {batch_size}")
+    arg_parser.add_argument('--uri', default=None, help="Stream every source from this URI")
+    arg_parser.add_argument('--fake-sink', action='store_true', help="Replace the sinks by a FakeSink")
+    arg_parser.add_argument('--file-loop', action='store_true', help="Loop file sources")
+    arg_parser.add_argument('--runner', default='app', choices=['app', 'simulate'])
+    arg_parser.add_argument('--command', default='deepstream-redaction-app -c {config}')
+    arg_parser.add_argument('--duration', type=float, default=60.0, help="Seconds to run each variant")
+    arg_parser.add_argument('--min-fps', type=float, default=None,
+                            help="Report the most streams reaching this frame rate")
+    arg_parser.add_argument('--fps-tolerance', type=float, default=0.05,
+                            help="Fraction of --min-fps a stream may fall short by")
+    arg_parser.add_argument('--max-latency', type=float, default=None, help="p95 latency limit in ms")
+    arg_parser.add_argument('--rerun', action='store_true', help="Run variants again that have a log")
+    args = arg_parser.parse_args()
+
+    if args.check:
+        for config_file in args.check:
+            config_problems = check_config(config_file)
+            print("%s: %s" % (config_file, '; '.join(config_problems) if config_problems else 'ok'))
+    else:
+        assert args.config and args.output_dir, "config and output_dir are required unless --check is given"
+        sweep_variants, sweep_skipped = make_variants(
+            args.sources, batch_sizes=args.batch_sizes, precisions=args.precisions, intervals=args.intervals,
+            tilers=[tuple(int(vv) for vv in tt.split('x')) for tt in args.tilers] if args.tilers else None,
+            max_batch_size=args.max_batch_size)
+        for skipped_variant, skip_reason in sweep_skipped:
+            print("Skipping %i streams with batch size %i: %s" % (skipped_variant['sources'],
+                                                                 skipped_variant['batch_size'], skip_reason))
+        if args.runner == 'app':
+            sweep_runner = AppRunner(args.command, duration=args.duration)
+        else:
+            sweep_runner = SimulatedRunner(duration=args.duration)
+        start = time.time()
+        table = run_sweep(args.config, sweep_variants, sweep_runner, args.output_dir, skip_existing=not args.rerun,
+                          engine=args.engine, uri=args.uri, fake_sink=args.fake_sink,
+                          overrides={'tests': {'file-loop': 1}} if args.file_loop else None)
+        print("Ran %i variants in %.0f s" % (len(table), time.time() - start))
+        print_table(table)
+        if args.min_fps is not None:
+            max_streams(table, args.min_fps, max_latency=args.max_latency, tolerance=args.fps_tolerance)
@@ -0,0 +1,255 @@
+"""
+Find and drop near-duplicate images from a COCO dataset.
+
+Each image gets a 64 bit difference hash (dHash): the image is decoded at reduced resolution, shrunk to 9x8
+grey pixels, and each bit says whether a pixel is brighter than its right neighbour. Re-encoded, resized or
+slightly edited copies of an image get hashes a few bits apart. Hashes are computed on a process pool and kept
+in a HashIndex file keyed by path, size and mtime, so only new or changed images are hashed on later runs.
+
+Near-duplicates (hashes within max_distance bits) are found with a multi-index search rather than comparing
+all pairs: the hash is cut into max_distance + 1 bands, and two hashes within max_distance bits must agree
+exactly on at least one band. Only images sharing a band value are compared, and large groups of them (e.g.
+many near-black frames) are compared a chunk at a time, so memory stays bounded.
+
+Images that can't be read get no hash: they are never duplicates, are kept, and are not stored in the index.
+"""
+
+import os
+import numpy as np
+from PIL import Image
+from data_tools.coco_index import load_index
+from data_tools.coco_stream import write_index
+from data_tools.kitti_eval import group_pairs
+from data_tools.materialize import build_image_dir_index
+from data_tools.parallel import bounded_imap, Throughput
+
+HASH_SIZE = 8
+INDEX_VERSION = 2  # Indexes of version 1 stored hash 0 for damaged images
+_POPCOUNT = np.array([bin(ii).count('1') for ii in range(256)], dtype=np.uint8)
+
+
+class HashIndex(object):
+    """
+    On-disk index of image hashes: path, mtime_ns, file size and hash arrays in a .npz file.
+    A hash is only used if the file's mtime and size still match.
+    """
+
+    def __init__(self, index_file=None):
+        self.index_file = index_file
+        self.entries = {}
+        self.modified = False
+        if index_file is not None and os.path.isfile(index_file):
+            with np.load(index_file) as data:
+                if 'version' not in data.files or int(data['version']) != INDEX_VERSION:
+                    print("Ignoring hash index %s of an older version" % index_file)
+                    return
+                for path, mtime, size, value in zip(data['paths'].tolist(), data['mtime_ns'].tolist(),
+                                                    data['size'].tolist(), data['hash'].tolist()):
+                    self.entries[path] = (mtime, size, value)
+
+    def get(self, path, st):
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2]
+        return None
+
+    def set(self, path, st, value):
+        self.entries[path] = (st.st_mtime_ns, st.st_size, value)
+        self.modified = True
+
+    def save(self):
+        """Write the index, if anything changed. The file is replaced atomically."""
+        if self.index_file is None or not self.modified:
+            return
+        paths = list(self.entries)
+        values = [self.entries[path] for path in paths]
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, version=INDEX_VERSION, paths=np.array(paths, dtype=str),
+                     mtime_ns=np.array([vv[0] for vv in values], dtype=np.int64),
+                     size=np.array([vv[1] for vv in values], dtype=np.int64),
+                     hash=np.array([vv[2] for vv in values], dtype=np.uint64))
+        os.replace(tmp_file, self.index_file)
+        self.modified = False
+
+
+def dhash(filepath):
+    """64 bit difference hash of an image, as an int. JPEGs are decoded directly at reduced resolution."""
+    image = Image.open(filepath)
+    image.draft('L', (4 * HASH_SIZE, 4 * HASH_SIZE))
+    pixels = np.asarray(image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int(np.packbits(bits.ravel()).view('>u8')[0])
+
+
+def compute_hashes(filenames, img_dirs, index_file=None, num_workers=8, chunk_size=256):
+    """
+    dHash of many images.
+    :param filenames: Image filenames
+    :param img_dirs: Directory or list of directories containing the images
+    :param index_file: Optional HashIndex file, used and updated so that only new or changed images are hashed
+    :param num_workers: Number of worker processes
+    :param chunk_size: Number of images hashed per task
+    :return: (uint64 array of hashes, boolean array marking the images that could be hashed), in the order of
+        filenames
+    """
+    filename2dir = build_image_dir_index(img_dirs, filenames)
+    missing = [fn for fn in filenames if fn not in filename2dir]
+    if missing:
+        raise FileNotFoundError("Image %s not found in any of img_dirs (%i images missing)"
+                                % (missing[0], len(missing)))
+
+    cache = HashIndex(index_file)
+    hashes = np.zeros(len(filenames), dtype=np.uint64)
+    valid = np.ones(len(filenames), dtype=bool)
+    todo = []
+    for ii, filename in enumerate(filenames):
+        filepath = os.path.join(filename2dir[filename], filename)
+        st = os.stat(filepath)
+        value = cache.get(filepath, st)
+        if value is None:
+            todo.append((ii, filepath, st))
+        else:
+            hashes[ii] = value
+    chunks = [[(ii, filepath) for ii, filepath, _ in todo[jj:jj + chunk_size]]
+              for jj in range(0, len(todo), chunk_size)]
+    progress = Throughput(len(todo))
+    for results in bounded_imap(_hash_chunk, chunks, num_workers=num_workers, use_processes=True):
+        for ii, value in results:
+            if value is None:
+                valid[ii] = False
+            else:
+                hashes[ii] = value
+        progress.update(items=len(results))
+    for ii, filepath, st in todo:
+        if valid[ii]:
+            cache.set(filepath, st, int(hashes[ii]))
+    cache.save()
+    print(" Hashed %i images (%i from index, %i damaged). %s" % (len(filenames), len(filenames) - len(todo),
+                                                                int((~valid).sum()), progress.summary()))
+    return hashes, valid
+
+
+def find_near_duplicates(hashes, max_distance=4, valid=None, max_bucket=1024):
+    """
+    All pairs of hashes at most max_distance bits apart.
+    :param hashes: uint64 array
+    :param max_distance: Maximum Hamming distance
+    :param valid: Optional boolean array; hashes where it is False are left out
+    :param max_bucket: Groups of up to this many hashes sharing a band value are paired in batches of about
+        max_bucket ** 2 pairs; larger groups are compared in max_bucket by max_bucket blocks
+    :return: (i, j, distance) arrays with i < j
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    positions = np.arange(len(hashes)) if valid is None else np.flatnonzero(valid)
+    values = hashes[positions]
+    num_bands = max_distance + 1
+    edges = np.linspace(0, 64, num_bands + 1).astype(np.int64)
+    pairs = [np.zeros((0, 2), dtype=np.int64)]
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        band = (values >> np.uint64(lo)) & np.uint64((1 << int(hi - lo)) - 1)
+        order = np.argsort(band, kind='stable')
+        sorted_band = band[order]
+        starts = np.flatnonzero(np.r_[True, sorted_band[1:] != sorted_band[:-1]])
+        sizes = np.diff(np.r_[starts, len(band)])
+        paired = np.repeat((sizes > 1) & (sizes <= max_bucket), sizes)
+
+        # Pair the buckets of up to max_bucket hashes in batches of consecutive buckets holding about
+        # max_bucket ** 2 pairs, so memory stays bounded however many buckets there are
+        small = np.flatnonzero((sizes > 1) & (sizes <= max_bucket))
+        batch = np.cumsum(sizes[small] ** 2) // (max_bucket * max_bucket)
+        bounds = np.searchsorted(batch, np.unique(batch), side='right')
+        for first, last in zip(np.r_[0, bounds[:-1]].tolist(), (bounds - 1).tolist()):
+            lo, hi = starts[small[first]], starts[small[last]] + sizes[small[last]]
+            members = order[lo:hi][paired[lo:hi]]
+            ii, jj = group_pairs(band[members], band[members])
+            ii, jj = members[ii], members[jj]
+            keep = (ii < jj) & (_popcount(values[ii] ^ values[jj]) <= max_distance)
+            pairs.append(np.stack([ii[keep], jj[keep]], axis=1))
+
+        large = sizes > max_bucket
+        for start, size in zip(starts[large].tolist(), sizes[large].tolist()):
+            members = np.sort(order[start:start + size])
+            for cc in range(0, len(members), max_bucket):
+                chunk = members[cc:cc + max_bucket]
+                for dd in range(cc, len(members), max_bucket):
+                    other = members[dd:dd + max_bucket]
+                    close = _popcount(values[chunk][:, None] ^ values[other][None, :]) <= max_distance
+                    ii, jj = np.nonzero(close & (chunk[:, None] < other[None, :]))
+                    pairs.append(np.stack([chunk[ii], other[jj]], axis=1))
+    # A pair can share several bands
+    pairs = np.unique(np.concatenate(pairs), axis=0)
+    distance = _popcount(values[pairs[:, 0]] ^ values[pairs[:, 1]])
+    return positions[pairs[:, 0]], positions[pairs[:, 1]], distance
+
+
+def duplicate_groups(num_items, pairs_i, pairs_j):
+    """Connected components of the duplicate pairs. Returns the group number of each item (its smallest member)."""
+    parent = np.arange(num_items)
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for ii, jj in zip(pairs_i.tolist(), pairs_j.tolist()):
+        ri, rj = find(ii), find(jj)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+    return np.array([find(x) for x in range(num_items)], dtype=np.int64)
+
+
+def dedup_dataset(annotations, img_dirs, output_annotations, max_distance=4, index_file=None, num_workers=8,
+                  renumber_from=1):
+    """
+    Drop near-duplicate images, with their annotations, from a COCO dataset.
+    Of each group of near-duplicates, the image with the most pixels is kept (the first in the file on ties).
+    Images that can't be read are kept.
+    :param annotations: COCO annotation file (e.g. from openimages2coco), or a CocoIndex
+    :param img_dirs: Directory or list of directories containing the images
+    :param output_annotations: File that will contain the deduplicated annotations
+    :param max_distance: Images whose hashes are at most this many bits apart are duplicates
+    :param index_file: Optional HashIndex file, see compute_hashes
+    :param num_workers: Number of worker processes
+    :param renumber_from: Image and annotation ids of the output are renumbered from this value. None keeps ids.
+    :return: List of (dropped file name, kept file name)
+    """
+    index = load_index(annotations, verbose=True)
+    file_names = list(index.file_names)
+    hashes, valid = compute_hashes(file_names, img_dirs, index_file=index_file, num_workers=num_workers)
+    pairs_i, pairs_j, _ = find_near_duplicates(hashes, max_distance=max_distance, valid=valid)
+    groups = duplicate_groups(index.num_images, pairs_i, pairs_j)
+
+    # Keep the largest image of each group: sort by group, then by decreasing pixel count, then by row
+    pixels = (np.asarray(index.image_columns['width'], dtype=np.int64)
+              * np.asarray(index.image_columns['height'], dtype=np.int64))
+    order = np.lexsort((np.arange(index.num_images), -pixels, groups))
+    first = np.r_[True, groups[order][1:] != groups[order][:-1]]
+    kept_of_group = np.zeros(index.num_images, dtype=np.int64)
+    kept_of_group[groups[order][first]] = order[first]
+    keep = np.zeros(index.num_images, dtype=bool)
+    keep[order[first]] = True
+    dropped = np.flatnonzero(~keep)
+    print("Dropping %i near-duplicate images of %i (%i groups)" % (len(dropped), index.num_images,
+                                                                  int((np.bincount(groups) > 1).sum())))
+    write_index(index.subset(np.flatnonzero(keep), renumber_from=renumber_from), output_annotations)
+    return [(file_names[row], file_names[kept_of_group[groups[row]]]) for row in dropped.tolist()]
+
+
+def _hash_chunk(chunk):
+    """Hash a list of (position, filepath). Runs on a worker process. Damaged images get hash None."""
+    results = []
+    for ii, filepath in chunk:
+        try:
+            results.append((ii, dhash(filepath)))
+        except (OSError, SyntaxError):
+            print("Image damaged:", filepath)
+            results.append((ii, None))
+    return results
+
+
+def _popcount(values):
+    """Number of bits set in each element of a uint64 array (np.bitwise_count needs NumPy 2)"""
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    return _POPCOUNT[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1, dtype=np.int64)
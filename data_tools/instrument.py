@@ -0,0 +1,315 @@
+"""
+Stage timers, counters and progress of the conversion tools, as JSON lines.
+
+Instrumentation is off by default, and then every call here returns at once. Turn it on with enable(), or by
+setting DATA_TOOLS_METRICS to the output file (or '-' for stderr) before importing data_tools:
+
+    DATA_TOOLS_METRICS=/tmp/metrics.jsonl DATA_TOOLS_PROFILE=1 python convert.py
+
+The tools wrap their work in stages (or decorate a function with instrumented(name)), and count what they
+process under the name of the stage:
+
+    with instrument.stage('resize', total=len(tasks), unit='images'):
+        ...
+        instrument.count('resize', 'images')
+        instrument.count('resize', 'bytes', nbytes)
+    # on a worker thread
+    with instrument.timer('resize', 'encode'):
+        new_image.save(new_filepath)
+
+Each line of the output is one event:
+    start     stage, total, unit, parent (the enclosing stage, if any)
+    progress  every report_every seconds: counters, done (the counter named by unit), rate (per second) and
+              eta (seconds, if total is known)
+    end       elapsed, counters, rate, timers (seconds summed over all threads, so they can exceed elapsed),
+              peak_traced_mb (with trace_memory) and profile (with profile)
+
+With profile=True, each top-level stage runs under cProfile and the stats are saved next to the output as
+<output>.<stage>.prof (read them with pstats or snakeviz). cProfile only sees the thread that opened the stage;
+the timers show where worker threads spend their time. With trace_memory=True, tracemalloc records the peak
+Python memory of each stage.
+"""
+
+import os
+import sys
+import json
+import time
+import cProfile
+import functools
+import threading
+import tracemalloc
+
+_recorder = None
+
+
+class _Null(object):
+    """Returned while instrumentation is off"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL = _Null()
+
+
+class _Timer(object):
+    def __init__(self, record, part):
+        self.record = record
+        self.part = part
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.start
+        with self.record.lock:
+            self.record.timers[self.part] = self.record.timers.get(self.part, 0.0) + elapsed
+        return False
+
+
+class _StageRecord(object):
+    def __init__(self, name, total, unit, parent_record):
+        self.name = name
+        self.total = total
+        self.unit = unit
+        self.parent_record = parent_record
+        self.parent = parent_record.name if parent_record is not None else None
+        self.counters = {}
+        self.timers = {}
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.last_report = self.start
+        self.peak = 0
+        self.profiler = None
+
+
+class _Stage(object):
+    """Context manager of one stage, see stage()"""
+
+    def __init__(self, recorder, name, total, unit):
+        self.recorder = recorder
+        self.name = name
+        self.total = total
+        self.unit = unit
+
+    def __enter__(self):
+        self.record = self.recorder.open(self.name, self.total, self.unit)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.recorder.close(self.record, failed=exc_type is not None)
+        return False
+
+
+class Recorder(object):
+    """
+    Writes the events of all stages to one output. See the module docstring.
+    Each thread keeps its own stack of open stages, so the same stage can run on several threads at once (e.g.
+    the branches of a Pipeline). count and timer go to the stage of that name opened by the calling thread, or
+    from a thread that opened none (a worker of the stage), to the most recently opened stage of that name.
+    """
+
+    def __init__(self, output, report_every=10.0, profile=False, trace_memory=False):
+        self.output_path = output
+        self.output = sys.stderr if output == '-' else open(output, 'a')
+        self.report_every = report_every
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.active = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def open(self, name, total, unit):
+        """Start a stage on the calling thread. Returns its record, to pass to close."""
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        record = _StageRecord(name, total, unit, parent)
+        with self.lock:
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                for open_record in self.active:
+                    open_record.peak = max(open_record.peak, peak)
+                tracemalloc.reset_peak()
+            self.active.append(record)
+        if self.profile and parent is None and not self._profiling():
+            record.profiler = cProfile.Profile()
+            record.profiler.enable()
+        stack.append(record)
+        self.write({'event': 'start', 'stage': name, 'total': total, 'unit': unit, 'parent': record.parent})
+        return record
+
+    def close(self, record, failed=False):
+        with self.lock:
+            self.active = [rr for rr in self.active if rr is not record]
+        stack = self._stack()
+        if record in stack:
+            stack.remove(record)
+        name = record.name
+        elapsed = time.time() - record.start
+        event = {'event': 'end', 'stage': name, 'elapsed': elapsed, 'failed': failed, 'parent': record.parent,
+                 'total': record.total, 'counters': dict(record.counters), 'timers': dict(record.timers)}
+        done = record.counters.get(record.unit)
+        if done is not None:
+            event['rate'] = done / elapsed if elapsed > 0 else None
+        if record.profiler is not None:
+            record.profiler.disable()
+            prof_path = "%s.%s.prof" % (self.output_path if self.output_path != '-' else 'data_tools', name)
+            record.profiler.dump_stats(prof_path)
+            event['profile'] = prof_path
+        if self.trace_memory:
+            record.peak = max(record.peak, tracemalloc.get_traced_memory()[1])
+            event['peak_traced_mb'] = record.peak / 1e6
+            parent = record.parent_record
+            if parent is not None:
+                parent.peak = max(parent.peak, record.peak)
+        self.write(event)
+
+    def count(self, name, key, n):
+        record = self._find(name)
+        if record is None:
+            return
+        with record.lock:
+            record.counters[key] = record.counters.get(key, 0) + n
+            now = time.time()
+            if now - record.last_report < self.report_every:
+                return
+            record.last_report = now
+            event = self._progress(record, now)
+        self.write(event)
+
+    def set_total(self, name, total):
+        record = self._find(name)
+        if record is not None:
+            record.total = total
+
+    def timer(self, name, part):
+        record = self._find(name)
+        if record is None:
+            return _NULL
+        return _Timer(record, part)
+
+    def write(self, event):
+        event['time'] = time.time()
+        line = json.dumps(event, default=repr) + "\n"
+        with self.lock:
+            self.output.write(line)
+            self.output.flush()
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def _find(self, name):
+        """The open stage called name: the calling thread's own, else the most recently opened one"""
+        for record in reversed(self._stack()):
+            if record.name == name:
+                return record
+        for record in reversed(self.active):
+            if record.name == name:
+                return record
+        return None
+
+    def _profiling(self):
+        """Only one cProfile profiler can be enabled at a time, so stages opened meanwhile are not profiled"""
+        return any(record.profiler is not None for record in self.active if record.parent is None)
+
+    def close_output(self):
+        if self.output is not sys.stderr:
+            self.output.close()
+
+    @staticmethod
+    def _progress(record, now):
+        elapsed = now - record.start
+        done = record.counters.get(record.unit, 0)
+        rate = done / elapsed if elapsed > 0 else None
+        eta = None
+        if record.total and rate:
+            eta = max(record.total - done, 0) / rate
+        return {'event': 'progress', 'stage': record.name, 'elapsed': elapsed, 'done': done, 'total': record.total,
+                'rate': rate, 'eta': eta, 'counters': dict(record.counters)}
+
+
+def enable(output, report_every=10.0, profile=False, trace_memory=False):
+    """
+    Turn instrumentation on.
+    :param output: JSON lines file to append to, or '-' for stderr
+    :param report_every: Seconds between progress events of a stage
+    :param profile: Run each top-level stage under cProfile
+    :param trace_memory: Record the peak Python memory of each stage with tracemalloc
+    """
+    global _recorder
+    disable()
+    _recorder = Recorder(output, report_every=report_every, profile=profile, trace_memory=trace_memory)
+
+
+def disable():
+    """Turn instrumentation off, closing the output"""
+    global _recorder
+    if _recorder is not None:
+        _recorder.close_output()
+        if _recorder.trace_memory:
+            tracemalloc.stop()
+    _recorder = None
+
+
+def enabled():
+    return _recorder is not None
+
+
+def stage(name, total=None, unit='items'):
+    """
+    Context manager around one stage of work.
+    :param name: Stage name, used by count and timer
+    :param total: Number of units expected, for the ETA
+    :param unit: The counter that measures progress, e.g. 'rows' or 'images'
+    """
+    if _recorder is None:
+        return _NULL
+    return _Stage(_recorder, name, total, unit)
+
+
+def instrumented(name, unit='items'):
+    """Decorator running every call of a function as stage name. Set its total with set_total."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return fn(*args, **kwargs)
+            with _Stage(_recorder, name, None, unit):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def set_total(name, total):
+    """Set the number of units expected by the open stage name, once it is known"""
+    if _recorder is None:
+        return
+    _recorder.set_total(name, total)
+
+
+def count(name, key, n=1):
+    """Add n to counter key of the open stage name. Safe to call from worker threads."""
+    if _recorder is None:
+        return
+    _recorder.count(name, key, n)
+
+
+def timer(name, part):
+    """Context manager adding its duration to timer part of the open stage name. Safe to call from worker threads."""
+    if _recorder is None:
+        return _NULL
+    return _recorder.timer(name, part)
+
+
+if os.environ.get('DATA_TOOLS_METRICS'):
+    enable(os.environ['DATA_TOOLS_METRICS'], profile=os.environ.get('DATA_TOOLS_PROFILE') == '1',
+           trace_memory=os.environ.get('DATA_TOOLS_TRACE_MEMORY') == '1')
@@ -0,0 +1,177 @@
+"""
+Read the KITTI files written by the redaction app.
+
+write_kitti_output (gie-kitti-output-dir) writes one file per frame per source, named
+<app index>_<stream id>_<frame number>.txt, with one line per object:
+    label 0.0 0 0.0 left top right bottom 0.0 0.0 0.0 0.0 0.0 0.0 0.0 [score]
+write_kitti_track_output (kitti-track-output-dir) uses the same names and adds the tracking id after the label:
+    label track_id 0.0 0 0.0 left top right bottom 0.0 0.0 0.0 0.0 0.0 0.0 0.0 [score]
+Box coordinates are in streammux output resolution. The app does not write scores; if a trailing score
+column is present it is read, otherwise every score is 1.
+
+A directory of these files is loaded into a KittiDetections object: one array per field, one entry per object.
+"""
+
+import os
+import re
+import numpy as np
+from data_tools.parallel import bounded_imap
+
+KITTI_FILENAME = re.compile(r'^(\d+)_(\d+)_(\d+)\.txt$')
+
+
+class KittiDetections(object):
+    """
+    Objects from KITTI files, as arrays with one entry per object:
+        app, stream, frame (int64), track (int64, -1 without tracking or for untracked objects),
+        label (int32 code into labels), boxes (float32, [left, top, right, bottom]), scores (float32)
+    frames holds (app, stream, frame) of every file read, including frames without objects.
+    """
+
+    FIELDS = ('app', 'stream', 'frame', 'track', 'label', 'boxes', 'scores')
+
+    def __init__(self, app, stream, frame, track, label, boxes, scores, labels, frames):
+        self.app = app
+        self.stream = stream
+        self.frame = frame
+        self.track = track
+        self.label = label
+        self.boxes = boxes
+        self.scores = scores
+        self.labels = labels
+        self.frames = frames
+
+    def __len__(self):
+        return len(self.frame)
+
+    def take(self, index):
+        """Return the objects selected by index (a boolean mask or object numbers). frames is unchanged."""
+        fields = [getattr(self, name)[index] for name in self.FIELDS]
+        return KittiDetections(*fields, labels=self.labels, frames=self.frames)
+
+    @property
+    def widths(self):
+        return self.boxes[:, 2] - self.boxes[:, 0]
+
+    @property
+    def heights(self):
+        return self.boxes[:, 3] - self.boxes[:, 1]
+
+    @classmethod
+    def concatenate(cls, parts):
+        """Concatenate several KittiDetections, merging their label vocabularies"""
+        if not parts:
+            return empty_detections()
+        label2code = {}
+        fields = {name: [] for name in cls.FIELDS}
+        for part in parts:
+            remap = np.array([label2code.setdefault(ll, len(label2code)) for ll in part.labels] or [0],
+                             dtype=np.int32)
+            for name in cls.FIELDS:
+                value = getattr(part, name)
+                fields[name].append(remap[value] if name == 'label' else value)
+        merged = [np.concatenate(fields[name]) for name in cls.FIELDS]
+        return cls(*merged, labels=list(label2code), frames=np.concatenate([part.frames for part in parts]))
+
+
+def empty_detections():
+    return KittiDetections(np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64),
+                           np.zeros(0, np.int64), np.zeros(0, np.int32), np.zeros((0, 4), np.float32),
+                           np.zeros(0, np.float32), [], np.zeros((0, 3), np.int64))
+
+
+def frame_keys(app, stream, frame):
+    """Combine (app, stream, frame) into one int64 per frame, ordered like (app, stream, frame)"""
+    return ((np.asarray(app, dtype=np.int64) << 52) | (np.asarray(stream, dtype=np.int64) << 40)
+            | np.asarray(frame, dtype=np.int64))
+
+
+def parse_kitti_filename(filename):
+    """Return (app index, stream id, frame number) of a KITTI file name, or None if it does not match"""
+    match = KITTI_FILENAME.match(os.path.basename(filename))
+    if match is None:
+        return None
+    return tuple(int(vv) for vv in match.groups())
+
+
+def list_kitti_files(kitti_dir):
+    """Return the KITTI file names in kitti_dir, sorted by (app, stream, frame)"""
+    names = []
+    with os.scandir(kitti_dir) as it:
+        for entry in it:
+            key = parse_kitti_filename(entry.name)
+            if key is not None:
+                names.append((key, entry.name))
+    names.sort()
+    return [name for _, name in names]
+
+
+def parse_kitti_files(paths, tracks=False):
+    """
+    Parse a list of KITTI files into a KittiDetections.
+    :param paths: KITTI files
+    :param tracks: True for files written by write_kitti_track_output (with a tracking id column)
+    """
+    box_col = 5 if tracks else 4
+    score_col = box_col + 11
+    keys, tracks_, labels_, boxes, scores = [], [], [], [], []
+    frames = []
+    for path in paths:
+        key = parse_kitti_filename(path)
+        frames.append(key)
+        with open(path) as f:
+            for line in f:
+                tok = line.split()
+                if len(tok) <= box_col + 3:
+                    continue
+                keys.append(key)
+                labels_.append(tok[0])
+                tracks_.append(_track_id(tok[1]) if tracks else -1)
+                boxes.append(tok[box_col:box_col + 4])
+                scores.append(tok[score_col] if len(tok) > score_col else 1.0)
+    labels = list(dict.fromkeys(labels_))
+    label2code = {ll: code for code, ll in enumerate(labels)}
+    keys = np.array(keys, dtype=np.int64).reshape(-1, 3)
+    return KittiDetections(keys[:, 0], keys[:, 1], keys[:, 2],
+                           np.array(tracks_, dtype=np.int64),
+                           np.array([label2code[ll] for ll in labels_], dtype=np.int32),
+                           np.array(boxes, dtype=np.float32).reshape(-1, 4),
+                           np.array(scores, dtype=np.float32),
+                           labels, np.array(frames, dtype=np.int64).reshape(-1, 3))
+
+
+def load_kitti_dir(kitti_dir, tracks=False, num_workers=8, files_per_task=512):
+    """
+    Load every KITTI file of a directory.
+    :param kitti_dir: gie-kitti-output-dir or kitti-track-output-dir of the app
+    :param tracks: True for kitti-track-output-dir files
+    :param num_workers: Number of worker processes
+    :param files_per_task: Number of files parsed per task
+    :return: KittiDetections, ordered by (app, stream, frame)
+    """
+    assert os.path.isdir(kitti_dir), "Directory %s does not exist" % kitti_dir
+    paths = [os.path.join(kitti_dir, name) for name in list_kitti_files(kitti_dir)]
+    detections = read_kitti_files(paths, tracks=tracks, num_workers=num_workers, files_per_task=files_per_task)
+    print(" Read %i objects from %i KITTI files in %s" % (len(detections), len(paths), kitti_dir))
+    return detections
+
+
+def read_kitti_files(paths, tracks=False, num_workers=8, files_per_task=512):
+    """
+    parse_kitti_files, with batches of files parsed in parallel worker processes.
+    :return: KittiDetections, in the order of paths
+    """
+    batches = [(paths[ii:ii + files_per_task], tracks) for ii in range(0, len(paths), files_per_task)]
+    return KittiDetections.concatenate(list(bounded_imap(_parse_batch, batches, num_workers=num_workers,
+                                                         use_processes=True, ordered=True)))
+
+
+def _track_id(token):
+    """object_id is a guint64; objects the tracker did not assign an id to have UNTRACKED_OBJECT_ID (2**64 - 1)"""
+    track = int(token)
+    return track if track < 2 ** 63 else -1
+
+
+def _parse_batch(batch):
+    paths, tracks = batch
+    return parse_kitti_files(paths, tracks=tracks)
@@ -0,0 +1,257 @@
+"""
+Compact the per-frame KITTI files of the redaction app into a few large files.
+
+The app writes one file per frame per source (see data_tools.kitti), which quickly adds up to millions of tiny
+files. compact_kitti_dir moves them into an archive directory holding, for each (app, stream):
+    <app>_<stream>.objects  one OBJECT_DTYPE record per object, in frame order
+    <app>_<stream>.frames   one FRAME_DTYPE record per frame: frame number and the number of its first object
+and index.json with the label table and the number of valid records in each file. Records are appended, and
+index.json is replaced after the data is written, so an archive can be extended while it is being read and
+data past the counts in index.json (from an interrupted compaction) is ignored and overwritten.
+
+KittiArchive reads an archive through memory maps and answers frame-range queries with a binary search over
+the frame records. follow_kitti_dir keeps compacting a directory while the app is writing to it.
+"""
+
+import os
+import json
+import time
+import numpy as np
+from data_tools.kitti import KittiDetections, empty_detections, list_kitti_files, parse_kitti_filename, \
+    read_kitti_files
+
+OBJECT_DTYPE = np.dtype([('frame', '<i8'), ('track', '<i8'), ('label', '<i4'), ('score', '<f4'),
+                         ('box', '<f4', (4,))])
+FRAME_DTYPE = np.dtype([('frame', '<i8'), ('first_object', '<i8')])
+INDEX_FILE = 'index.json'
+
+
+class KittiArchive(object):
+    """Read access to an archive written by compact_kitti_dir"""
+
+    def __init__(self, archive_dir):
+        assert os.path.isfile(os.path.join(archive_dir, INDEX_FILE)), "No KITTI archive in %s" % archive_dir
+        self.archive_dir = archive_dir
+        self.refresh()
+
+    def refresh(self):
+        """Re-read index.json, to see data appended since the archive was opened"""
+        self.meta = _read_meta(self.archive_dir)
+        self.labels = self.meta['labels']
+        self._maps = {}
+
+    @property
+    def streams(self):
+        """(app, stream) of every stream in the archive"""
+        return sorted(_stream_key(name) for name in self.meta['streams'])
+
+    def num_frames(self, app=0, stream=0):
+        return self.meta['streams'].get(_stream_name(app, stream), {}).get('frames', 0)
+
+    def frame_records(self, app=0, stream=0):
+        """Memory-mapped FRAME_DTYPE records of a stream"""
+        return self._map(app, stream, 'frames', FRAME_DTYPE)
+
+    def object_records(self, app=0, stream=0):
+        """Memory-mapped OBJECT_DTYPE records of a stream"""
+        return self._map(app, stream, 'objects', OBJECT_DTYPE)
+
+    def read(self, app=0, stream=0, start=None, stop=None):
+        """
+        Objects of one stream with start <= frame number < stop.
+        :return: KittiDetections
+        """
+        frames = self.frame_records(app, stream)
+        objects = self.object_records(app, stream)
+        lo = 0 if start is None else int(np.searchsorted(frames['frame'], start, side='left'))
+        hi = len(frames) if stop is None else int(np.searchsorted(frames['frame'], stop, side='left'))
+        first = int(frames['first_object'][lo]) if lo < len(frames) else len(objects)
+        last = int(frames['first_object'][hi]) if hi < len(frames) else len(objects)
+        records = np.array(objects[first:last])
+        frame_keys = np.zeros((hi - lo, 3), dtype=np.int64)
+        frame_keys[:, 0] = app
+        frame_keys[:, 1] = stream
+        frame_keys[:, 2] = frames['frame'][lo:hi]
+        return KittiDetections(np.full(len(records), app, dtype=np.int64),
+                               np.full(len(records), stream, dtype=np.int64), records['frame'], records['track'],
+                               records['label'], records['box'], records['score'], list(self.labels), frame_keys)
+
+    def detections(self):
+        """Objects of every stream, as one KittiDetections"""
+        parts = [self.read(app, stream) for app, stream in self.streams]
+        return KittiDetections.concatenate(parts) if parts else empty_detections()
+
+    def _map(self, app, stream, kind, dtype):
+        name = _stream_name(app, stream)
+        key = (name, kind)
+        if key not in self._maps:
+            count = self.meta['streams'].get(name, {}).get(kind, 0)
+            path = os.path.join(self.archive_dir, '%s.%s' % (name, kind))
+            self._maps[key] = (np.memmap(path, dtype=dtype, mode='r', shape=(count,)) if count
+                               else np.zeros(0, dtype=dtype))
+        return self._maps[key]
+
+
+def compact_kitti_dir(kitti_dir, archive_dir, tracks=False, delete=False, settle=None, num_workers=8,
+                      files_per_task=512):
+    """
+    Append the frames of a KITTI directory that are not yet in the archive.
+    Frames are taken in order and only frames after the last archived frame of their stream are added, so use
+    one archive per run of the app.
+    :param kitti_dir: gie-kitti-output-dir or kitti-track-output-dir of the app
+    :param archive_dir: Archive directory. Created if it does not exist.
+    :param tracks: True for kitti-track-output-dir files. Must be the same for every call on an archive.
+    :param delete: Remove the KITTI files once they are in the archive
+    :param settle: If set, the app may still be writing: the newest frame of each stream is only taken once a
+        later frame exists or the file is settle seconds old
+    :param num_workers: Number of processes parsing KITTI files
+    :param files_per_task: Number of files parsed per task
+    :return: Number of frames added
+    """
+    assert os.path.isdir(kitti_dir), "Directory %s does not exist" % kitti_dir
+    os.makedirs(archive_dir, exist_ok=True)
+    meta = _read_meta(archive_dir) if os.path.isfile(os.path.join(archive_dir, INDEX_FILE)) else \
+        {'tracks': tracks, 'labels': [], 'streams': {}}
+    assert meta['tracks'] == tracks, "Archive %s was written with tracks=%s" % (archive_dir, meta['tracks'])
+
+    names = _pending_files(kitti_dir, meta, settle)
+    if not names:
+        return 0
+    paths = [os.path.join(kitti_dir, name) for name in names]
+    detections = read_kitti_files(paths, tracks=tracks, num_workers=num_workers, files_per_task=files_per_task)
+
+    label2code = {ll: code for code, ll in enumerate(meta['labels'])}
+    remap = np.array([label2code.setdefault(ll, len(label2code)) for ll in detections.labels] or [0], dtype=np.int32)
+    meta['labels'] = list(label2code)
+
+    # Files are sorted by (app, stream, frame), so each stream is one contiguous run of objects and frames
+    frame_keys = detections.frames
+    stream_change = np.flatnonzero(np.any(frame_keys[1:, :2] != frame_keys[:-1, :2], axis=1)) + 1
+    for lo, hi in zip(np.r_[0, stream_change], np.r_[stream_change, len(frame_keys)]):
+        app, stream = (int(vv) for vv in frame_keys[lo, :2])
+        name = _stream_name(app, stream)
+        info = meta['streams'].setdefault(name, {'frames': 0, 'objects': 0, 'last_frame': -1})
+        obj_sel = np.flatnonzero((detections.app == app) & (detections.stream == stream))
+        objects = np.zeros(len(obj_sel), dtype=OBJECT_DTYPE)
+        objects['frame'] = detections.frame[obj_sel]
+        objects['track'] = detections.track[obj_sel]
+        objects['label'] = remap[detections.label[obj_sel]]
+        objects['score'] = detections.scores[obj_sel]
+        objects['box'] = detections.boxes[obj_sel]
+        frames = np.zeros(hi - lo, dtype=FRAME_DTYPE)
+        frames['frame'] = frame_keys[lo:hi, 2]
+        frames['first_object'] = info['objects'] + np.searchsorted(objects['frame'], frames['frame'], side='left')
+        _append(os.path.join(archive_dir, name + '.objects'), info['objects'], objects)
+        _append(os.path.join(archive_dir, name + '.frames'), info['frames'], frames)
+        info['objects'] += len(objects)
+        info['frames'] += len(frames)
+        info['last_frame'] = int(frames['frame'][-1])
+    _write_meta(archive_dir, meta)
+
+    if delete:
+        for path in paths:
+            os.remove(path)
+    print(" Compacted %i frames (%i objects) from %s into %s" % (len(paths), len(detections), kitti_dir,
+                                                                  archive_dir))
+    return len(paths)
+
+
+def follow_kitti_dir(kitti_dir, archive_dir, tracks=False, delete=True, poll_interval=5.0, settle=10.0,
+                     idle_timeout=None, num_workers=8):
+    """
+    Keep compacting a KITTI directory while the app writes to it.
+    :param poll_interval: Seconds between scans of kitti_dir
+    :param settle: See compact_kitti_dir
+    :param idle_timeout: Stop after this many seconds without new frames. None to run until interrupted.
+    Other parameters are as for compact_kitti_dir.
+    :return: Number of frames added
+    """
+    total = 0
+    last_new = time.time()
+    try:
+        while True:
+            added = compact_kitti_dir(kitti_dir, archive_dir, tracks=tracks, delete=delete, settle=settle,
+                                      num_workers=num_workers)
+            total += added
+            now = time.time()
+            if added:
+                last_new = now
+            elif idle_timeout is not None and now - last_new >= idle_timeout:
+                break
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        pass
+    print("Compacted %i frames from %s" % (total, kitti_dir))
+    return total
+
+
+def _pending_files(kitti_dir, meta, settle):
+    """KITTI files in kitti_dir newer than the last archived frame of their stream, in (app, stream, frame) order"""
+    names = list_kitti_files(kitti_dir)
+    keys = [parse_kitti_filename(name) for name in names]
+    pending = [(key, name) for key, name in zip(keys, names)
+               if key[2] > meta['streams'].get(_stream_name(key[0], key[1]), {}).get('last_frame', -1)]
+    if settle is None:
+        return [name for _, name in pending]
+    # The newest file of a stream may be open in the app. Later frames of the same stream mean it is closed.
+    newest = {}
+    for key, name in pending:
+        newest[key[:2]] = name
+    now = time.time()
+    held = set(name for name in newest.values()
+               if now - os.stat(os.path.join(kitti_dir, name)).st_mtime < settle)
+    return [name for _, name in pending if name not in held]
+
+
+def _append(path, count, records):
+    """Write records after the first count records of path, dropping anything beyond them"""
+    mode = 'r+b' if os.path.isfile(path) else 'wb'
+    with open(path, mode) as f:
+        f.seek(count * records.dtype.itemsize)
+        f.truncate()
+        f.write(records.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _read_meta(archive_dir):
+    with open(os.path.join(archive_dir, INDEX_FILE)) as f:
+        return json.load(f)
+
+
+def _write_meta(archive_dir, meta):
+    tmp = os.path.join(archive_dir, INDEX_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp, os.path.join(archive_dir, INDEX_FILE))
+
+
+def _stream_name(app, stream):
+    return '%02i_%03i' % (app, stream)
+
+
+def _stream_key(name):
+    app, stream = name.split('_')
+    return int(app), int(stream)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Compact the KITTI output directory of the redaction app")
+    parser.add_argument('kitti_dir')
+    parser.add_argument('archive_dir')
+    parser.add_argument('--tracks', action='store_true', help="kitti-track-output-dir files (with tracking ids)")
+    parser.add_argument('--delete', action='store_true', help="Remove KITTI files once archived")
+    parser.add_argument('--follow', action='store_true', help="Keep compacting new files as the app writes them")
+    parser.add_argument('--poll-interval', type=float, default=5.0)
+    parser.add_argument('--settle', type=float, default=10.0)
+    parser.add_argument('--idle-timeout', type=float, default=None)
+    parser.add_argument('--num-workers', type=int, default=8)
+    args = parser.parse_args()
+    if args.follow:
+        follow_kitti_dir(args.kitti_dir, args.archive_dir, tracks=args.tracks, delete=args.delete,
+                         poll_interval=args.poll_interval, settle=args.settle, idle_timeout=args.idle_timeout,
+                         num_workers=args.num_workers)
+    else:
+        compact_kitti_dir(args.kitti_dir, args.archive_dir, tracks=args.tracks, delete=args.delete,
+                          num_workers=args.num_workers)
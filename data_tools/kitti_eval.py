@@ -0,0 +1,235 @@
+"""
+Score the KITTI output of the redaction app against COCO ground truth.
+
+Detections (from a KITTI directory, see data_tools.kitti, or a KITTI archive, see data_tools.kitti_archive)
+are matched to the ground truth boxes of their image, COCO style: in order of decreasing score, each
+detection takes the unmatched ground truth box it overlaps most, if their IoU is at least iou_threshold.
+AP (101 point interpolated) and recall are reported for all boxes and per COCO box size bucket.
+
+Matching is done with array operations over the whole dataset: every (detection, ground truth) pair of the
+same image is scored at once, and the greedy assignment runs one step per detection rank, handling the k'th
+detection of every image together. The pairs are computed once, so sweeping the app's threshold and
+detected-min-w / detected-min-h (odtk_model_config_*.txt) only re-runs the assignment.
+"""
+
+import os
+import itertools
+import numpy as np
+from data_tools.coco_index import load_index
+from data_tools.kitti import KittiDetections, load_kitti_dir
+from data_tools.kitti_archive import KittiArchive, INDEX_FILE
+
+AREA_RANGES = (('all', 0, float('inf')),
+               ('small', 0, 32 ** 2),
+               ('medium', 32 ** 2, 96 ** 2),
+               ('large', 96 ** 2, float('inf')))
+RECALL_POINTS = np.linspace(0, 1, 101)
+
+
+def evaluate_kitti(detections, annotations, mapping=None, mux_size=None, iou_threshold=0.5, thresholds=(0.0,),
+                   min_sizes=((0, 0),), categories=None, labels=None, num_workers=8):
+    """
+    Evaluate KITTI detections against COCO annotations, for every combination of thresholds and min_sizes.
+    :param detections: KITTI output directory of the app (gie-kitti-output-dir), a KITTI archive directory
+        written by compact_kitti_dir, a KittiArchive or KittiDetections
+    :param annotations: COCO annotation file (e.g. from openimages2coco), COCO dict or CocoIndex
+    :param mapping: How frames map to images, see frames_to_image_rows. By default frame n of each stream is the
+        n'th image of the annotation file.
+    :param mux_size: (width, height) of the streammux output, which KITTI boxes are given in. If set, boxes are
+        scaled to the size of their image. If None, boxes are assumed to be in image coordinates.
+    :param iou_threshold: Minimum IoU for a detection to match a ground truth box
+    :param thresholds: Score thresholds to evaluate. The app does not write scores, so this only has an
+        effect on KITTI files with a score column.
+    :param min_sizes: (detected-min-w, detected-min-h) pairs to evaluate, in streammux pixels
+    :param categories: Ground truth category ids to evaluate. Defaults to all.
+    :param labels: Detection labels to evaluate. Defaults to all.
+    :param num_workers: Number of processes reading a KITTI directory
+    :return: list of dicts, one per threshold, min size and area range
+    """
+    if not isinstance(detections, (KittiDetections, KittiArchive)):
+        if os.path.isfile(os.path.join(detections, INDEX_FILE)):
+            detections = KittiArchive(detections)
+        else:
+            detections = load_kitti_dir(detections, num_workers=num_workers)
+    if isinstance(detections, KittiArchive):
+        detections = detections.detections()
+    index = load_index(annotations, verbose=True)
+
+    if labels is not None:
+        codes = [code for code, ll in enumerate(detections.labels) if ll in labels]
+        detections = detections.take(np.isin(detections.label, codes))
+    det_rows = frames_to_image_rows(detections.app, detections.stream, detections.frame, index, mapping)
+    frame_rows = frames_to_image_rows(detections.frames[:, 0], detections.frames[:, 1], detections.frames[:, 2],
+                                      index, mapping)
+    keep = det_rows >= 0
+    detections, det_rows = detections.take(keep), det_rows[keep]
+    image_rows = np.unique(frame_rows[frame_rows >= 0])
+    print("Evaluating %i detections on %i images (%i detections in unmapped frames)" % (
+        len(detections), len(image_rows), int((~keep).sum())))
+
+    det_boxes = detections.boxes.astype(np.float64)
+    if mux_size is not None:
+        scale = np.stack([np.asarray(index.image_columns['width'], dtype=np.float64)[det_rows] / mux_size[0],
+                          np.asarray(index.image_columns['height'], dtype=np.float64)[det_rows] / mux_size[1]], 1)
+        det_boxes = det_boxes * np.tile(scale, 2)
+
+    gt_rows, gt_boxes, gt_crowd = _ground_truth(index, image_rows, categories)
+    pairs = _pairs(det_rows, det_boxes, gt_rows, gt_boxes, iou_threshold)
+    det_area = (det_boxes[:, 2] - det_boxes[:, 0]) * (det_boxes[:, 3] - det_boxes[:, 1])
+    gt_area = (gt_boxes[:, 2] - gt_boxes[:, 0]) * (gt_boxes[:, 3] - gt_boxes[:, 1])
+
+    results = []
+    for threshold, (min_w, min_h) in itertools.product(thresholds, min_sizes):
+        det_keep = ((detections.scores >= threshold) & (detections.widths >= min_w)
+                    & (detections.heights >= min_h))
+        for name, low, high in AREA_RANGES:
+            gt_ignore = gt_crowd | (gt_area < low) | (gt_area >= high)
+            det_ignore = (det_area < low) | (det_area >= high)
+            result = _evaluate_range(det_rows, detections.scores, det_keep, det_ignore, gt_ignore, pairs)
+            result.update(threshold=threshold, min_w=min_w, min_h=min_h, area=name)
+            results.append(result)
+    return results
+
+
+def frames_to_image_rows(app, stream, frame, index, mapping=None):
+    """
+    Find the annotation file image of each frame.
+    :param app, stream, frame: Arrays identifying frames (from the KITTI file names)
+    :param index: CocoIndex of the ground truth
+    :param mapping: None to map frame n of every stream to the n'th image of the annotation file, or a dict of
+        (stream, frame) or (app, stream, frame): file name or image id, or a function(app, stream, frame)
+        returning a file name or image id (or None)
+    :return: Image row of each frame, -1 for frames without an image
+    """
+    frame = np.asarray(frame, dtype=np.int64)
+    if mapping is None:
+        return np.where(frame < index.num_images, frame, -1)
+    rows = np.full(len(frame), -1, dtype=np.int64)
+    for ii, key in enumerate(zip(np.asarray(app).tolist(), np.asarray(stream).tolist(), frame.tolist())):
+        if callable(mapping):
+            target = mapping(*key)
+        else:
+            target = mapping.get(key, mapping.get(key[1:]))
+        if target is None:
+            continue
+        try:
+            rows[ii] = index.image_row(index.filename2imgid(target) if isinstance(target, str) else target)
+        except KeyError:
+            pass
+    return rows
+
+
+def box_iou(a, b):
+    """IoU of boxes a[i] and b[i], both (n, 4) arrays of [left, top, right, bottom]"""
+    w = np.clip(np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0]), 0, None)
+    h = np.clip(np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1]), 0, None)
+    inter = w * h
+    union = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]) + (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1]) - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-12), 0.0)
+
+
+def print_results(results):
+    """Print the results of evaluate_kitti as a table"""
+    print("%9s %6s %6s %7s %7s %7s %8s %8s" % ('threshold', 'min_w', 'min_h', 'area', 'AP', 'recall', 'num_gt',
+                                              'num_det'))
+    for res in results:
+        print("%9.2f %6i %6i %7s %7.4f %7.4f %8i %8i" % (res['threshold'], res['min_w'], res['min_h'], res['area'],
+                                                         res['ap'], res['recall'], res['num_gt'], res['num_det']))
+
+
+def _ground_truth(index, image_rows, categories):
+    """Ground truth boxes ([left, top, right, bottom]) of the evaluated images, with their image row and crowd flag"""
+    ann_rows = np.flatnonzero(np.isin(index.ann_image_rows, image_rows))
+    if categories is not None:
+        cat_ids = np.asarray(index.ann_columns['category_id'])[ann_rows]
+        ann_rows = ann_rows[np.isin(cat_ids, list(categories))]
+    boxes = index.bboxes[ann_rows].astype(np.float64)
+    boxes[:, 2:] += boxes[:, :2]
+    if 'iscrowd' in index.ann_columns:
+        crowd = np.asarray([vv == 1 for vv in _column_values(index.ann_columns['iscrowd'], ann_rows)], dtype=bool)
+    else:
+        crowd = np.zeros(len(ann_rows), dtype=bool)
+    return index.ann_image_rows[ann_rows], boxes, crowd
+
+
+def _column_values(column, rows):
+    if isinstance(column, np.ndarray):
+        return column[rows].tolist()
+    return [column[row] for row in rows.tolist()]
+
+
+def group_pairs(groups_a, groups_b):
+    """
+    All (i, j) with groups_a[i] == groups_b[j], e.g. every (detection, ground truth) pair of the same image
+    :return: (i array, j array)
+    """
+    order_b = np.argsort(groups_b, kind='stable')
+    sorted_b = groups_b[order_b]
+    start = np.searchsorted(sorted_b, groups_a, side='left')
+    count = np.searchsorted(sorted_b, groups_a, side='right') - start
+    pair_a = np.repeat(np.arange(len(groups_a)), count)
+    offsets = np.arange(len(pair_a)) - np.repeat(np.cumsum(count) - count, count)
+    return pair_a, order_b[np.repeat(start, count) + offsets]
+
+
+def _pairs(det_rows, det_boxes, gt_rows, gt_boxes, iou_threshold):
+    """All (detection, ground truth) pairs of the same image with IoU >= iou_threshold, as (det, gt, iou) arrays"""
+    pair_det, pair_gt = group_pairs(det_rows, gt_rows)
+    iou = box_iou(det_boxes[pair_det], gt_boxes[pair_gt])
+    keep = iou >= iou_threshold
+    return pair_det[keep], pair_gt[keep], iou[keep]
+
+
+def _evaluate_range(det_rows, scores, det_keep, det_ignore, gt_ignore, pairs):
+    """Greedy matching and AP / recall for one set of detections and one area range"""
+    # Detections in matching order: by image, then by decreasing score. rank is the position within the image.
+    order = np.flatnonzero(det_keep)
+    order = order[np.lexsort((-scores[order], det_rows[order]))]
+    rank = np.full(len(det_rows), -1, dtype=np.int64)
+    if len(order):
+        first = np.r_[True, det_rows[order][1:] != det_rows[order][:-1]]
+        group_start = np.maximum.accumulate(np.where(first, np.arange(len(order)), 0))
+        rank[order] = np.arange(len(order)) - group_start
+
+    pair_det, pair_gt, iou = pairs
+    valid = rank[pair_det] >= 0
+    pair_det, pair_gt, iou = pair_det[valid], pair_gt[valid], iou[valid]
+    # Prefer ground truth that is not ignored, then the highest IoU, as COCO does
+    priority = iou + 2.0 * ~gt_ignore[pair_gt]
+    pair_rank = rank[pair_det]
+    by_rank = np.argsort(pair_rank, kind='stable')
+    rank_bounds = np.searchsorted(pair_rank[by_rank], np.arange(pair_rank.max() + 2 if len(pair_rank) else 1))
+
+    matched = np.full(len(det_rows), -1, dtype=np.int64)
+    taken = np.zeros(len(gt_ignore), dtype=bool)
+    for kk in range(len(rank_bounds) - 1):
+        sel = by_rank[rank_bounds[kk]:rank_bounds[kk + 1]]
+        sel = sel[~taken[pair_gt[sel]]]
+        if not len(sel):
+            continue
+        sel = sel[np.lexsort((-priority[sel], pair_det[sel]))]
+        best = sel[np.r_[True, pair_det[sel][1:] != pair_det[sel][:-1]]]
+        matched[pair_det[best]] = pair_gt[best]
+        taken[pair_gt[best]] = True
+
+    kept = order[np.argsort(-scores[order], kind='stable')]
+    has_match = matched[kept] >= 0
+    ignored = np.where(has_match, gt_ignore[np.maximum(matched[kept], 0)], det_ignore[kept])
+    tp = has_match & ~ignored
+    fp = ~has_match & ~ignored
+    num_gt = int((~gt_ignore).sum())
+    return dict(_average_precision(np.cumsum(tp), np.cumsum(fp), num_gt), num_gt=num_gt,
+                num_det=int((~ignored).sum()))
+
+
+def _average_precision(tp_cum, fp_cum, num_gt):
+    if num_gt == 0:
+        return {'ap': float('nan'), 'recall': float('nan'), 'precision': float('nan')}
+    if len(tp_cum) == 0:
+        return {'ap': 0.0, 'recall': 0.0, 'precision': 0.0}
+    recall = tp_cum / float(num_gt)
+    precision = tp_cum / np.maximum(tp_cum + fp_cum, 1)
+    envelope = np.maximum.accumulate(precision[::-1])[::-1]
+    pos = np.searchsorted(recall, RECALL_POINTS, side='left')
+    interpolated = np.where(pos < len(envelope), envelope[np.minimum(pos, len(envelope) - 1)], 0.0)
+    return {'ap': float(interpolated.mean()), 'recall': float(recall[-1]), 'precision': float(precision[-1])}
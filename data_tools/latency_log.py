@@ -0,0 +1,302 @@
+"""
+Parse the performance output of the redaction app.
+
+With latency measurement enabled (NVDS_ENABLE_LATENCY_MEASUREMENT=1), latency_measurement_buf_prob prints,
+for every batch,
+    ************BATCH-NUM = 12**************
+    Source id = 0 Frame_num = 96 Frame latency = 41.877930 (ms)
+and with enable-perf-measurement=1, perf_cb prints the FPS of every stream each perf-measurement-interval-sec:
+    **PERF: FPS 0 (Avg)	FPS 1 (Avg)
+    **PERF: 29.98 (29.87)	30.01 (29.90)
+
+LatencyLogParser consumes these lines one at a time, from a finished log or while the app is running, and
+keeps per-source latency histograms with fixed logarithmic buckets, so memory does not grow with the length
+of the run. Quantiles read from the histograms are within half a bucket (about 0.6% with the default
+bucket size) of the exact value.
+"""
+
+import re
+import sys
+import json
+import time
+import numpy as np
+
+BATCH_LINE = re.compile(r'\*+BATCH-NUM = (\d+)\*+')
+LATENCY_LINE = re.compile(r'Source id = (\d+) Frame_num = (-?\d+) Frame latency = ([-+\d.eE]+) \(ms\)')
+PERF_LINE = re.compile(r'\*\*PERF:\s*(.*)')
+PERF_VALUE = re.compile(r'([\d.]+) \(([\d.]+)\)')
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class LogHistogram(object):
+    """Counts of values in logarithmic buckets between min_value and max_value. Values outside are clamped."""
+
+    def __init__(self, min_value=0.01, max_value=1e6, bins_per_decade=200):
+        self.min_value = min_value
+        self.bins_per_decade = bins_per_decade
+        self.num_bins = int(np.ceil(np.log10(max_value / min_value) * bins_per_decade)) + 1
+        self.counts = np.zeros(self.num_bins, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, value):
+        self.counts[self._bin(value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def add_many(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return
+        np.add.at(self.counts, self._bin(values), 1)
+        self.count += len(values)
+        self.total += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else float('nan')
+
+    def quantile(self, q):
+        """Approximate q quantile: the centre of the bucket holding it, clipped to the observed range"""
+        if not self.count:
+            return float('nan')
+        bucket = int(np.searchsorted(np.cumsum(self.counts), q * self.count, side='left'))
+        value = self.min_value * 10 ** ((bucket + 0.5) / self.bins_per_decade)
+        return float(np.clip(value, self.min, self.max))
+
+    def _bin(self, value):
+        value = np.maximum(value, self.min_value)
+        return np.minimum((np.log10(value / self.min_value) * self.bins_per_decade).astype(np.int64),
+                          self.num_bins - 1)
+
+
+class LatencyLogParser(object):
+    """
+    Collects latency, FPS and batch statistics from the output of the app, fed one line at a time.
+    :param interval: perf-measurement-interval-sec of the run, used to put times on the FPS series
+    :param batch_size: batch-size of [streammux], used to report how full batches are
+    """
+
+    def __init__(self, interval=None, batch_size=None):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.latency = {}
+        self.all_latency = LogHistogram()
+        self.last_frame = {}
+        self.fps = []
+        self.fps_avg = []
+        self.batch_sizes = {}
+        self.lines = 0
+        self._batch_sources = None
+
+    def feed(self, line):
+        """Parse one line of output. Lines that are not performance output are ignored."""
+        self.lines += 1
+        match = LATENCY_LINE.search(line)
+        if match is not None:
+            source, frame, latency = int(match.group(1)), int(match.group(2)), float(match.group(3))
+            hist = self.latency.get(source)
+            if hist is None:
+                hist = self.latency[source] = LogHistogram()
+            hist.add(latency)
+            self.all_latency.add(latency)
+            self.last_frame[source] = frame
+            if self._batch_sources is not None:
+                self._batch_sources += 1
+            return
+        match = BATCH_LINE.search(line)
+        if match is not None:
+            self._end_batch()
+            self._batch_sources = 0
+            return
+        match = PERF_LINE.search(line)
+        if match is not None:
+            values = PERF_VALUE.findall(match.group(1))
+            if values:
+                self.fps.append([float(fps) for fps, _ in values])
+                self.fps_avg.append([float(avg) for _, avg in values])
+
+    def feed_lines(self, lines):
+        for line in lines:
+            self.feed(line)
+        return self
+
+    def _end_batch(self):
+        if self._batch_sources is not None:
+            self.batch_sizes[self._batch_sources] = self.batch_sizes.get(self._batch_sources, 0) + 1
+        self._batch_sources = None
+
+    def summary(self):
+        """
+        Statistics so far, as a dict:
+            latency: {source id or 'all': {frames, last_frame, mean, min, max, p50, p95, p99}}
+            fps: {stream: {mean, min, max, last_avg}} over the FPS reports
+            batches: {count, mean_sources, fill (mean_sources / batch_size), sources: {sources in batch: count}}
+        """
+        batch_sizes = dict(self.batch_sizes)
+        if self._batch_sources is not None:
+            batch_sizes[self._batch_sources] = batch_sizes.get(self._batch_sources, 0) + 1
+        num_batches = sum(batch_sizes.values())
+        mean_sources = (sum(size * count for size, count in batch_sizes.items()) / float(num_batches)
+                        if num_batches else float('nan'))
+
+        latency = {}
+        for source in sorted(self.latency):
+            latency[source] = _hist_summary(self.latency[source])
+            latency[source]['last_frame'] = self.last_frame[source]
+        latency['all'] = _hist_summary(self.all_latency)
+
+        fps = {}
+        if self.fps:
+            num_streams = max(len(row) for row in self.fps)
+            values = np.full((len(self.fps), num_streams), np.nan)
+            for ii, row in enumerate(self.fps):
+                values[ii, :len(row)] = row
+            for stream in range(num_streams):
+                column = values[:, stream][~np.isnan(values[:, stream])]
+                last_avg = [row[stream] for row in self.fps_avg if len(row) > stream][-1]
+                fps[stream] = {'mean': float(column.mean()), 'min': float(column.min()), 'max': float(column.max()),
+                               'last_avg': last_avg}
+        return {'latency': latency, 'fps': fps,
+                'batches': {'count': num_batches, 'mean_sources': mean_sources,
+                            'fill': mean_sources / self.batch_size if self.batch_size else None,
+                            'sources': dict(sorted(batch_sizes.items()))}}
+
+    def fps_series(self):
+        """List of (time in seconds or report number, [fps of each stream]) for every FPS report"""
+        step = self.interval if self.interval else 1
+        return [(ii * step, row) for ii, row in enumerate(self.fps)]
+
+    def print_summary(self):
+        summary = self.summary()
+        print("%6s %8s %9s %9s %9s %9s %9s" % ('source', 'frames', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+        for source, stats in summary['latency'].items():
+            print("%6s %8i %9.2f %9.2f %9.2f %9.2f %9.2f" % (source, stats['frames'], stats['mean'], stats['p50'],
+                                                             stats['p95'], stats['p99'], stats['max']))
+        for stream, stats in summary['fps'].items():
+            print("Stream %i: %.2f FPS (min %.2f, max %.2f, app average %.2f)" % (
+                stream, stats['mean'], stats['min'], stats['max'], stats['last_avg']))
+        batches = summary['batches']
+        if batches['count']:
+            print("%i batches, %.2f sources per batch%s" % (
+                batches['count'], batches['mean_sources'],
+                '' if batches['fill'] is None else ' (%.0f%% full)' % (100 * batches['fill'])))
+
+    def write_report(self, output_file):
+        """Write the summary as JSON (with the FPS series) or, for a .csv file name, one row per source"""
+        summary = self.summary()
+        if output_file.endswith('.csv'):
+            with open(output_file, 'w') as f:
+                f.write('source,frames,mean_ms,min_ms,max_ms,p50_ms,p95_ms,p99_ms,fps_mean,fps_last_avg\n')
+                for source, stats in summary['latency'].items():
+                    fps = summary['fps'].get(source, {})
+                    f.write('%s,%i,%.3f,%.3f,%.3f,%.3f,%.3f,%.3f,%s,%s\n' % (
+                        source, stats['frames'], stats['mean'], stats['min'], stats['max'], stats['p50'],
+                        stats['p95'], stats['p99'], _csv_value(fps.get('mean')), _csv_value(fps.get('last_avg'))))
+        else:
+            summary['fps_series'] = self.fps_series()
+            with open(output_file, 'w') as f:
+                json.dump(_json_keys(summary), f, indent=1)
+        print("Wrote report to", output_file)
+
+
+def parse_log(log, follow=False, interval=None, batch_size=None, poll_interval=0.5, idle_timeout=None,
+              report_every=None):
+    """
+    Parse a log of the app.
+    :param log: Log file name, '-' for stdin (e.g. piped from the app), or an open file
+    :param follow: Keep reading as the log grows, like tail -f, until interrupted or idle_timeout
+    :param interval: perf-measurement-interval-sec of the run
+    :param batch_size: batch-size of [streammux]
+    :param poll_interval: Seconds between checks for new lines when following
+    :param idle_timeout: When following, stop after this many seconds without new lines
+    :param report_every: If set, print the summary every report_every seconds
+    :return: LatencyLogParser
+    """
+    parser = LatencyLogParser(interval=interval, batch_size=batch_size)
+    if log == '-':
+        f = sys.stdin
+    elif isinstance(log, str):
+        f = open(log)
+    else:
+        f = log
+    last_line = last_report = time.time()
+    pending = ''
+    try:
+        while True:
+            line = f.readline()
+            now = time.time()
+            if report_every is not None and now - last_report >= report_every:
+                parser.print_summary()
+                last_report = now
+            if line:
+                pending += line
+                if pending.endswith('\n') or not follow:
+                    parser.feed(pending)
+                    pending = ''
+                last_line = now
+                continue
+            if not follow or (idle_timeout is not None and now - last_line >= idle_timeout):
+                break
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if f is not log and f is not sys.stdin:
+            f.close()
+    if pending:
+        parser.feed(pending)
+    return parser
+
+
+def _hist_summary(hist):
+    stats = {'frames': hist.count, 'mean': hist.mean,
+             'min': hist.min if hist.count else float('nan'), 'max': hist.max if hist.count else float('nan')}
+    for q in QUANTILES:
+        stats['p%i' % round(100 * q)] = hist.quantile(q)
+    return stats
+
+
+def _csv_value(value):
+    return '' if value is None else '%.3f' % value
+
+
+def _json_keys(value):
+    if isinstance(value, dict):
+        return {str(key): _json_keys(vv) for key, vv in value.items()}
+    return value
+
+
+if __name__ == '__main__':
+    import argparse
+    arg_parser = argparse.ArgumentParser(description="Summarize the latency and FPS output of the redaction app")
+    arg_parser.add_argument('log', help="Log file, or - to read stdin")
+    arg_parser.add_argument('--follow', action='store_true', help="Keep reading as the log grows")
+    arg_parser.add_argument('--interval', type=float, default=None, help="perf-measurement-interval-sec")
+    arg_parser.add_argument('--batch-size', type=int, default=None, help="batch-size of [streammux]")
+    arg_parser.add_argument('--idle-timeout', type=float, default=None)
+    arg_parser.add_argument('--report-every', type=float, default=None,
+                            help="Print the summary every this many seconds")
+    arg_parser.add_argument('--csv', default=None, help="Write a per-source CSV report")
+    arg_parser.add_argument('--json', default=None, help="Write a JSON report")
+    args = arg_parser.parse_args()
+    result = parse_log(args.log, follow=args.follow, interval=args.interval, batch_size=args.batch_size,
+                       idle_timeout=args.idle_timeout, report_every=args.report_every)
+    result.print_summary()
+    if args.csv:
+        result.write_report(args.csv)
+    if args.json:
+        result.write_report(args.json)
@@ -0,0 +1,442 @@
+"""
+Prefetching batch loader over the COCO datasets produced by openimages2coco and copy_images.
+
+CocoLoader reads the annotations through a CocoIndex and decodes the images of the next batches on a worker pool
+while the current batch is in use. Images are resized the way the retinanet trainer does (the shorter side to
+resize, unless that makes the longer side exceed max_size) and written straight into a ring of batch buffers in
+shared memory, so worker processes don't send pixels back through pickles (shared memory needs Python 3.8;
+on older versions the buffers are plain arrays and the workers are threads). Each batch is
+    images    (n, height, width, 3) uint8 view of the buffer, each image at the top left of its padded canvas
+    sizes     (n, 2) width and height of each resized image in the canvas
+    scales    (n, 2) resize factor of each image along x and y. They differ slightly, as sizes are rounded.
+    boxes     (n, max_boxes, 5) float32 [x, y, w, h, class] scaled to the canvas, padded with -1. class is the
+              position of the category id among the sorted category ids.
+    image_ids (n,) COCO image ids
+    flipped   (n,) whether each image was flipped
+    status    'decoded', 'cached', 'missing' or 'damaged' for each image. Images that could not be read are left
+              black, with no boxes.
+
+    loader = CocoLoader('/data/open_images/train_faces.json', '/data/open_images/train_faces', batch_size=80,
+                        max_size=880, flip=True)
+    for batch in loader:  # one epoch
+        images = torch.from_numpy(batch.images).cuda(non_blocking=True)
+        ...
+    loader.close()
+
+A batch's buffer is reused once the next batch is requested, so copy what you need (e.g. to the GPU) first.
+
+For the validation set, which is read again every --val-iters, cache_bytes keeps decoded, resized images in an
+LRU cache bounded by size, so later passes only copy them into the buffers.
+
+loader.stats() tells whether the GPU waits on input: stall_seconds is the time spent waiting for a batch that
+was not ready, and ready_depth the mean number of decoded batches queued when one was requested (0 means
+input is the bottleneck; prefetch_batches means the workers keep up). With instrumentation on (see
+instrument), each epoch is also reported as stage 'loader'.
+"""
+
+import os
+import time
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+import numpy as np
+from PIL import Image
+from data_tools import instrument
+from data_tools.coco_index import load_index
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None  # Python < 3.8
+
+_buffers = {}  # buffer name: flat uint8 array, in the loader's process and inherited by forked workers
+
+
+class Batch(object):
+    """One batch from CocoLoader. See the module docstring for the fields."""
+
+    def __init__(self, images, sizes, scales, boxes, image_ids, flipped, rows, status):
+        self.images = images
+        self.sizes = sizes
+        self.scales = scales
+        self.boxes = boxes
+        self.image_ids = image_ids
+        self.flipped = flipped
+        self.rows = rows
+        self.status = status
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class DecodedCache(object):
+    """Least recently used cache of decoded images, bounded by the total bytes of the arrays. Thread safe."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, array, info):
+        if array.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[0].nbytes
+            self.entries[key] = (array, info)
+            self.nbytes += array.nbytes
+            while self.nbytes > self.max_bytes:
+                _, (evicted, _) = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+
+class CocoLoader(object):
+    """
+    Batches of a COCO dataset, decoded ahead on a worker pool. Iterating over the loader runs one epoch.
+    :param annotations: COCO annotation file (e.g. train_faces.json), or a CocoIndex
+    :param image_dir: Directory containing the images
+    :param batch_size: Images per batch
+    :param resize: Resize the shorter side of each image to this
+    :param max_size: ...unless that makes the longer side larger than this, which is then resized to max_size
+    :param stride: The canvas of the batch buffers is max_size rounded up to a multiple of stride
+    :param shuffle: Visit the images in a new random order every epoch, else in file order
+    :param flip: Flip each image (and its boxes) horizontally with probability 0.5, for training
+    :param drop_last: Leave out the last batch of an epoch if it is not full
+    :param seed: Random seed of the order and flips. Epoch e uses seed + e.
+    :param num_workers: Number of images decoded in parallel
+    :param use_processes: Decode on worker processes rather than threads. Threads are usually enough, as
+        decoding and resizing release the GIL. Needs Python 3.8 or later.
+    :param prefetch_batches: Number of batches decoded ahead of the one in use
+    :param cache_bytes: If set, keep up to this many bytes of decoded, resized images for later epochs
+    """
+
+    def __init__(self, annotations, image_dir, batch_size=80, resize=800, max_size=1333, stride=128,
+                 shuffle=True, flip=False, drop_last=False, seed=0, num_workers=8, use_processes=False,
+                 prefetch_batches=4, cache_bytes=0):
+        assert os.path.isdir(image_dir), "Directory %s does not exist" % image_dir
+        self.index = load_index(annotations, verbose=True)
+        self.image_dir = image_dir
+        self.batch_size = batch_size
+        self.resize = resize
+        self.max_size = max_size
+        self.shuffle = shuffle
+        self.flip = flip
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.canvas = int(np.ceil(max_size / float(stride)) * stride)
+        self.cache = DecodedCache(cache_bytes) if cache_bytes else None
+
+        index = self.index
+        self.file_paths = [os.path.join(image_dir, fn) for fn in index.file_names]
+        cat_ids = sorted(cat['id'] for cat in index.categories)
+        ann_rows = index.ann_image_rows
+        valid = ann_rows >= 0
+        counts = np.bincount(ann_rows[valid], minlength=index.num_images)
+        self.max_boxes = max(int(counts.max()) if len(counts) else 0, 1)
+        self.ann_boxes = index.bboxes.astype(np.float32)
+        self.ann_classes = np.searchsorted(np.asarray(cat_ids), np.asarray(index.ann_columns['category_id']))
+
+        self.num_slots = prefetch_batches + 1
+        self.slot_shape = (batch_size, self.canvas, self.canvas, 3)
+        slot_bytes = int(np.prod(self.slot_shape))
+        if shared_memory is not None:
+            self.shm = shared_memory.SharedMemory(create=True, size=slot_bytes * self.num_slots)
+            self.buffer_name = self.shm.name
+            flat = np.ndarray(slot_bytes * self.num_slots, dtype=np.uint8, buffer=self.shm.buf)
+        else:
+            if use_processes:
+                print("Shared memory needs Python 3.8, decoding on threads")
+                use_processes = False
+            self.shm = None
+            self.buffer_name = 'loader-%i' % id(self)
+            flat = np.zeros(slot_bytes * self.num_slots, dtype=np.uint8)
+        _buffers[self.buffer_name] = flat
+        self.buffers = flat.reshape((self.num_slots,) + self.slot_shape)
+        print("Allocated %i batch buffers of %.0f MB" % (self.num_slots, slot_bytes / 1e6))
+        if use_processes:
+            self.executor = ProcessPoolExecutor(max_workers=num_workers)
+            # Start all the workers before any thread of ours exists. Python 3.9 and 3.10 otherwise fork them as
+            # tasks come in; tasks that take a moment keep each submit from finding an idle worker.
+            wait([self.executor.submit(time.sleep, 0.05) for _ in range(num_workers)])
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.counters = {'batches': 0, 'images': 0, 'cache_hits': 0, 'missing': 0, 'damaged': 0, 'stalls': 0,
+                         'stall_seconds': 0.0, 'decode_seconds': 0.0, 'queue_depth': 0, 'ready_depth': 0}
+
+    def __len__(self):
+        """Number of batches per epoch"""
+        if self.drop_last:
+            return self.index.num_images // self.batch_size
+        return (self.index.num_images + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        rs = np.random.RandomState(self.seed + self.epoch)
+        self.epoch += 1
+        order = rs.permutation(self.index.num_images) if self.shuffle else np.arange(self.index.num_images)
+        flips = rs.rand(self.index.num_images) < 0.5 if self.flip else np.zeros(self.index.num_images, dtype=bool)
+        plan = [order[start:start + self.batch_size] for start in range(0, len(self) * self.batch_size,
+                                                                          self.batch_size)]
+        return self._epoch(plan, flips)
+
+    def _epoch(self, plan, flips):
+        free = queue.Queue()
+        for slot in range(self.num_slots):
+            free.put(slot)
+        submitted = queue.Queue()
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(plan, flips, free, submitted, stop), daemon=True)
+        producer.start()
+        slot = None
+        try:
+            with instrument.stage('loader', total=len(plan), unit='batches'):
+                for _ in range(len(plan)):
+                    if slot is not None:
+                        free.put(slot)
+                    slot, batch = self._next_batch(submitted)
+                    yield batch
+        finally:
+            # Stopped early: let the images in flight land before their buffers are used again
+            stop.set()
+            producer.join()
+            in_flight = []
+            while not submitted.empty():
+                entry = submitted.get()
+                if not isinstance(entry, Exception):
+                    in_flight.extend(ff for ff in entry[2] if ff is not None and not ff.cancel())
+            wait(in_flight)
+
+    def _produce(self, plan, flips, free, submitted, stop):
+        """
+        Fill free batch buffers, in the order of plan. Runs on a thread of its own. An exception (e.g. a broken
+        process pool) is put on the queue for the consumer to raise.
+        """
+        try:
+            self._fill_buffers(plan, flips, free, submitted, stop)
+        except Exception as e:
+            submitted.put(e)
+
+    def _fill_buffers(self, plan, flips, free, submitted, stop):
+        for rows in plan:
+            slot = None
+            while slot is None:
+                if stop.is_set():
+                    return
+                try:
+                    slot = free.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            futures = []
+            results = []
+            for ii, row in enumerate(rows.tolist()):
+                cached = self.cache.get(row) if self.cache is not None else None
+                if cached is not None:
+                    array, info = cached
+                    canvas = self.buffers[slot, ii]
+                    height, width = array.shape[:2]
+                    canvas[:height, :width] = array[:, ::-1] if flips[row] else array
+                    canvas[height:] = 0
+                    canvas[:height, width:] = 0
+                    futures.append(None)
+                    results.append(('cached',) + info + (0.0,))
+                else:
+                    offset = (slot * self.slot_shape[0] + ii) * int(np.prod(self.slot_shape[1:]))
+                    futures.append(self.executor.submit(_load_image, (
+                        self.buffer_name, offset, self.slot_shape[1:], self.file_paths[row], self.resize,
+                        self.max_size, bool(flips[row]))))
+                    results.append(None)
+            submitted.put((slot, rows, futures, results, flips[rows]))
+
+    def _next_batch(self, submitted):
+        queue_depth = submitted.qsize()
+        entries = list(submitted.queue)
+        ready_depth = sum(all(ff is None or ff.done() for ff in entry[2]) for entry in entries
+                          if not isinstance(entry, Exception))
+        start = time.perf_counter()
+        entry = submitted.get()
+        if isinstance(entry, Exception):
+            raise entry
+        slot, rows, futures, results, flipped = entry
+        for ii, future in enumerate(futures):
+            if future is not None:
+                results[ii] = future.result()
+        stall = time.perf_counter() - start
+        n = len(rows)
+
+        sizes = np.zeros((n, 2), dtype=np.int64)
+        scales = np.zeros((n, 2), dtype=np.float32)
+        boxes = np.full((n, self.max_boxes, 5), -1, dtype=np.float32)
+        status = []
+        decode_seconds = 0.0
+        cache_hits = 0
+        for ii, (row, result) in enumerate(zip(rows.tolist(), results)):
+            state, width, height, scale, seconds = result
+            status.append(state)
+            decode_seconds += seconds
+            if state in ('missing', 'damaged'):
+                self.counters[state] += 1
+                continue
+            cache_hits += state == 'cached'
+            sizes[ii] = width, height
+            scales[ii] = scale
+            ann_rows = self.index.ann_rows_at(row)
+            image_boxes = self.ann_boxes[ann_rows] * np.tile(scale, 2)
+            if flipped[ii]:
+                image_boxes[:, 0] = width - image_boxes[:, 0] - image_boxes[:, 2]
+            boxes[ii, :len(ann_rows), :4] = image_boxes
+            boxes[ii, :len(ann_rows), 4] = self.ann_classes[ann_rows]
+            if self.cache is not None and state == 'decoded':
+                array = self.buffers[slot, ii, :height, :width]
+                self.cache.put(row, np.ascontiguousarray(array[:, ::-1] if flipped[ii] else array),
+                               (width, height, scale))
+
+        counters = self.counters
+        counters['batches'] += 1
+        counters['images'] += n
+        counters['cache_hits'] += cache_hits
+        counters['decode_seconds'] += decode_seconds
+        counters['stall_seconds'] += stall
+        counters['stalls'] += stall > 0.001
+        counters['queue_depth'] += queue_depth
+        counters['ready_depth'] += ready_depth
+        instrument.count('loader', 'images', n)
+        instrument.count('loader', 'cache_hits', cache_hits)
+        instrument.count('loader', 'stall_ms', int(round(1000 * stall)))
+        instrument.count('loader', 'batches')
+        return slot, Batch(self.buffers[slot, :n], sizes, scales, boxes, self.index.image_ids[rows], flipped, rows,
+                           status)
+
+    def stats(self):
+        """
+        Counters since the loader was created, as a dict:
+            batches, images, cache_hits, missing, damaged
+            stalls, stall_seconds: batches that had to be waited for (over 1 ms), and the total wait
+            decode_seconds: worker time spent reading, decoding and resizing
+            queue_depth: mean number of batches submitted to the workers when one was requested
+            ready_depth: mean number of those already decoded
+            cache_mb, cached_images: size of the decoded image cache
+        """
+        stats = dict(self.counters)
+        batches = max(stats['batches'], 1)
+        stats['queue_depth'] = stats['queue_depth'] / float(batches)
+        stats['ready_depth'] = stats['ready_depth'] / float(batches)
+        if self.cache is not None:
+            stats['cache_mb'] = self.cache.nbytes / 1e6
+            stats['cached_images'] = len(self.cache)
+        return stats
+
+    def summary(self):
+        stats = self.stats()
+        return ("%i batches, %i images: waited %.2f s for %i batches, %.2f ready of %.2f queued on average, "
+                "%.1f s decoding, %i cache hits, %i missing, %i damaged" % (
+                    stats['batches'], stats['images'], stats['stall_seconds'], stats['stalls'],
+                    stats['ready_depth'], stats['queue_depth'], stats['decode_seconds'], stats['cache_hits'],
+                    stats['missing'], stats['damaged']))
+
+    def close(self):
+        """Stop the workers and free the batch buffers. Batches from this loader can't be used afterwards."""
+        self.executor.shutdown(wait=True)
+        self.buffers = None
+        _buffers.pop(self.buffer_name, None)
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def resize_scale(width, height, resize, max_size):
+    """Scale that makes the shorter side resize, unless the longer side would then exceed max_size"""
+    scale = resize / float(min(width, height))
+    if scale * max(width, height) > max_size:
+        scale = max_size / float(max(width, height))
+    return scale
+
+
+def _load_image(task):
+    """
+    Decode and resize one image into its canvas in the batch buffer. Runs on a worker.
+    :return: (status, width, height, (x scale, y scale), seconds)
+    """
+    buffer_name, offset, canvas_shape, filepath, resize, max_size, flip = task
+    start = time.perf_counter()
+    buffer = _buffers.get(buffer_name)
+    if buffer is None:
+        # A worker process started by spawn rather than fork: attach the buffer by name
+        shm = shared_memory.SharedMemory(name=buffer_name)
+        buffer = _buffers[buffer_name] = np.ndarray(shm.size, dtype=np.uint8, buffer=shm.buf)
+    canvas = np.ndarray(canvas_shape, dtype=np.uint8, buffer=buffer, offset=offset)
+    try:
+        image = Image.open(filepath)
+        width, height = image.size
+        scale = resize_scale(width, height, resize, max_size)
+        new_w = min(max(int(round(width * scale)), 1), canvas_shape[1])
+        new_h = min(max(int(round(height * scale)), 1), canvas_shape[0])
+        image.draft('RGB', (new_w, new_h))
+        image = image.convert('RGB')
+        if image.size != (new_w, new_h):
+            image = image.resize((new_w, new_h), Image.BILINEAR)
+        if flip:
+            image = image.transpose(Image.FLIP_LEFT_RIGHT)
+        pixels = np.asarray(image)
+    except FileNotFoundError:
+        canvas[:] = 0
+        return 'missing', 0, 0, (0.0, 0.0), time.perf_counter() - start
+    except (OSError, SyntaxError):
+        canvas[:] = 0
+        return 'damaged', 0, 0, (0.0, 0.0), time.perf_counter() - start
+    canvas[:new_h, :new_w] = pixels
+    canvas[new_h:] = 0
+    canvas[:new_h, new_w:] = 0
+    # The factors of the rounded size, so that boxes (and their mirror when flipped) match the pixels
+    return 'decoded', new_w, new_h, (new_w / float(width), new_h / float(height)), time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Measure how fast CocoLoader delivers batches of a dataset")
+    parser.add_argument('annotations', help="COCO annotation file")
+    parser.add_argument('image_dir', help="Directory containing the images")
+    parser.add_argument('--batch', type=int, default=80)
+    parser.add_argument('--resize', type=int, default=800)
+    parser.add_argument('--max-size', type=int, default=1333)
+    parser.add_argument('--epochs', type=int, default=1)
+    parser.add_argument('--batches', type=int, default=None, help="Stop each epoch after this many batches")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--processes', action='store_true', help="Decode on worker processes")
+    parser.add_argument('--prefetch', type=int, default=4, help="Batches decoded ahead")
+    parser.add_argument('--cache-mb', type=float, default=0, help="Size of the decoded image cache")
+    parser.add_argument('--step-ms', type=float, default=0,
+                        help="Simulated time the model takes per batch, to see whether the loader keeps up")
+    parser.add_argument('--no-shuffle', action='store_true')
+    args = parser.parse_args()
+    with CocoLoader(args.annotations, args.image_dir, batch_size=args.batch, resize=args.resize,
+                    max_size=args.max_size, shuffle=not args.no_shuffle, num_workers=args.workers,
+                    use_processes=args.processes, prefetch_batches=args.prefetch,
+                    cache_bytes=int(args.cache_mb * 1e6)) as loader:
+        for epoch in range(args.epochs):
+            epoch_start = time.time()
+            for num, batch in enumerate(loader):
+                if args.batches is not None and num + 1 >= args.batches:
+                    break
+                time.sleep(args.step_ms / 1000.0)
+            print("Epoch %i: %.1f s" % (epoch, time.time() - epoch_start))
+            print("  " + loader.summary())
@@ -0,0 +1,153 @@
+"""
+Materialize the images of a dataset into a training directory.
+
+Images can be hard linked, symlinked, reflinked (copy-on-write clones, on filesystems that support them) or
+copied. Work runs on a thread pool, the source directory of every file comes from a single listing of each
+source directory, and files that are already in place are skipped.
+"""
+
+import os
+import errno
+import shutil
+import fcntl
+from data_tools import instrument
+from data_tools.parallel import bounded_imap, Throughput
+
+MODES = ('hardlink', 'symlink', 'reflink', 'copy')
+_FICLONE = 0x40049409  # Linux ioctl: clone src_fd into dest_fd (btrfs, xfs with reflink=1, ...)
+
+
+def build_image_dir_index(img_dirs, filenames=None):
+    """
+    List each image directory once and map filename to the directory containing it.
+    If a file is in several directories, the first one in img_dirs wins.
+    Directories that don't exist are skipped with a message.
+    :param img_dirs: Directory or list of directories
+    :param filenames: If given, only index these filenames
+    :return: dict of filename: directory
+    """
+    if not type(img_dirs) == list:
+        img_dirs = [img_dirs]
+    wanted = set(filenames) if filenames is not None else None
+    filename2dir = {}
+    for img_d in img_dirs:
+        if not os.path.isdir(img_d):
+            print("Directory %s does not exist, skipping it" % img_d)
+            continue
+        with os.scandir(img_d) as it:
+            for entry in it:
+                if wanted is not None and entry.name not in wanted:
+                    continue
+                if entry.name not in filename2dir:
+                    filename2dir[entry.name] = img_d
+    return filename2dir
+
+
+@instrument.instrumented('materialize_images', unit='files')
+def materialize_images(filenames, source_dirs, dest_dir, mode='copy', num_workers=8):
+    """
+    Put each of filenames, found in source_dirs, into dest_dir.
+    :param filenames: Image filenames
+    :param source_dirs: Directory or list of directories containing the images
+    :param dest_dir: Output directory
+    :param mode: One of hardlink, symlink, reflink or copy. hardlink and reflink fall back to copy where
+        unsupported.
+    :param num_workers: Number of worker threads
+    :return: dict of counts per outcome (linked, copied, skipped, missing), 'bytes' moved and the 'missing' filenames
+    """
+    assert mode in MODES, "mode must be one of %s" % (MODES,)
+    assert os.path.isdir(dest_dir), "Directory %s does not exist" % dest_dir
+    filenames = list(dict.fromkeys(filenames))
+    instrument.set_total('materialize_images', len(filenames))
+    with instrument.timer('materialize_images', 'list_dirs'):
+        filename2dir = build_image_dir_index(source_dirs, filenames)
+
+    tasks = []
+    missing = []
+    for filename in filenames:
+        if filename in filename2dir:
+            tasks.append((os.path.join(filename2dir[filename], filename), os.path.join(dest_dir, filename), mode))
+        else:
+            missing.append(filename)
+
+    summary = {'linked': 0, 'copied': 0, 'skipped': 0, 'missing': len(missing), 'bytes': 0}
+    progress = Throughput(len(tasks), name="files")
+    instrument.count('materialize_images', 'missing', len(missing))
+    for status, nbytes in bounded_imap(_materialize_file, tasks, num_workers=num_workers):
+        summary[status] += 1
+        summary['bytes'] += nbytes
+        instrument.count('materialize_images', status)
+        instrument.count('materialize_images', 'bytes', nbytes)
+        instrument.count('materialize_images', 'files')
+        progress.update(nbytes=nbytes)
+    print("  " + progress.summary())
+    print("  %(linked)i linked, %(copied)i copied, %(skipped)i already in place, %(missing)i not found, "
+          "%(bytes)i bytes moved." % summary)
+    summary['missing'] = missing
+    return summary
+
+
+def _materialize_file(task):
+    """Runs on a worker. Returns (status, bytes moved)"""
+    src, dest, mode = task
+    src_stat = os.stat(src)
+    if _is_in_place(src, src_stat, dest, mode):
+        return 'skipped', 0
+    tmp = dest + '.tmp%i' % os.getpid()
+    if os.path.lexists(tmp):
+        # Left by an interrupted run whose pid was the same
+        os.remove(tmp)
+    with instrument.timer('materialize_images', mode):
+        if mode == 'hardlink' and _hardlink(src, tmp):
+            status, nbytes = 'linked', 0
+        elif mode == 'symlink':
+            os.symlink(os.path.abspath(src), tmp)
+            status, nbytes = 'linked', 0
+        elif mode == 'reflink' and _reflink(src, tmp):
+            shutil.copystat(src, tmp)
+            status, nbytes = 'linked', 0
+        else:
+            shutil.copy2(src, tmp)
+            status, nbytes = 'copied', src_stat.st_size
+    os.replace(tmp, dest)
+    return status, nbytes
+
+
+def _is_in_place(src, src_stat, dest, mode):
+    """True if dest already holds src, as it would be after materializing with mode"""
+    try:
+        dest_stat = os.lstat(dest)
+    except FileNotFoundError:
+        return False
+    if mode == 'symlink':
+        return os.path.islink(dest) and os.readlink(dest) == os.path.abspath(src)
+    if mode == 'hardlink' and dest_stat.st_dev == src_stat.st_dev:
+        return dest_stat.st_ino == src_stat.st_ino
+    return (not os.path.islink(dest) and dest_stat.st_size == src_stat.st_size
+            and int(dest_stat.st_mtime) == int(src_stat.st_mtime))
+
+
+def _hardlink(src, dest):
+    """
+    Hard link src to dest. Returns False if that can't be done: src and dest are on different filesystems, the
+    filesystem doesn't allow hard links, or src has the maximum number of links.
+    """
+    try:
+        os.link(src, dest)
+        return True
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+    return False
+
+
+def _reflink(src, dest):
+    """Clone src to dest. Returns False (leaving no dest) if the filesystem does not support it."""
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), _FICLONE, fsrc.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(dest)
+    return False
@@ -0,0 +1,72 @@
+"""
+Helpers for running per-image work on a worker pool
+"""
+
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+def bounded_imap(fn, items, num_workers=8, max_pending=None, use_processes=False, ordered=False):
+    """
+    Apply fn to each item on a worker pool, yielding results in completion order.
+    At most max_pending tasks are queued at once, so items can be a generator over a huge dataset and
+    results are consumed as they are produced rather than held in memory.
+    :param fn: Function of one argument. Must be picklable if use_processes is True.
+    :param items: Iterable of arguments
+    :param num_workers: Number of worker threads (or processes)
+    :param max_pending: Maximum number of submitted but unfinished tasks. Defaults to 4 * num_workers.
+    :param use_processes: Use a process pool rather than a thread pool
+    :param ordered: Yield results in the order of items rather than in completion order
+    :return: generator of fn(item)
+    """
+    if max_pending is None:
+        max_pending = 4 * num_workers
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=num_workers) as executor:
+        if ordered:
+            pending = deque()
+            for item in items:
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(fn, item))
+            while pending:
+                yield pending.popleft().result()
+            return
+        pending = set()
+        for item in items:
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(fn, item))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+class Throughput(object):
+    """Counts items and bytes, printing progress with items/s and MB/s every report_every seconds"""
+
+    def __init__(self, total, name="images", report_every=10.0):
+        self.total = total
+        self.name = name
+        self.report_every = report_every
+        self.items = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.last_report = self.start
+
+    def update(self, items=1, nbytes=0):
+        self.items += items
+        self.bytes += nbytes
+        now = time.time()
+        if now - self.last_report >= self.report_every:
+            self.last_report = now
+            print("  " + self.summary())
+
+    def summary(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        return "Processed %i of %i %s in %.1f s (%.1f %s/s, %.1f MB/s)" % (
+            self.items, self.total, self.name, elapsed, self.items / elapsed, self.name, self.bytes / elapsed / 1e6)
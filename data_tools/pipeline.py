@@ -0,0 +1,500 @@
+"""
+Incremental runner for the data preparation chain of DATA_README.md.
+
+A Pipeline is a set of named stages. Each stage is a function called as fn(output_dir, **params) that writes its
+results into output_dir. Params can refer to external files or directories with Input(path), and to the results
+of other stages with Output(stage, name), which also makes the stage depend on that stage.
+
+Every stage has a key: a hash of its function (name, source and an optional version string), its params, the
+contents of its Input paths and the keys of the stages it depends on. The stage writes into
+cache_dir/stages/<name>/<key>, and a stage whose directory for the current key exists is up to date. Changing
+a parameter therefore only reruns that stage and the stages after it, and switching back to earlier parameters
+finds their results still in the cache. Stages that don't depend on each other run concurrently.
+
+Input files are hashed by content (the digests are kept in cache_dir/fingerprints.json, keyed by size and
+mtime, so unchanged files are not read again). Input directories are hashed by their listing: the name, size
+and mtime of every file. The listing is only redone when the mtime of one of the directories changes, so files
+changed in place without being renamed go unnoticed. Input(path, version=...) keys a path by a label instead.
+
+open_images_pipeline builds the chain of DATA_README.md: parse_open_images, reduce_data and openimages2coco for
+the validation and train annotations, an optional split of the train set, then copy_images and resize for each
+dataset.
+
+    pipeline = open_images_pipeline('/data/open_images', '/data/open_images/pipeline', resize_factor=0.5)
+    pipeline.run()
+    pipeline.output('resize_train', 'annotations.json')
+
+cache_dir/<stage name> is a symlink to the output of the last run of each stage.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import inspect
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from data_tools.coco_tools import split_dataset, resize
+from open_images.columnar import OpenImagesTable
+from open_images.open_image_to_json import parse_open_images, reduce_data, read_catMIDtoname, openimages2coco, \
+    copy_images
+
+MANIFEST = 'stage.json'
+
+
+class Input(object):
+    """
+    A file or directory a stage reads. Resolves to path; its contents are part of the stage key.
+    :param version: If set, the stage key uses this label instead of the contents of path. Change it when the
+        contents change, e.g. to pin a large image directory that other files get written into.
+    """
+
+    def __init__(self, path, version=None):
+        self.path = os.path.abspath(path)
+        self.version = version
+
+    def __repr__(self):
+        if self.version is not None:
+            return "Input(%r, version=%r)" % (self.path, self.version)
+        return "Input(%r)" % self.path
+
+
+class Output(object):
+    """A file (or, with name='', the directory) written by another stage. Resolves to its path."""
+
+    def __init__(self, stage, name=''):
+        self.stage = stage
+        self.name = name
+
+    def __repr__(self):
+        return "Output(%r, %r)" % (self.stage, self.name)
+
+
+class Stage(object):
+    def __init__(self, name, fn, params, version=None):
+        self.name = name
+        self.fn = fn
+        self.params = params
+        self.version = version
+        self.deps = sorted(set(ref.stage for ref in _references(params, Output)))
+
+
+class Pipeline(object):
+    """
+    Stages with cached outputs, see the module docstring.
+    :param cache_dir: Directory holding the output of every stage
+    :param max_parallel: Maximum number of stages run at once
+    """
+
+    def __init__(self, cache_dir, max_parallel=2):
+        assert os.path.isdir(cache_dir), "Directory %s does not exist" % cache_dir
+        self.cache_dir = cache_dir
+        self.max_parallel = max_parallel
+        self.stages = {}
+        self.fingerprints = Fingerprints(os.path.join(cache_dir, 'fingerprints.json'))
+
+    def add(self, name, fn, params=None, version=None):
+        """
+        Add a stage.
+        :param name: Stage name, also used as a directory name
+        :param fn: Called as fn(output_dir, **params)
+        :param params: dict of keyword arguments. Values must be JSON serializable, Input or Output, or lists,
+            tuples and dicts of these.
+        :param version: Change this to rerun the stage when something the key can't see has changed, e.g. a
+            function that fn calls
+        :return: Stage
+        """
+        assert name not in self.stages, "Stage %s already exists" % name
+        stage = Stage(name, fn, dict(params or {}), version)
+        self.stages[name] = stage
+        return stage
+
+    def keys(self, targets=None):
+        """Key of each stage needed for targets (default: all stages), as a dict of name: key"""
+        keys = {}
+        for name in self._order(targets):
+            stage = self.stages[name]
+            description = {
+                'name': name,
+                'fn': _function_id(stage.fn),
+                'version': stage.version,
+                'params': _resolve(stage.params, self._input_id,
+                                   lambda ref: {'output': keys[ref.stage], 'name': ref.name}),
+            }
+            encoded = json.dumps(description, sort_keys=True, default=repr).encode('utf-8')
+            keys[name] = hashlib.blake2b(encoded, digest_size=10).hexdigest()
+        self.fingerprints.save()
+        return keys
+
+    def _input_id(self, ref):
+        if ref.version is not None:
+            return {'input_version': ref.version}
+        return {'input': self.fingerprints.digest(ref.path)}
+
+    def stage_dir(self, name, key):
+        return os.path.join(self.cache_dir, 'stages', name, key)
+
+    def output(self, stage, name='', keys=None):
+        """Path of a file written by stage (or its directory, if name is ''), for the current key"""
+        if keys is None:
+            keys = self.keys([stage])
+        return os.path.join(self.stage_dir(stage, keys[stage]), name)
+
+    def status(self, targets=None):
+        """List of (stage name, key, up to date) in the order the stages would run"""
+        keys = self.keys(targets)
+        return [(name, key, os.path.isfile(os.path.join(self.stage_dir(name, key), MANIFEST)))
+                for name, key in keys.items()]
+
+    def run(self, targets=None, force=()):
+        """
+        Run the stages needed for targets (default: all stages) that are not up to date.
+        :param targets: Stage names. Their dependencies are included.
+        :param force: Names of stages to run even if they are up to date
+        :return: dict of stage name: output directory
+        """
+        keys = self.keys(targets)
+        todo = {}
+        for name, key in keys.items():
+            if name not in force and os.path.isfile(os.path.join(self.stage_dir(name, key), MANIFEST)):
+                print("Stage %s: up to date (%s)" % (name, key))
+                self._link(name, key)
+            else:
+                todo[name] = key
+        start = time.time()
+        running = {}
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            while todo or running:
+                # Start every stage whose dependencies are done, unless a stage has failed
+                ready = [name for name in todo if not failed and not any(dep in todo or dep in running.values()
+                                                                         for dep in self.stages[name].deps)]
+                for name in ready[:self.max_parallel - len(running)]:
+                    running[executor.submit(self._run_stage, name, keys)] = name
+                    del todo[name]
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as exc:
+                        print("Stage %s failed: %r" % (name, exc))
+                        failed.append((name, exc))
+        if failed:
+            raise RuntimeError("Stage %s failed, %i stages not run" % (failed[0][0], len(todo))) from failed[0][1]
+        print("Pipeline done in %.1f s" % (time.time() - start))
+        return {name: self.stage_dir(name, key) for name, key in keys.items()}
+
+    def clean(self):
+        """Delete the cached outputs of every stage that don't belong to its current key"""
+        keys = self.keys()
+        stages_dir = os.path.join(self.cache_dir, 'stages')
+        if not os.path.isdir(stages_dir):
+            return
+        for name in sorted(os.listdir(stages_dir)):
+            for key in sorted(os.listdir(os.path.join(stages_dir, name))):
+                if keys.get(name) != key:
+                    print("Removing %s/%s" % (name, key))
+                    shutil.rmtree(os.path.join(stages_dir, name, key))
+
+    def _order(self, targets):
+        """Names of the stages needed for targets, dependencies first"""
+        order = []
+        visiting = set()
+
+        def visit(name):
+            assert name in self.stages, "Unknown stage %s" % name
+            if name in order:
+                return
+            assert name not in visiting, "Stage %s depends on itself" % name
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                visit(dep)
+            order.append(name)
+
+        for name in (self.stages if targets is None else targets):
+            visit(name)
+        return order
+
+    def _run_stage(self, name, keys):
+        """Run one stage into a temporary directory, then move it into place. Runs on a worker thread."""
+        stage = self.stages[name]
+        output_dir = self.stage_dir(name, keys[name])
+        tmp_dir = output_dir + '.tmp'
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        params = _resolve(stage.params, lambda ref: ref.path,
+                          lambda ref: os.path.join(self.stage_dir(ref.stage, keys[ref.stage]), ref.name))
+        print("Stage %s: running (%s)" % (name, keys[name]))
+        start = time.time()
+        stage.fn(tmp_dir, **params)
+        elapsed = time.time() - start
+        with open(os.path.join(tmp_dir, MANIFEST), 'w') as f:
+            json.dump({'name': name, 'key': keys[name], 'fn': _function_id(stage.fn)[:2], 'version': stage.version,
+                       'params': _resolve(stage.params, repr, repr), 'seconds': elapsed}, f, indent=1, default=repr)
+        if os.path.isdir(output_dir):
+            # Forced rerun
+            shutil.rmtree(output_dir)
+        os.replace(tmp_dir, output_dir)
+        self._link(name, keys[name])
+        print("Stage %s: done in %.1f s" % (name, elapsed))
+
+    def _link(self, name, key):
+        """Point the cache_dir/<name> symlink at the output of key"""
+        link = os.path.join(self.cache_dir, name)
+        tmp_link = link + '.tmp'
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(os.path.join('stages', name, key), tmp_link)
+        os.replace(tmp_link, link)
+
+
+class Fingerprints(object):
+    """
+    Digests of Input paths, kept in a JSON file of {path: entry}. A file entry is [mtime_ns, size, digest] and is
+    only recomputed when the file's mtime or size changes. A directory entry is [{subdirectory: mtime_ns}, digest],
+    holding the mtime of every directory of the tree, and is only recomputed when one of these changes, i.e. when
+    files are added, removed or renamed. Checking it takes one stat per directory rather than one per file.
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.entries = {}
+        self.modified = False
+        if os.path.isfile(cache_file):
+            with open(cache_file) as f:
+                self.entries = json.load(f)
+
+    def digest(self, path):
+        if os.path.isdir(path):
+            return self._dir_digest(path)
+        st = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2]
+        hasher = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 22), b''):
+                hasher.update(block)
+        self.entries[path] = [st.st_mtime_ns, st.st_size, hasher.hexdigest()]
+        self.modified = True
+        return self.entries[path][2]
+
+    def save(self):
+        if not self.modified:
+            return
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_file, self.cache_file)
+        self.modified = False
+
+    def _dir_digest(self, path):
+        entry = self.entries.get(path)
+        if entry is not None and len(entry) == 2 and _dir_mtimes_match(path, entry[0]):
+            return entry[1]
+        dir_mtimes = {}
+        listing = []
+        _list_tree(path, '', dir_mtimes, listing)
+        digest = hashlib.blake2b(''.join(listing).encode('utf-8'), digest_size=16).hexdigest()
+        self.entries[path] = [dir_mtimes, digest]
+        self.modified = True
+        return digest
+
+
+def _dir_mtimes_match(path, dir_mtimes):
+    """True if every directory of dir_mtimes ({path relative to path: mtime_ns}) still has that mtime"""
+    for rel_dir, mtime_ns in dir_mtimes.items():
+        try:
+            if os.stat(os.path.join(path, rel_dir)).st_mtime_ns != mtime_ns:
+                return False
+        except FileNotFoundError:
+            return False
+    return True
+
+
+def _list_tree(root, rel_dir, dir_mtimes, listing):
+    """Add the mtime of root/rel_dir and of its subdirectories to dir_mtimes, and a "name, size, mtime" line for
+    every file below it to listing"""
+    full_dir = os.path.join(root, rel_dir)
+    # Before listing, so that a file added while listing changes the mtime after it
+    dir_mtimes[rel_dir] = os.stat(full_dir).st_mtime_ns
+    with os.scandir(full_dir) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        rel_path = os.path.join(rel_dir, entry.name)
+        if entry.is_dir(follow_symlinks=False):
+            _list_tree(root, rel_path, dir_mtimes, listing)
+        else:
+            st = entry.stat()
+            listing.append("%s\t%i\t%i\n" % (rel_path, st.st_size, st.st_mtime_ns))
+
+
+def open_images_pipeline(data_dir, cache_dir, keep_classes=('Human face',), output_class_ids=None, max_size=880,
+                         min_ann_size=(1, 1), min_ratio=2.0, holdout=None, salt="", resize_factor=None,
+                         copy_mode='hardlink', num_workers=16, max_parallel=2, images_version=None):
+    """
+    The DATA_README.md chain as a Pipeline. The validation and train branches are independent and run concurrently.
+    Stages, for each of validation and train:
+        parse_<split>     parse_open_images(columnar=True), saved as an OpenImagesTable
+        reduce_<split>    reduce_data(keep_classes)
+        coco_<split>      openimages2coco, writes annotations.json
+    If holdout is set, split_train splits the train annotations into train.json and holdout.json. Then for each
+    dataset (validation, train and holdout):
+        copy_<dataset>    copy_images from the Open Images directories, writes images/
+        resize_<dataset>  If resize_factor is set: resize, writes images/ and annotations.json
+    :param data_dir: Directory containing the Open Images CSVs and image directories (see DATA_README.md)
+    :param cache_dir: Directory holding the output of every stage
+    :param keep_classes, output_class_ids: See reduce_data and openimages2coco. output_class_ids defaults to
+        numbering keep_classes from 1.
+    :param max_size, min_ann_size, min_ratio: See openimages2coco
+    :param holdout: Fraction of the train images split off into a holdout set, see split_dataset
+    :param salt: See split_dataset
+    :param resize_factor: See resize
+    :param copy_mode: See copy_images. The default hardlinks the images, so the copies take no space.
+    :param num_workers: Number of worker threads used within each stage
+    :param max_parallel: Maximum number of stages run at once
+    :param images_version: If set, the image directories are keyed by this label rather than by their listing,
+        see Input
+    :return: Pipeline
+    """
+    if output_class_ids is None:
+        output_class_ids = {name: ii + 1 for ii, name in enumerate(keep_classes)}
+    pipeline = Pipeline(cache_dir, max_parallel=max_parallel)
+    category_csv = Input(os.path.join(data_dir, 'class-descriptions-boxable.csv'))
+    splits = [('validation', 'validation-annotations-bbox.csv', ['validation']),
+              ('train', 'train-annotations-bbox.csv', ['train_0%i' % oo for oo in range(9)])]
+    datasets = []
+    for split, csv_name, image_dirs in splits:
+        image_dirs = [Input(os.path.join(data_dir, dd), version=images_version) for dd in image_dirs]
+        pipeline.add('parse_' + split, _parse_stage, {'annotation_csv': Input(os.path.join(data_dir, csv_name))})
+        pipeline.add('reduce_' + split, _reduce_stage,
+                     {'table': Output('parse_' + split, 'table.npz'), 'category_csv': category_csv,
+                      'keep_classes': list(keep_classes)})
+        pipeline.add('coco_' + split, _coco_stage,
+                     {'table': Output('reduce_' + split, 'table.npz'), 'category_csv': category_csv,
+                      'images_dir': image_dirs, 'desc': "Open Image %s data." % split,
+                      'output_class_ids': output_class_ids, 'max_size': max_size, 'min_ann_size': min_ann_size,
+                      'min_ratio': min_ratio, 'num_workers': num_workers,
+                      'size_cache': os.path.join(os.path.abspath(cache_dir), split + '_image_sizes.json')})
+        if split == 'train' and holdout:
+            pipeline.add('split_train', _split_stage, {'annotations': Output('coco_train', 'annotations.json'),
+                                                       'holdout': holdout, 'salt': salt})
+            datasets.append(('train', Output('split_train', 'train.json'), image_dirs))
+            datasets.append(('holdout', Output('split_train', 'holdout.json'), image_dirs))
+        else:
+            datasets.append((split, Output('coco_' + split, 'annotations.json'), image_dirs))
+
+    # copy_images comes before resize, since resize reads the images from a single directory
+    for name, annotations, image_dirs in datasets:
+        pipeline.add('copy_' + name, _copy_stage, {'annotations': annotations, 'image_dirs': image_dirs,
+                                                   'mode': copy_mode, 'num_workers': num_workers})
+        if resize_factor is not None:
+            pipeline.add('resize_' + name, _resize_stage,
+                         {'annotations': annotations, 'images': Output('copy_' + name, 'images'),
+                          'resize_factor': resize_factor, 'num_workers': num_workers})
+    return pipeline
+
+
+def _parse_stage(output_dir, annotation_csv):
+    parse_open_images(annotation_csv, columnar=True).save(os.path.join(output_dir, 'table.npz'))
+
+
+def _reduce_stage(output_dir, table, category_csv, keep_classes):
+    reduced = reduce_data(OpenImagesTable.load(table), read_catMIDtoname(category_csv), keep_classes=keep_classes)
+    reduced.save(os.path.join(output_dir, 'table.npz'))
+
+
+def _coco_stage(output_dir, table, category_csv, images_dir, **kwargs):
+    openimages2coco(OpenImagesTable.load(table), read_catMIDtoname(category_csv), images_dir,
+                    output_json=os.path.join(output_dir, 'annotations.json'), **kwargs)
+
+
+def _split_stage(output_dir, annotations, holdout, salt):
+    split_dataset(annotations, 1 - holdout, os.path.join(output_dir, 'train.json'),
+                  os.path.join(output_dir, 'holdout.json'), salt=salt)
+
+
+def _copy_stage(output_dir, annotations, image_dirs, mode, num_workers):
+    os.makedirs(os.path.join(output_dir, 'images'))
+    summary = copy_images(annotations, image_dirs, os.path.join(output_dir, 'images'), mode=mode,
+                          num_workers=num_workers)
+    if summary['missing']:
+        raise FileNotFoundError("%i images not found, e.g. %s" % (len(summary['missing']), summary['missing'][0]))
+
+
+def _resize_stage(output_dir, annotations, images, resize_factor, num_workers):
+    os.makedirs(os.path.join(output_dir, 'images'))
+    resize(images, annotations, resize_factor, os.path.join(output_dir, 'images'),
+           os.path.join(output_dir, 'annotations.json'), num_workers=num_workers)
+
+
+def _references(value, cls):
+    """All instances of cls in a (nested) param value"""
+    if isinstance(value, cls):
+        return [value]
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return [ref for vv in value for ref in _references(vv, cls)]
+    return []
+
+
+def _resolve(value, on_input, on_output):
+    """Copy of a (nested) param value with Input and Output replaced by on_input(ref) and on_output(ref)"""
+    if isinstance(value, Input):
+        return on_input(value)
+    if isinstance(value, Output):
+        return on_output(value)
+    if isinstance(value, dict):
+        return {kk: _resolve(vv, on_input, on_output) for kk, vv in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_resolve(vv, on_input, on_output) for vv in value)
+    return value
+
+
+def _function_id(fn):
+    """(module, qualified name, source digest) of a function. The source is hashed so that editing it reruns."""
+    try:
+        source = inspect.getsource(fn)
+    except (OSError, TypeError):
+        source = ''
+    return (getattr(fn, '__module__', ''), getattr(fn, '__qualname__', repr(fn)),
+            hashlib.blake2b(source.encode('utf-8'), digest_size=8).hexdigest())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the Open Images to COCO preparation, rerunning only the "
+                                                 "stages whose inputs or parameters changed.")
+    parser.add_argument('data_dir', help="Directory containing the Open Images CSVs and image directories")
+    parser.add_argument('cache_dir', help="Directory holding the output of every stage")
+    parser.add_argument('--max-size', type=int, default=880)
+    parser.add_argument('--min-ann-size', type=float, nargs=2, default=(1, 1))
+    parser.add_argument('--min-ratio', type=float, default=2.0)
+    parser.add_argument('--holdout', type=float, default=None, help="Fraction of train images split off")
+    parser.add_argument('--resize', type=float, default=None, help="Resize factor of the images")
+    parser.add_argument('--copy-mode', default='hardlink', help="copy, hardlink, symlink or reflink")
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--parallel', type=int, default=2, help="Maximum number of stages run at once")
+    parser.add_argument('--status', action='store_true', help="Only print which stages are up to date")
+    parser.add_argument('--clean', action='store_true', help="Delete outputs of earlier parameters")
+    parser.add_argument('--images-version', default=None,
+                        help="Key the image directories by this label instead of listing them")
+    args = parser.parse_args()
+
+    pipeline = open_images_pipeline(args.data_dir, args.cache_dir, max_size=args.max_size,
+                                    min_ann_size=tuple(args.min_ann_size), min_ratio=args.min_ratio,
+                                    holdout=args.holdout, resize_factor=args.resize, copy_mode=args.copy_mode,
+                                    num_workers=args.workers, max_parallel=args.parallel,
+                                    images_version=args.images_version)
+    if args.status:
+        for stage_name, stage_key, fresh in pipeline.status():
+            print("%-20s %s %s" % (stage_name, stage_key, 'up to date' if fresh else 'stale'))
+    else:
+        pipeline.run()
+        if args.clean:
+            pipeline.clean()
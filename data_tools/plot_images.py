@@ -1,59 +1,145 @@
 from PIL import Image, ImageDraw, ImageFont
 import os
-from data_tools.coco_tools import read_json
+import numpy as np
+from data_tools import instrument
+from data_tools.coco_index import load_index
+from data_tools.parallel import bounded_imap
 
-def draw_boxes(image_dir, output_dir, anns):
+BOX_COLOR = (53, 111, 19)
+
+
+@instrument.instrumented('draw_boxes', unit='images')
+def draw_boxes(image_dir, output_dir, anns, num_workers=8, max_size=None, sample=None, seed=0, categories=None,
+               min_box_size=None, max_box_size=None, contact_sheet=None):
     """
     Plot GT boxes
+    :param anns: COCO annotation file, or a CocoIndex
+    :param num_workers: Number of images drawn in parallel
+    :param max_size: If set, draw previews no larger than max_size in either dimension. JPEGs are decoded
+        directly at reduced resolution.
+    :param sample, seed, categories, min_box_size, max_box_size: Only plot some images, see select_images
+    :param contact_sheet: (columns, rows). If set, tile the images (max_size defaults to 256) into contact
+        sheets contact_sheet_0000.jpg, ... rather than saving one file per image. contact_sheet_0000.txt lists
+        the images of each sheet, row by row.
     """
 
     # Read annotations
-    annotations=read_json(anns)
+    index = load_index(anns)
 
     # Get info we need
-    catid2name = {}
-    for cat in annotations['categories']:
-        catid2name[cat['id']] = cat['name']
+    catid2name = index.catid2name()
+    rows = select_images(index, sample=sample, seed=seed, categories=categories, min_box_size=min_box_size,
+                         max_box_size=max_box_size)
+    instrument.set_total('draw_boxes', len(rows))
+    if contact_sheet is not None and max_size is None:
+        max_size = 256
+    category_ids = np.asarray(index.ann_columns['category_id'])
+    file_names = [index.file_names[row] for row in rows.tolist()]
+
+    def tasks():
+        for row in rows.tolist():
+            ann_rows = index.ann_rows_at(row)
+            file_name = index.file_names[row]
+            labels = [catid2name[catid] for catid in category_ids[ann_rows].tolist()]
+            if contact_sheet is None:
+                filename_root, filename_ext = os.path.splitext(file_name)
+                output_path = os.path.join(output_dir, filename_root + "_detections" + filename_ext)
+            else:
+                output_path = None
+            yield os.path.join(image_dir, file_name), output_path, index.bboxes[ann_rows].tolist(), labels, max_size
+
+    # Now work through the selected images and create images.
+    done = 0
+    sheet = []
+    num_sheets = 0
+    for image in bounded_imap(_draw_image, tasks(), num_workers=num_workers, ordered=contact_sheet is not None):
+        done += 1
+        instrument.count('draw_boxes', 'images')
+        if contact_sheet is not None:
+            sheet.append(image)
+            if len(sheet) == contact_sheet[0] * contact_sheet[1]:
+                _save_contact_sheet(sheet, file_names[done - len(sheet):done], contact_sheet, max_size, output_dir,
+                                    num_sheets)
+                num_sheets += 1
+                sheet = []
+        if done % 25 == 0:
+            print("  Saved {} of {} images.".format(done, len(rows)),)
+    if sheet:
+        _save_contact_sheet(sheet, file_names[done - len(sheet):done], contact_sheet, max_size, output_dir,
+                            num_sheets)
+        num_sheets += 1
+    print("  Saved {} of {} images.".format(done, len(rows)), )
+    if contact_sheet is not None:
+        print("  Wrote {} contact sheets.".format(num_sheets))
 
 
-    imageid2filename = {}
-    for ann in annotations['images']:
-        imageid2filename[ann['id']] = ann['file_name']
+def select_images(index, sample=None, seed=0, categories=None, min_box_size=None, max_box_size=None):
+    """
+    Choose images to plot.
+    :param index: CocoIndex
+    :param sample: Number of images to pick at random from those matching. Defaults to all.
+    :param seed: Seed of the random sample
+    :param categories: Only images with a box of one of these category ids
+    :param min_box_size: Only images with a box at least this large (square root of the box area, in pixels)
+    :param max_box_size: Only images with a box at most this large
+    :return: Array of image rows, in file order
+    """
+    if categories is None and min_box_size is None and max_box_size is None:
+        rows = np.arange(index.num_images)
+    else:
+        match = np.ones(index.num_annotations, dtype=bool)
+        if categories is not None:
+            match &= np.isin(np.asarray(index.ann_columns['category_id']), list(categories))
+        box_size = np.sqrt(index.bboxes[:, 2].astype(np.float64) * index.bboxes[:, 3])
+        if min_box_size is not None:
+            match &= box_size >= min_box_size
+        if max_box_size is not None:
+            match &= box_size <= max_box_size
+        image_rows = index.ann_image_rows[match]
+        rows = np.unique(image_rows[image_rows >= 0])
+    if sample is not None and sample < len(rows):
+        rows = np.sort(np.random.RandomState(seed).choice(rows, sample, replace=False))
+    return rows
+
 
-    imageid2annboxes = {} # [(bbox, catid)]
-    for ann in annotations['annotations']:
-        this_entry = (ann['bbox'], ann['category_id'])
-        if ann['image_id'] not in imageid2annboxes:
-            imageid2annboxes[ann['image_id']] = [this_entry]
+def _draw_image(task):
+    """Draw the boxes of one image. Runs on a worker. Saves the image to output_path, or returns it if None."""
+    filepath, output_path, bboxes, labels, max_size = task
+    with instrument.timer('draw_boxes', 'decode'):
+        image = Image.open(filepath)
+        scale = 1.0
+        if max_size is not None:
+            full_size = image.size
+            image.draft('RGB', (max_size, max_size))
+            image = image.convert("RGB")
+            image.thumbnail((max_size, max_size), Image.BILINEAR)
+            scale = image.size[0] / float(full_size[0])
         else:
-            imageid2annboxes[ann['image_id']].append(this_entry)
-
-    # Now work through image IDs (imageid2filename.keys()) and create images.
-    for done, imageid in enumerate(imageid2filename):
-        filepath = os.path.join(image_dir, imageid2filename[imageid])
-        image = Image.open(filepath).convert("RGB")
-        # image = Image.open(filepath)
-        draw = ImageDraw.Draw(image)
-        # Add GT bounding boxes.
-        anns = []
-        try:
-            anns = imageid2annboxes[imageid]
-        except KeyError:
-            pass
-        for bbox, catid in anns:
-            [xmin, ymin, w, h] = bbox
-            xmax = int(round(xmin + w))
-            ymax = int(round(ymin + h))
-            draw.line([(xmin, ymin), (xmin, ymax), (xmax, ymax), (xmax, ymin), (xmin, ymin)],
-                      fill=(53, 111, 19), width=4)
-            draw.text((xmin + 3, ymin - 18), catid2name[catid], (53, 111, 19))
-
-
-        filename_root, filename_ext = os.path.splitext(imageid2filename[imageid])
-        output_path = os.path.join(output_dir, filename_root + "_detections" + filename_ext)
+            image = image.convert("RGB")
+    draw = ImageDraw.Draw(image)
+    line_width = 4 if max_size is None else 2
+    # Add GT bounding boxes.
+    for bbox, label in zip(bboxes, labels):
+        [xmin, ymin, w, h] = [vv * scale for vv in bbox]
+        xmax = int(round(xmin + w))
+        ymax = int(round(ymin + h))
+        draw.line([(xmin, ymin), (xmin, ymax), (xmax, ymax), (xmax, ymin), (xmin, ymin)],
+                  fill=BOX_COLOR, width=line_width)
+        if max_size is None:
+            draw.text((xmin + 3, ymin - 18), label, BOX_COLOR)
+    if output_path is None:
+        return image
+    with instrument.timer('draw_boxes', 'save'):
         image.save(output_path)
-        if (done + 1) % 25 == 0 and done > 0:
-            print("  Saved {} of {} images.".format(done + 1, len(imageid2filename)),)
-    print("  Saved {} of {} images.".format(done + 1, len(imageid2filename)), )
 
 
+def _save_contact_sheet(images, file_names, grid, tile_size, output_dir, number):
+    columns, rows = grid
+    sheet = Image.new("RGB", (columns * tile_size, rows * tile_size))
+    for ii, image in enumerate(images):
+        x = (ii % columns) * tile_size + (tile_size - image.size[0]) // 2
+        y = (ii // columns) * tile_size + (tile_size - image.size[1]) // 2
+        sheet.paste(image, (x, y))
+    sheet.save(os.path.join(output_dir, "contact_sheet_%04i.jpg" % number), quality=90)
+    with open(os.path.join(output_dir, "contact_sheet_%04i.txt" % number), 'w') as f:
+        f.write("".join(file_name + "\n" for file_name in file_names))
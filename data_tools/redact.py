@@ -0,0 +1,221 @@
+"""
+Redact regions of still images on the CPU.
+
+Each box is filled with a solid colour (what the app's OSD draws: a black patch over each face), pixelated, or
+blurred. The regions are processed as NumPy array slices: pixelation averages blocks with np.add.reduceat,
+and blurring is a box blur computed from cumulative sums, so the cost per box does not depend on the blur
+radius. Images are decoded, redacted and written on a worker pool, and results are written as they finish.
+
+Boxes come from COCO annotations (one image per annotation file image) or from the KITTI output of the app
+(frame n of a stream is the n'th image of a list of images).
+"""
+
+import os
+import numpy as np
+from PIL import Image
+from data_tools.coco_index import load_index
+from data_tools.kitti import KittiDetections, frame_keys
+from data_tools.parallel import bounded_imap, Throughput
+
+METHODS = ('fill', 'pixelate', 'blur')
+
+
+def redact_array(pixels, boxes, method='fill', color=(0, 0, 0), block_size=16, blur_radius=None, passes=2):
+    """
+    Redact boxes of an image in place.
+    :param pixels: (height, width, channels) uint8 array
+    :param boxes: (n, 4) array of [left, top, right, bottom] in pixels. Boxes are clipped to the image.
+    :param method: fill, pixelate or blur
+    :param color: Fill colour
+    :param block_size: Pixelation block size in pixels
+    :param blur_radius: Box blur radius in pixels. Defaults to a quarter of the smaller side of each box.
+    :param passes: Number of box blur passes. Two or three passes look close to a Gaussian blur.
+    :return: pixels
+    """
+    assert method in METHODS, "method must be one of %s" % (METHODS,)
+    height, width = pixels.shape[:2]
+    boxes = np.round(np.asarray(boxes, dtype=np.float64).reshape(-1, 4)).astype(np.int64)
+    boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, width)
+    boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, height)
+    for left, top, right, bottom in boxes.tolist():
+        if right <= left or bottom <= top:
+            continue
+        region = pixels[top:bottom, left:right]
+        if method == 'fill':
+            region[...] = color
+        elif method == 'pixelate':
+            region[...] = _pixelate(region, block_size)
+        else:
+            radius = blur_radius if blur_radius is not None else max(min(bottom - top, right - left) // 4, 1)
+            region[...] = _box_blur(region, radius, passes)
+    return pixels
+
+
+def redact_images(image_dir, output_dir, boxes, method='fill', color=(0, 0, 0), block_size=16, blur_radius=None,
+                  margin=0.0, image_files=None, mux_size=None, categories=None, num_workers=8, quality=95,
+                  skip_existing=False, use_processes=False):
+    """
+    Redact a directory of images.
+    :param image_dir: Directory containing the images
+    :param output_dir: Directory for the redacted images. Images keep their file name.
+    :param boxes: COCO annotation file, COCO dict or CocoIndex, or KittiDetections (e.g. from load_kitti_dir or
+        KittiArchive.detections)
+    :param method: fill, pixelate or blur, see redact_array
+    :param color, block_size, blur_radius: See redact_array
+    :param margin: Grow each box by this fraction of its width and height on every side
+    :param image_files: KITTI only. File names of the frames of each stream: a list (frame n of every stream is
+        image_files[n]) or a dict of (stream, frame): file name. Defaults to the sorted file names of image_dir.
+        The boxes of all frames that map to the same file are redacted together.
+    :param mux_size: KITTI only. (width, height) of the streammux output, which KITTI boxes are given in. Boxes
+        are scaled to the size of each image.
+    :param categories: COCO category ids (or KITTI labels) to redact. Defaults to all.
+    :param num_workers: Number of images processed in parallel
+    :param quality: JPEG quality of the output
+    :param skip_existing: Don't redo images whose output is newer than the original
+    :param use_processes: Use worker processes rather than threads
+    :return: dict of counts per outcome (redacted, skipped, missing, damaged)
+    """
+    assert os.path.isdir(image_dir), "Directory %s does not exist" % image_dir
+    assert os.path.isdir(output_dir), "Directory %s does not exist" % output_dir
+    if isinstance(boxes, KittiDetections):
+        image_boxes = _kitti_image_boxes(boxes, image_dir, image_files, categories)
+    else:
+        image_boxes = _coco_image_boxes(load_index(boxes, verbose=True), categories)
+        mux_size = None
+    image_boxes = _merge_by_file(image_boxes)
+
+    params = (method, tuple(color), block_size, blur_radius, margin, mux_size, quality, skip_existing)
+    tasks = ((os.path.join(image_dir, file_name), os.path.join(output_dir, file_name), file_boxes, params)
+             for file_name, file_boxes in image_boxes)
+    progress = Throughput(len(image_boxes))
+    counts = {'redacted': 0, 'skipped': 0, 'missing': 0, 'damaged': 0}
+    for status, filepath, nbytes in bounded_imap(_redact_file, tasks, num_workers=num_workers,
+                                                 use_processes=use_processes):
+        counts[status] += 1
+        if status == 'missing':
+            print("Image not found:", filepath)
+        elif status == 'damaged':
+            print("Image damaged:", filepath)
+        progress.update(nbytes=nbytes)
+    print("  " + progress.summary())
+    print("  %(redacted)i redacted, %(skipped)i already up to date, %(missing)i not found, %(damaged)i damaged."
+          % counts)
+    return counts
+
+
+def _coco_image_boxes(index, categories):
+    """[(file name, (n, 4) [left, top, right, bottom] array)] for every image of a CocoIndex"""
+    boxes = index.bboxes.astype(np.float64)
+    boxes[:, 2:] += boxes[:, :2]
+    keep = np.ones(len(boxes), dtype=bool)
+    if categories is not None:
+        keep = np.isin(np.asarray(index.ann_columns['category_id']), list(categories))
+    image_boxes = []
+    for row, file_name in enumerate(index.file_names):
+        ann_rows = index.ann_rows_at(row)
+        image_boxes.append((file_name, boxes[ann_rows[keep[ann_rows]]]))
+    return image_boxes
+
+
+def _kitti_image_boxes(detections, image_dir, image_files, categories):
+    """[(file name, (n, 4) boxes)] for every KITTI frame that has an image"""
+    if image_files is None:
+        image_files = sorted(os.listdir(image_dir))
+    if categories is not None:
+        codes = [code for code, ll in enumerate(detections.labels) if ll in categories]
+        detections = detections.take(np.isin(detections.label, codes))
+    keys = frame_keys(detections.app, detections.stream, detections.frame)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    file_keys = frame_keys(*detections.frames.T)
+    starts = np.searchsorted(keys, file_keys, side='left')
+    ends = np.searchsorted(keys, file_keys, side='right')
+    image_boxes = []
+    for (app, stream, frame), start, end in zip(detections.frames.tolist(), starts.tolist(), ends.tolist()):
+        if isinstance(image_files, dict):
+            file_name = image_files.get((stream, frame))
+        else:
+            file_name = image_files[frame] if frame < len(image_files) else None
+        if file_name is not None:
+            image_boxes.append((file_name, detections.boxes[order[start:end]].astype(np.float64)))
+    return image_boxes
+
+
+def _merge_by_file(image_boxes):
+    """
+    Join the boxes of entries sharing a file name, e.g. frame n of every stream when all sources play the same
+    video, so that each output file is written once
+    """
+    merged = {}
+    for file_name, boxes in image_boxes:
+        merged.setdefault(file_name, []).append(boxes)
+    return [(file_name, np.concatenate(boxes_list) if len(boxes_list) > 1 else boxes_list[0])
+            for file_name, boxes_list in merged.items()]
+
+
+def _redact_file(task):
+    """
+    Redact one image. Runs on a worker.
+    :return: (status, filepath, bytes read), status being one of redacted, skipped, missing, damaged
+    """
+    filepath, output_path, boxes, params = task
+    method, color, block_size, blur_radius, margin, mux_size, quality, skip_existing = params
+    try:
+        st = os.stat(filepath)
+    except FileNotFoundError:
+        return 'missing', filepath, 0
+    if skip_existing:
+        try:
+            if os.stat(output_path).st_mtime >= st.st_mtime:
+                return 'skipped', filepath, 0
+        except FileNotFoundError:
+            pass
+    try:
+        image = Image.open(filepath)
+        image_format = image.format
+        pixels = np.array(image.convert("RGB"))
+    except OSError:
+        return 'damaged', filepath, st.st_size
+    if mux_size is not None:
+        boxes = boxes * np.tile([pixels.shape[1] / float(mux_size[0]), pixels.shape[0] / float(mux_size[1])], 2)
+    if margin:
+        pad = np.tile(boxes[:, 2:] - boxes[:, :2], 2) * margin
+        boxes = boxes + pad * np.array([-1, -1, 1, 1])
+    redact_array(pixels, boxes, method=method, color=color, block_size=block_size, blur_radius=blur_radius)
+    # Write to a temporary file first, so an interrupted run never leaves a partly written output
+    tmp = output_path + '.tmp%i' % os.getpid()
+    Image.fromarray(pixels).save(tmp, format=image_format, quality=quality)
+    os.replace(tmp, output_path)
+    return 'redacted', filepath, st.st_size
+
+
+def _pixelate(region, block_size):
+    """Replace each block_size x block_size block of region by its mean"""
+    height, width = region.shape[:2]
+    rows = np.arange(0, height, block_size)
+    cols = np.arange(0, width, block_size)
+    sums = np.add.reduceat(np.add.reduceat(region.astype(np.int64), rows, axis=0), cols, axis=1)
+    counts = np.outer(np.diff(np.r_[rows, height]), np.diff(np.r_[cols, width]))[:, :, None]
+    means = (sums + counts // 2) // counts
+    rows_rep = np.diff(np.r_[rows, height])
+    cols_rep = np.diff(np.r_[cols, width])
+    return np.repeat(np.repeat(means, rows_rep, axis=0), cols_rep, axis=1)
+
+
+def _box_blur(region, radius, passes):
+    """Box blur with a (2 * radius + 1) wide window, repeated passes times. Edges are extended."""
+    out = region.astype(np.float64)
+    for _ in range(passes):
+        for axis in (0, 1):
+            out = _box_filter_1d(out, radius, axis)
+    return np.clip(np.round(out), 0, 255).astype(region.dtype)
+
+
+def _box_filter_1d(values, radius, axis):
+    pad = [(0, 0)] * values.ndim
+    pad[axis] = (radius + 1, radius)
+    cums = np.cumsum(np.pad(values, pad, mode='edge'), axis=axis)
+    size = values.shape[axis]
+    upper = np.take(cums, np.arange(2 * radius + 1, 2 * radius + 1 + size), axis=axis)
+    lower = np.take(cums, np.arange(0, size), axis=axis)
+    return (upper - lower) / (2 * radius + 1)
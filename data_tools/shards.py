@@ -0,0 +1,186 @@
+"""
+Pack a COCO dataset into a few large sequential shard files.
+
+Each shard is a plain tar file holding, per sample, '<sample>.jpg' (the encoded image) followed by
+'<sample>.json' ({"image": image dict, "annotations": [annotation dicts]}), so shards can also be read with
+standard tools or tar-based loaders. Next to the shards, index.json holds the dataset header and shard names,
+and index.npy holds one record per sample with the shard number and the byte offset and size of both members,
+so a reader can seek straight to any sample.
+"""
+
+import io
+import os
+import json
+import tarfile
+import numpy as np
+from PIL import Image
+from data_tools.coco_index import load_index
+from data_tools.parallel import bounded_imap, Throughput
+
+INDEX_DTYPE = np.dtype([('shard', '<i4'), ('image_id', '<i8'),
+                        ('jpg_offset', '<i8'), ('jpg_size', '<i8'),
+                        ('json_offset', '<i8'), ('json_size', '<i8')])
+
+
+def write_shards(annotations, image_dir, output_dir, shard_size=256 * 1024 * 1024, max_size=None,
+                 quality=95, num_workers=8, prefix='shard'):
+    """
+    Write the images of a COCO dataset and their annotations into shards.
+    :param annotations: COCO annotation file (e.g. from openimages2coco or split_dataset), or a CocoIndex
+    :param image_dir: Directory containing the images
+    :param output_dir: Directory that will contain the shards and index
+    :param shard_size: A new shard is started once a shard holds this many bytes
+    :param max_size: If set, images larger than this (in either dimension) are resized to fit while packing,
+        and their annotations are scaled to match
+    :param quality: JPEG quality of resized images. Images that are not resized are packed as they are.
+    :param num_workers: Number of images read (and resized) in parallel
+    :param prefix: Shard file name prefix
+    :return: Number of samples written. Images that are missing or damaged are skipped and left out of the index.
+    """
+    assert os.path.isdir(image_dir), "Directory %s does not exist" % image_dir
+    assert os.path.isdir(output_dir), "Directory %s does not exist" % output_dir
+    index = load_index(annotations, verbose=True)
+
+    def tasks():
+        for row in range(index.num_images):
+            img = index.image_at(row)
+            anns = [index.annotation_at(ann_row) for ann_row in index.ann_rows_at(row).tolist()]
+            yield os.path.join(image_dir, img['file_name']), img, anns, max_size, quality
+
+    records = np.zeros(index.num_images, dtype=INDEX_DTYPE)
+    shard_names = []
+    tar = None
+    progress = Throughput(index.num_images)
+    counts = {'missing': 0, 'damaged': 0}
+    sample = 0
+    for status, filepath, jpg, img, anns in bounded_imap(_pack_sample, tasks(), num_workers=num_workers,
+                                                         ordered=True):
+        if status != 'packed':
+            print("Image %s:" % ('not found' if status == 'missing' else 'damaged'), filepath)
+            counts[status] += 1
+            progress.update()
+            continue
+        if tar is None or tar.offset >= shard_size:
+            if tar is not None:
+                tar.close()
+            shard_names.append('%s-%06i.tar' % (prefix, len(shard_names)))
+            tar = tarfile.open(os.path.join(output_dir, shard_names[-1]), 'w', format=tarfile.USTAR_FORMAT)
+        meta = json.dumps({'image': img, 'annotations': anns}).encode('utf-8')
+        key = '%09i' % sample
+        jpg_offset = _add_member(tar, key + '.jpg', jpg)
+        json_offset = _add_member(tar, key + '.json', meta)
+        records[sample] = (len(shard_names) - 1, img['id'], jpg_offset, len(jpg), json_offset, len(meta))
+        sample += 1
+        progress.update(nbytes=len(jpg))
+    if tar is not None:
+        tar.close()
+    print("  " + progress.summary())
+    print("  %(missing)i not found, %(damaged)i damaged." % counts)
+
+    np.save(os.path.join(output_dir, 'index.npy'), records[:sample])
+    with open(os.path.join(output_dir, 'index.json'), 'w') as f:
+        json.dump({'header': index.header, 'shards': shard_names, 'num_samples': sample}, f)
+    print("Wrote %i samples in %i shards to %s" % (sample, len(shard_names), output_dir))
+    return sample
+
+
+class ShardReader(object):
+    """
+    Read samples written by write_shards, either sequentially (iterate over the reader) or by sample number.
+    Samples are (jpeg bytes, {"image": ..., "annotations": [...]}); use decode_image to get a PIL image.
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, 'index.json')) as f:
+            meta = json.load(f)
+        self.header = meta['header']
+        self.shards = meta['shards']
+        self.records = np.load(os.path.join(shard_dir, 'index.npy'), mmap_mode='r')
+        self._files = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, sample):
+        rec = self.records[sample]
+        f = self._files.get(int(rec['shard']))
+        if f is None:
+            f = self._files[int(rec['shard'])] = open(os.path.join(self.shard_dir, self.shards[rec['shard']]), 'rb')
+        f.seek(int(rec['jpg_offset']))
+        jpg = f.read(int(rec['jpg_size']))
+        f.seek(int(rec['json_offset']))
+        meta = json.loads(f.read(int(rec['json_size'])).decode('utf-8'))
+        return jpg, meta
+
+    def __iter__(self):
+        """Stream all samples in order, reading each shard front to back"""
+        for shard in self.shards:
+            with tarfile.open(os.path.join(self.shard_dir, shard), 'r|') as tar:
+                jpg = None
+                for member in tar:
+                    data = tar.extractfile(member).read()
+                    if member.name.endswith('.jpg'):
+                        jpg = data
+                    else:
+                        yield jpg, json.loads(data.decode('utf-8'))
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+
+
+def decode_image(jpg):
+    """Decode the image bytes of a sample to an RGB PIL image"""
+    return Image.open(io.BytesIO(jpg)).convert("RGB")
+
+
+def _pack_sample(task):
+    """
+    Read (and if needed resize) one image. Runs on a worker.
+    :return: (status, filepath, image bytes, image dict, annotations), status being one of packed, missing or
+        damaged. Image bytes are None unless packed.
+    """
+    filepath, img, anns, max_size, quality = task
+    if not os.path.isfile(filepath):
+        return 'missing', filepath, None, img, anns
+    try:
+        if max_size is None or max(img['width'], img['height']) <= max_size:
+            with open(filepath, 'rb') as f:
+                data = f.read()
+            Image.open(io.BytesIO(data)).verify()
+            return 'packed', filepath, data, img, anns
+        scale = max_size / float(max(img['width'], img['height']))
+        new_w = max(int(img['width'] * scale), 1)
+        new_h = max(int(img['height'] * scale), 1)
+        image = Image.open(filepath)
+        image.draft('RGB', (new_w, new_h))
+        image = image.convert("RGB").resize((new_w, new_h), Image.BILINEAR)
+    except (OSError, SyntaxError):
+        return 'damaged', filepath, None, img, anns
+    buf = io.BytesIO()
+    image.save(buf, format='JPEG', quality=quality)
+    img = dict(img, width=new_w, height=new_h)
+    anns = [_scale_annotation(ann, scale) for ann in anns]
+    return 'packed', filepath, buf.getvalue(), img, anns
+
+
+def _scale_annotation(ann, scale):
+    ann = dict(ann)
+    ann['bbox'] = [vv * scale for vv in ann['bbox']]
+    if 'area' in ann:
+        ann['area'] = ann['area'] * scale * scale
+    seg = ann.get('segmentation')
+    if isinstance(seg, list) and seg and all(isinstance(vv, (int, float)) for vv in seg):
+        ann['segmentation'] = [vv * scale for vv in seg]
+    return ann
+
+
+def _add_member(tar, name, data):
+    """Add a file to a tar being written and return the offset of its data in the tar file"""
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+    blocks = (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+    return tar.offset - blocks * tarfile.BLOCKSIZE
@@ -0,0 +1,176 @@
+"""
+Fill in tracked boxes between detector keyframes, and measure what skipping frames costs.
+
+With interval=N in [primary-gie], the detector only runs on every (N+1)'th frame. interpolate_tracks fills the
+frames in between from the KITTI track dump (kitti-track-output-dir): each gap in a track is filled by linear
+interpolation between its two observations, and after an observation a track can be carried forward at its
+last velocity. Filled boxes are padded in proportion to how fast the box moves and how far the frame is from
+an observation, so that fast faces stay covered.
+
+simulate_intervals takes a dense dump (interval=0, every frame detected) as ground truth, keeps only the
+keyframes of each interval, fills the gaps, and counts the face-frames whose box is not covered. That shows how
+far interval can be raised, multiplying the number of streams per GPU, before faces are left unredacted.
+"""
+
+import numpy as np
+from data_tools.kitti import KittiDetections, frame_keys
+from data_tools.kitti_eval import group_pairs
+
+
+def interpolate_tracks(detections, max_gap=None, extrapolate=0, causal=False, pad_motion=1.0, margin=0.0):
+    """
+    Add boxes for the frames between and after the observations of each track.
+    :param detections: KittiDetections with tracking ids (load_kitti_dir(..., tracks=True) or a track archive)
+    :param max_gap: Don't interpolate over gaps longer than this many frames. Defaults to no limit.
+    :param extrapolate: Carry each track forward this many frames after an observation, at its last velocity
+    :param causal: Only use past observations, as a live pipeline would: every gap is filled by carrying the
+        track forward (up to extrapolate frames) rather than by interpolating to the next observation
+    :param pad_motion: Grow filled boxes by pad_motion * (distance moved per frame) * (frames from the nearest
+        observation used), separately for each side
+    :param margin: Grow every box, observed or filled, by this fraction of its width and height on each side
+    :return: (KittiDetections sorted by (app, stream, frame), boolean array marking the filled boxes)
+    """
+    tracked = detections.track >= 0
+    obs = detections.take(np.flatnonzero(tracked))
+    order = np.lexsort((obs.frame, obs.track, obs.stream, obs.app))
+    obs = obs.take(order)
+    boxes = obs.boxes.astype(np.float64)
+    frame = obs.frame
+
+    same_next = np.zeros(len(obs), dtype=bool)
+    if len(obs) > 1:
+        same_next[:-1] = ((obs.app[1:] == obs.app[:-1]) & (obs.stream[1:] == obs.stream[:-1])
+                          & (obs.track[1:] == obs.track[:-1]))
+    same_prev = np.r_[False, same_next[:-1]]
+    next_idx = np.minimum(np.arange(len(obs)) + 1, max(len(obs) - 1, 0))
+    prev_idx = np.maximum(np.arange(len(obs)) - 1, 0)
+    gap = np.where(same_next, frame[next_idx] - frame, 0)
+
+    # Boxes between two observations of a track
+    fill = same_next & (gap > 1) & (not causal)
+    if max_gap is not None:
+        fill &= gap <= max_gap
+    count = np.where(fill, gap - 1, 0)
+    src = np.repeat(np.arange(len(obs)), count)
+    step = _ranges(count) + 1
+    velocity = (boxes[next_idx[src]] - boxes[src]) / gap[src][:, None]
+    distance = np.minimum(step, gap[src] - step)
+    parts = [(src, frame[src] + step, _pad(boxes[src] + velocity * step[:, None], velocity, distance, pad_motion))]
+
+    # Boxes carried forward after an observation, at the velocity since the previous observation
+    if extrapolate:
+        if causal:
+            count = np.where(same_next, np.minimum(gap - 1, extrapolate), extrapolate)
+        else:
+            # Past the last observation of a track, and over gaps too long to interpolate
+            count = np.where(same_next & ~fill & (gap > 1), np.minimum(gap - 1, extrapolate), 0)
+            count = np.where(same_next, count, extrapolate)
+        src = np.repeat(np.arange(len(obs)), count)
+        step = _ranges(count) + 1
+        prev_gap = np.maximum(frame - frame[prev_idx], 1)
+        velocity = np.where(same_prev[:, None], (boxes - boxes[prev_idx]) / prev_gap[:, None], 0.0)[src]
+        new_frame = frame[src] + step
+        # Never past the last frame written for the stream
+        keep = new_frame <= _last_frames(detections.frames, obs.app[src], obs.stream[src])
+        src, step, velocity, new_frame = src[keep], step[keep], velocity[keep], new_frame[keep]
+        parts.append((src, new_frame, _pad(boxes[src] + velocity * step[:, None], velocity, step, pad_motion)))
+
+    src = np.concatenate([part[0] for part in parts])
+    new_frame = np.concatenate([part[1] for part in parts])
+    new_boxes = np.concatenate([part[2] for part in parts])
+    filled = KittiDetections(obs.app[src], obs.stream[src], new_frame, obs.track[src], obs.label[src],
+                             new_boxes.astype(np.float32), obs.scores[src], obs.labels, np.zeros((0, 3), np.int64))
+    combined = KittiDetections.concatenate([detections, filled])
+    is_filled = np.r_[np.zeros(len(detections), dtype=bool), np.ones(len(filled), dtype=bool)]
+    order = np.argsort(frame_keys(combined.app, combined.stream, combined.frame), kind='stable')
+    combined = combined.take(order)
+    if margin:
+        size = combined.boxes[:, 2:] - combined.boxes[:, :2]
+        combined.boxes = (combined.boxes + np.tile(size, 2) * margin * np.array([-1, -1, 1, 1])).astype(np.float32)
+    return combined, is_filled[order]
+
+
+def coverage(predicted, truth):
+    """
+    For each box of truth, the largest fraction of its area covered by a single box of predicted in the same frame.
+    :param predicted, truth: KittiDetections
+    :return: array with one value in [0, 1] per box of truth
+    """
+    pair_t, pair_p = group_pairs(frame_keys(truth.app, truth.stream, truth.frame),
+                                 frame_keys(predicted.app, predicted.stream, predicted.frame))
+    a = truth.boxes[pair_t].astype(np.float64)
+    b = predicted.boxes[pair_p].astype(np.float64)
+    w = np.clip(np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0]), 0, None)
+    h = np.clip(np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1]), 0, None)
+    area = np.maximum((a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]), 1e-12)
+    result = np.zeros(len(truth), dtype=np.float64)
+    np.maximum.at(result, pair_t, w * h / area)
+    return result
+
+
+def simulate_intervals(dense, intervals=(0, 1, 2, 3, 4), min_coverage=0.9, causal=False, pad_motion=1.0,
+                       margin=0.0, max_gap=None):
+    """
+    Estimate, from a dense track dump, how many face-frames each detector interval leaves uncovered.
+    :param dense: KittiDetections with tracking ids, from a run with interval=0
+    :param intervals: interval values to simulate
+    :param min_coverage: A face-frame counts as covered if one box covers at least this fraction of it
+    :param causal: Fill gaps only from past keyframes, as the live pipeline has to (see interpolate_tracks)
+    :param pad_motion, margin, max_gap: See interpolate_tracks
+    :return: list of dicts, one per interval
+    """
+    results = []
+    for interval in intervals:
+        keyframe = dense.frame % (interval + 1) == 0
+        filled, is_filled = interpolate_tracks(dense.take(np.flatnonzero(keyframe)), max_gap=max_gap,
+                                               extrapolate=interval, causal=causal, pad_motion=pad_motion,
+                                               margin=margin)
+        covered = coverage(filled, dense) >= min_coverage
+        truth_area = float(np.prod(dense.boxes[:, 2:] - dense.boxes[:, :2], axis=1).sum())
+        redacted_area = float(np.prod(filled.boxes[:, 2:] - filled.boxes[:, :2], axis=1).sum())
+        missed = ~covered
+        results.append({'interval': interval, 'face_frames': len(dense), 'missed': int(missed.sum()),
+                        'missed_skipped_frames': int((missed & ~keyframe).sum()),
+                        'miss_rate': float(missed.mean()) if len(dense) else float('nan'),
+                        'filled_boxes': int(is_filled.sum()),
+                        'area_ratio': redacted_area / truth_area if truth_area else float('nan'),
+                        'detector_load': 1.0 / (interval + 1)})
+    return results
+
+
+def print_intervals(results):
+    """Print the results of simulate_intervals as a table"""
+    print("%8s %11s %8s %9s %10s %14s" % ('interval', 'face_frames', 'missed', 'miss_rate', 'area_ratio',
+                                          'detector_load'))
+    for res in results:
+        print("%8i %11i %8i %9.4f %10.3f %14.3f" % (res['interval'], res['face_frames'], res['missed'],
+                                                    res['miss_rate'], res['area_ratio'], res['detector_load']))
+
+
+def _ranges(count):
+    """Concatenation of arange(c) for each c in count"""
+    count = np.asarray(count, dtype=np.int64)
+    return np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+
+
+def _pad(boxes, velocity, distance, pad_motion):
+    """Grow each side of boxes by pad_motion * |velocity of that side| * distance"""
+    pad = pad_motion * np.abs(velocity) * np.asarray(distance, dtype=np.float64)[:, None]
+    return boxes + pad * np.array([-1, -1, 1, 1])
+
+
+def _last_frames(frames, app, stream):
+    """Last frame number in frames (app, stream, frame rows) of each (app, stream) pair, int64 max if it has none"""
+    keys = frame_keys(frames[:, 0], frames[:, 1], 0)
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    query = frame_keys(app, stream, 0)
+    end = np.searchsorted(sorted_keys, query, side='right')
+    found = end > 0
+    found[found] = sorted_keys[end[found] - 1] == query[found]
+    last = np.full(len(query), np.iinfo(np.int64).max, dtype=np.int64)
+    if len(frames):
+        group_max = np.maximum.reduceat(frames[order, 2], np.r_[0, np.flatnonzero(np.diff(sorted_keys)) + 1])
+        group_of = np.cumsum(np.r_[True, np.diff(sorted_keys) != 0]) - 1
+        last[found] = group_max[group_of[end[found] - 1]]
+    return last
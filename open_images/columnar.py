@@ -0,0 +1,186 @@
+"""
+Columnar (struct-of-arrays) representation of Open Images bbox annotations.
+
+parse_open_images returns one dict per CSV row, which for the ~14M row train CSV takes tens of GB. An
+OpenImagesTable holds each column as a typed NumPy array instead: float32 coordinates, int8 flags and
+int32 codes into a per-column vocabulary for the string columns (ImageID, Source, LabelName).
+"""
+
+import os
+import csv
+import numpy as np
+from data_tools import instrument
+
+EXPECTED_HEADER = ['ImageID', 'Source', 'LabelName', 'Confidence', 'XMin', 'XMax', 'YMin', 'YMax',
+                   'IsOccluded', 'IsTruncated', 'IsGroupOf', 'IsDepiction', 'IsInside']
+CODE_COLUMNS = ('ImageID', 'Source', 'LabelName')
+FLOAT_COLUMNS = ('XMin', 'XMax', 'YMin', 'YMax')
+FLAG_COLUMNS = ('Confidence', 'IsOccluded', 'IsTruncated', 'IsGroupOf', 'IsDepiction', 'IsInside')
+
+
+class OpenImagesTable(object):
+    """
+    Open Images annotations stored column by column.
+    String columns are stored as int32 codes; table.vocab[column][code] gives the string. Codes are
+    assigned in order of first appearance in the CSV, so sorting by code preserves the file order.
+    """
+
+    def __init__(self, columns, vocab):
+        """
+        :param columns: dict of column name: 1D array, all of the same length
+        :param vocab: dict of code column name: list of strings, indexed by code
+        """
+        self.columns = columns
+        self.vocab = vocab
+
+    def __len__(self):
+        return len(self.columns['ImageID'])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def decode(self, column, codes=None):
+        """Return the strings of a code column (for all rows, or for the given codes)"""
+        if codes is None:
+            codes = self.columns[column]
+        return np.asarray(self.vocab[column], dtype=object)[codes]
+
+    def codes_for(self, column, values):
+        """Return the codes of the given strings in a code column. Strings not in the table are ignored."""
+        lookup = {vv: code for code, vv in enumerate(self.vocab[column])}
+        return np.array([lookup[vv] for vv in values if vv in lookup], dtype=np.int32)
+
+    def take(self, index):
+        """Return a new table with only the rows selected by index (a boolean mask or row numbers)"""
+        columns = {name: col[index] for name, col in self.columns.items()}
+        return OpenImagesTable(columns, self.vocab)
+
+    def rows(self):
+        """Iterate over rows as dicts, in the format produced by parse_open_images_row"""
+        names = list(self.columns)
+        values = []
+        for name in names:
+            if name in CODE_COLUMNS:
+                values.append(self.decode(name).tolist())
+            else:
+                values.append(self.columns[name].tolist())
+        for row in zip(*values):
+            yield dict(zip(names, row))
+
+    def save(self, path):
+        """Write the table to an .npz file, which load reads back without parsing the CSV again"""
+        arrays = {'column_' + name: col for name, col in self.columns.items()}
+        arrays.update({'vocab_' + name: np.array(words, dtype=str) for name, words in self.vocab.items()})
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Read a table written by save"""
+        with np.load(path) as data:
+            columns = {key[len('column_'):]: data[key] for key in data.files if key.startswith('column_')}
+            vocab = {key[len('vocab_'):]: data[key].tolist() for key in data.files if key.startswith('vocab_')}
+        return cls(columns, vocab)
+
+    @classmethod
+    def from_rows(cls, rows, float_dtype=np.float32):
+        """
+        Build a table from a list of dicts, as produced by parse_open_images
+        :param float_dtype: dtype of the coordinate columns. Use np.float64 to keep the parsed values exactly.
+        """
+        builder = _TableBuilder(float_dtype)
+        builder.add_chunk([[dd[hh] for hh in EXPECTED_HEADER] for dd in rows])
+        return builder.build()
+
+
+class _TableBuilder(object):
+    """Accumulates chunks of raw CSV rows into typed column arrays."""
+
+    def __init__(self, float_dtype=np.float32):
+        self.float_dtype = float_dtype
+        self.chunks = {hh: [] for hh in EXPECTED_HEADER}
+        self.lookup = {hh: {} for hh in CODE_COLUMNS}
+
+    def add_chunk(self, rows):
+        if not rows:
+            return
+        cols = list(zip(*rows))
+        for ii, hh in enumerate(EXPECTED_HEADER):
+            if hh in FLOAT_COLUMNS:
+                arr = np.array(cols[ii], dtype=self.float_dtype)
+            elif hh in FLAG_COLUMNS:
+                arr = np.array(cols[ii], dtype=np.int8)
+            else:
+                arr = _intern(cols[ii], self.lookup[hh])
+            self.chunks[hh].append(arr)
+
+    def build(self):
+        columns = {}
+        for hh in EXPECTED_HEADER:
+            if self.chunks[hh]:
+                columns[hh] = np.concatenate(self.chunks[hh])
+            else:
+                columns[hh] = np.zeros(0, dtype=self.float_dtype if hh in FLOAT_COLUMNS else _column_dtype(hh))
+        vocab = {hh: list(self.lookup[hh]) for hh in CODE_COLUMNS}  # dicts keep insertion (= code) order
+        return OpenImagesTable(columns, vocab)
+
+
+def parse_open_images_columnar(annotation_csv, chunk_rows=250000):
+    """
+    Parse an Open Images bbox CSV into an OpenImagesTable.
+    :param annotation_csv: Open Images annotation CSV, e.g. train-annotations-bbox.csv
+    :param chunk_rows: Number of rows converted to arrays at once. Bounds the size of the temporary row lists.
+    :return: OpenImagesTable
+    """
+    assert os.path.isfile(annotation_csv), "File %s does not exist." % annotation_csv
+
+    builder = _TableBuilder()
+    rows_read = 0
+    with instrument.stage('parse_open_images', unit='rows'), open(annotation_csv) as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader)
+        for ii, hh in enumerate(header):
+            assert hh == EXPECTED_HEADER[ii], "File header is not as expected."
+        chunk = []
+        for row in reader:
+            chunk.append(row)
+            if len(chunk) == chunk_rows:
+                with instrument.timer('parse_open_images', 'build'):
+                    builder.add_chunk(chunk)
+                rows_read += len(chunk)
+                instrument.count('parse_open_images', 'rows', len(chunk))
+                chunk = []
+        with instrument.timer('parse_open_images', 'build'):
+            builder.add_chunk(chunk)
+            table = builder.build()
+        rows_read += len(chunk)
+        instrument.count('parse_open_images', 'rows', len(chunk))
+        instrument.count('parse_open_images', 'bytes', os.path.getsize(annotation_csv))
+    print(" Read", rows_read, "rows from annotation csv", annotation_csv)
+    return table
+
+
+def first_appearance_order(codes):
+    """Return the unique values of codes, ordered by the row in which each first appears."""
+    uniq, first = np.unique(codes, return_index=True)
+    return uniq[np.argsort(first, kind='stable')]
+
+
+def _intern(values, lookup):
+    """Map strings to int32 codes, adding unseen strings to lookup."""
+    codes = []
+    for vv in values:
+        code = lookup.get(vv)
+        if code is None:
+            code = len(lookup)
+            lookup[vv] = code
+        codes.append(code)
+    return np.array(codes, dtype=np.int32)
+
+
+def _column_dtype(column):
+    if column in FLOAT_COLUMNS:
+        return np.float32
+    if column in FLAG_COLUMNS:
+        return np.int8
+    return np.int32
@@ -0,0 +1,109 @@
+"""
+Image dimension probing for openimages2coco.
+
+Only the image header is read (PIL opens images lazily and knows the size before decoding any pixels).
+The directory holding each image is found with a one-time listing of every image directory, probing runs
+on a thread pool, and results can be kept in an on-disk cache keyed by path and mtime so that reruns of a
+conversion skip probing entirely.
+"""
+
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from data_tools import instrument
+from data_tools.materialize import build_image_dir_index
+
+
+class SizeCache(object):
+    """
+    On-disk cache of image sizes: {path: [mtime_ns, file_size, width, height]}.
+    An entry is only used if the file's mtime and size still match.
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.entries = {}
+        self.modified = False
+        if cache_file is not None and os.path.isfile(cache_file):
+            with open(cache_file) as f:
+                self.entries = json.load(f)
+
+    def get(self, path, st):
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2], entry[3]
+        return None
+
+    def set(self, path, st, size):
+        self.entries[path] = [st.st_mtime_ns, st.st_size, size[0], size[1]]
+        self.modified = True
+
+    def save(self):
+        """Write the cache, if anything changed. The file is replaced atomically."""
+        if self.cache_file is None or not self.modified:
+            return
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_file, self.cache_file)
+        self.modified = False
+
+
+def probe_image_size(filepath):
+    """Return (width, height) of an image, reading only its header"""
+    with Image.open(filepath) as image:
+        return image.size
+
+
+@instrument.instrumented('get_image_sizes', unit='images')
+def get_image_sizes(filenames, img_dirs, num_workers=8, cache_file=None, chunk_size=256):
+    """
+    Get (width, height) for many images.
+    :param filenames: Image filenames, e.g. ['000002b66c9c498e.jpg', ...]
+    :param img_dirs: Directory or list of directories containing the images
+    :param num_workers: Number of probing threads
+    :param cache_file: Optional JSON file used to persist sizes between runs
+    :param chunk_size: Number of images handled per task
+    :return: dict of filename: (width, height)
+    """
+    filenames = list(dict.fromkeys(filenames))
+    instrument.set_total('get_image_sizes', len(filenames))
+    with instrument.timer('get_image_sizes', 'list_dirs'):
+        filename2dir = build_image_dir_index(img_dirs, filenames)
+    missing = [fn for fn in filenames if fn not in filename2dir]
+    if missing:
+        raise FileNotFoundError("Image %s not found in any of img_dir (%i images missing)" % (missing[0], len(missing)))
+
+    cache = SizeCache(cache_file)
+
+    def probe_chunk(chunk):
+        results = []
+        for filename in chunk:
+            filepath = os.path.join(filename2dir[filename], filename)
+            st = os.stat(filepath)
+            size = cache.get(filepath, st)
+            if size is None:
+                with instrument.timer('get_image_sizes', 'probe'):
+                    size = probe_image_size(filepath)
+                results.append((filename, size, filepath, st))
+            else:
+                results.append((filename, size, None, None))
+        return results
+
+    chunks = [filenames[ii:ii + chunk_size] for ii in range(0, len(filenames), chunk_size)]
+    sizes = {}
+    probed = 0
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for results in executor.map(probe_chunk, chunks):
+            for filename, size, filepath, st in results:
+                sizes[filename] = tuple(size)
+                if filepath is not None:
+                    cache.set(filepath, st, size)
+                    probed += 1
+            instrument.count('get_image_sizes', 'images', len(results))
+    instrument.count('get_image_sizes', 'probed', probed)
+    instrument.count('get_image_sizes', 'cached', len(sizes) - probed)
+    cache.save()
+    print(" Got sizes of %i images (%i probed, %i from cache)" % (len(sizes), probed, len(sizes) - probed))
+    return sizes
@@ -1,53 +1,46 @@
-import os, csv, json, shutil
-from data_tools.coco_tools import read_json
-from PIL import Image
+import os, csv
+import numpy as np
+from data_tools import instrument
+from data_tools.coco_index import load_index
+from data_tools.coco_stream import CocoWriter
+from data_tools.materialize import materialize_images
+from open_images.columnar import OpenImagesTable, parse_open_images_columnar, first_appearance_order
+from open_images.image_sizes import get_image_sizes, probe_image_size
 
 
 def reduce_data(oidata, catmid2name, keep_classes=[]):
     """
     Reduce the amount of data by only keeping images that are in the classes we want.
-    :param oidata: oidata, as outputted by parse_open_images
+    :param oidata: oidata, as outputted by parse_open_images (list of dicts or OpenImagesTable)
     :param catmid2name: catid2name dict, as produced by read_catMIDtoname
     :param keep_classes: List of classes to be kept.
-    :return:
+    :return: Same type as oidata
     """
     print(" Reducing the dataset. Initial dataset has length", len(oidata))
-    # First build a dictionary of imageID:[classnames]
-    imageid2classmid = {}
-    for dd in oidata:
-        imageid = dd['ImageID']
-        if imageid not in imageid2classmid:
-            imageid2classmid[imageid] = [dd['LabelName']]
-        else:
-            imageid2classmid[imageid].append(dd['LabelName'])
-
-    # Work out which images we are including.
-    imageid2include = {} # dict to store True if this imageid is included.
-
-    for imgid, classmids in imageid2classmid.items():
-        imageid2include[imgid] = False # Assume we don't include this.
-        for mid in classmids:
-            this_name = catmid2name[mid]
-            if this_name in keep_classes:
-                imageid2include[imgid] = True
-
-    # Now work through list, appending if ImageID has imageid2include[imageid] = True
-    returned_data = []
-    for dd in oidata:
-        imageid = dd['ImageID']
-        if imageid2include[imageid]:
-            returned_data.append(dd)
-
+    table = _as_table(oidata)
+    keep = image_has_class_mask(table, class_codes(table, catmid2name, keep_classes))
+    if isinstance(oidata, OpenImagesTable):
+        returned_data = oidata.take(keep)
+    else:
+        returned_data = [dd for dd, kk in zip(oidata, keep.tolist()) if kk]
     print(" Reducing the dataset. Final dataset has length", len(returned_data))
     return returned_data
 
+@instrument.instrumented('openimages2coco', unit='images')
 def openimages2coco(oidata, catmid2name, img_dir, desc="", output_class_ids=None,
-                    max_size=None, min_ann_size=None, min_ratio=0.0, min_width_for_ratio=400):
+                    max_size=None, min_ann_size=None, min_ratio=0.0, min_width_for_ratio=400,
+                    num_workers=8, size_cache=None, output_json=None, resume=False):
     """
     Converts open images annotations into COCO format
-    :param raw: list of data items, as produced by parse_open_images
-    :return: COCO style dict
+    :param raw: list of data items or OpenImagesTable, as produced by parse_open_images
+    :param num_workers: Number of threads used to read image sizes
+    :param size_cache: Optional JSON file in which image sizes are kept between runs
+    :param output_json: If given, images and annotations are streamed to this file as they are produced,
+        instead of being returned as one dict.
+    :param resume: With output_json, continue an interrupted run, skipping the images already written.
+    :return: COCO style dict, or output_json if it was given
     """
+    table = _as_table(oidata)
     output = {'info':
                   "Annotations produced from OpenImages. %s" % desc,
               'licenses': [],
@@ -55,102 +48,86 @@ def openimages2coco(oidata, catmid2name, img_dir, desc="", output_class_ids=None
               'annotations': [],
               'categories': []} # Prepare output
 
-    # Get categories in this dataset
-    all_cats = []
-    for dd in oidata:
-        if dd['LabelName'] not in all_cats:
-            all_cats.append(dd['LabelName'])
+    # Get categories in this dataset, and a lookup table from label code to output category id (-1 = dropped)
     categories = []
-    for mid in all_cats:
+    for mid in get_label_mids(table):
         cat_name = catmid2name[mid]
         if cat_name in output_class_ids:
             categories.append({"id": output_class_ids[cat_name], "name": cat_name, "supercategory": 'object'})
     output['categories'] = categories
-
-    # Get images
-    image_filename_to_id = {} # To store found images.
-    current_img_index = 0 #To incrementally add image IDs.
-    imgid2wh = {} # To store width and height
-    intermediate_images = [] # To store as if output
-    for dd in oidata:
-        filename = dd['ImageID'] + '.jpg'
-        if filename not in image_filename_to_id:
-            img_entry = _oidata_entry_to_image_dict(filename, current_img_index, img_dir)
-            image_filename_to_id[filename] = current_img_index
-            imgid2wh[current_img_index] = (img_entry['width'], img_entry['height'])
-            intermediate_images.append(img_entry)
-            current_img_index += 1
+    code2catid = np.full(len(table.vocab['LabelName']), -1, dtype=np.int64)
+    for code, mid in enumerate(table.vocab['LabelName']):
+        cat_name = catmid2name.get(mid)
+        if cat_name is not None and cat_name in output_class_ids:
+            code2catid[code] = output_class_ids[cat_name]
+
+    # Get images, in order of first appearance. img_rows maps each annotation row to its intermediate image index.
+    image_codes = first_appearance_order(table['ImageID'])
+    code2img = np.full(len(table.vocab['ImageID']), -1, dtype=np.int64)
+    code2img[image_codes] = np.arange(len(image_codes))
+    filenames = [table.vocab['ImageID'][code] + '.jpg' for code in image_codes.tolist()]
+    instrument.set_total('openimages2coco', len(filenames))
+    filename2size = get_image_sizes(filenames, img_dir, num_workers=num_workers, cache_file=size_cache)
+    intermediate_images = []
+    for indx, filename in enumerate(filenames):
+        intermediate_images.append(_oidata_entry_to_image_dict(filename, indx, img_dir, filename2size[filename]))
+    img_w = np.array([img['width'] for img in intermediate_images], dtype=np.float64)
+    img_h = np.array([img['height'] for img in intermediate_images], dtype=np.float64)
+    img_rows = code2img[table['ImageID']]
 
     # Get annotations
-    ann_id = 1
-    imgid2_has_new_ann = {} # Use this to make sure that our images have valid annotations
-    new_anns_raw = [] # list of candidate annotations
-    for dd in oidata:
-        filename = dd['ImageID'] + '.jpg'
-        imgid = image_filename_to_id[filename]
-        cat_name = catmid2name[dd['LabelName']]
-        if cat_name in output_class_ids:
-            catid = output_class_ids[cat_name]
-            w, h = imgid2wh[imgid]
-            bbox, area, seg = _ann2bbox(dd, w, h)
-            ann_entry = {'id': ann_id, 'image_id': imgid, 'category_id': catid,
-                         'segmentation': seg,
-                         'area': area,
-                         'bbox': bbox,
-                         'iscrowd': 0}
-            # Check if we want to include this annotation
-            include_this_annotation = True
-            x, y, ann_w, ann_h = bbox
-            if max_size:
-                maxdim = max(w, h)
-                ann_w = ann_w * (max_size / float(maxdim))
-                ann_h = ann_h * (max_size / float(maxdim))
-            if min_ann_size is not None:
-                if ann_w < min_ann_size[0]:
-                    include_this_annotation = False
-                if ann_h < min_ann_size[1]:
-                    include_this_annotation = False
-
-            # Now check whether this annotation exceeds the ratio requriements, if any.
-            if min_ratio > 0:
-                try:
-                    ratio = float(w) / float(h)
-                except ZeroDivisionError:
-                    include_this_annotation = False
-                else:
-                    if ratio >= min_ratio and w >= min_width_for_ratio:
-                        include_this_annotation = False
-
-            if include_this_annotation:
-                new_anns_raw.append(ann_entry)
-                imgid2_has_new_ann[imgid] = True
-                ann_id += 1
-
-    # Now we must review all of the images and only keep those where imgid2_has_new_ann[imgid] = True
-
-    new_imgs_raw = []
-    for img in intermediate_images:
-        if img['id'] in imgid2_has_new_ann:
-            new_imgs_raw.append(img)
-
-    # Now we assign new image_ids to the images, mapping old to new
-    old_img2new_img = {}
+    catids = code2catid[table['LabelName']]
+    w = img_w[img_rows]
+    h = img_h[img_rows]
+    xmin = table['XMin'].astype(np.float64) * w
+    xmax = table['XMax'].astype(np.float64) * w
+    ymin = table['YMin'].astype(np.float64) * h
+    ymax = table['YMax'].astype(np.float64) * h
+    ann_w = xmax - xmin
+    ann_h = ymax - ymin
+
+    # Check which annotations we want to include
+    include = (catids >= 0) & box_filter_mask(w, h, ann_w, ann_h, max_size, min_ann_size,
+                                              min_ratio, min_width_for_ratio)
+
+    # Only keep images with at least one included annotation, renumbering both from 1.
+    keep_img = np.zeros(len(intermediate_images), dtype=bool)
+    keep_img[img_rows[include]] = True
+    old_img2new_img = np.cumsum(keep_img)
     new_imgs = []
-    for indx, img in enumerate(new_imgs_raw):
-        old_img2new_img[img['id']] = indx + 1
-        img['id'] = indx + 1
-        new_imgs.append(img)
-
+    for img in intermediate_images:
+        if keep_img[img['id']]:
+            img['id'] = int(old_img2new_img[img['id']])
+            new_imgs.append(img)
     output['images'] = new_imgs
-
-    # Now we assing new ann_ids to the annotations, also updating the image ID
-    new_anns = []
-    for indx, ann in enumerate(new_anns_raw):
-        ann['id'] = indx + 1
-        ann['image_id'] = old_img2new_img[ann['image_id']]
-        new_anns.append(ann)
-
-    output['annotations'] = new_anns
+    instrument.count('openimages2coco', 'images', len(intermediate_images))
+    instrument.count('openimages2coco', 'kept_images', len(new_imgs))
+    instrument.count('openimages2coco', 'rows', len(table))
+    instrument.count('openimages2coco', 'kept_annotations', int(include.sum()))
+
+    rows = np.flatnonzero(include)
+    ann_imgids = old_img2new_img[img_rows[rows]]
+    columns = [xmin[rows], ymin[rows], xmax[rows], ymax[rows], ann_w[rows], ann_h[rows], catids[rows], ann_imgids]
+
+    def ann_records(indices):
+        """Annotation dicts for positions indices of rows. Annotation ids follow row order."""
+        values = [col[indices].tolist() for col in columns]
+        for indx, x0, y0, x1, y1, bw, bh, catid, imgid in zip(indices.tolist(), *values):
+            yield {'id': indx + 1, 'image_id': imgid, 'category_id': catid,
+                   'segmentation': [x0, y0, x0, y1, x1, y1, x1, y0],
+                   'area': bw * bh,
+                   'bbox': [x0, y0, bw, bh],
+                   'iscrowd': 0}
+
+    if output_json is not None:
+        # Stream each image with its annotations, building the annotation dicts one image at a time.
+        order = np.argsort(ann_imgids, kind='stable')
+        starts = np.searchsorted(ann_imgids[order], np.arange(1, len(new_imgs) + 2))
+        records = ((img, ann_records(order[starts[img['id'] - 1]:starts[img['id']]])) for img in new_imgs)
+        with instrument.timer('openimages2coco', 'write'):
+            _write_coco(output, output_json, resume, records)
+        return output_json
+    output['annotations'] = list(ann_records(np.arange(len(rows))))
     return output
 
 def read_catMIDtoname(csv_file):
@@ -169,19 +146,33 @@ def read_catMIDtoname(csv_file):
     print(" Read", rows_read, "rows from category csv", csv_file)
     return catmid2name
 
-def parse_open_images(annotation_csv):
+def get_label_mids(oidata):
+    """Return the LabelName MIDs present in oidata, in order of first appearance."""
+    if isinstance(oidata, OpenImagesTable):
+        return [oidata.vocab['LabelName'][code] for code in first_appearance_order(oidata['LabelName'])]
+    all_cats = {}
+    for dd in oidata:
+        all_cats.setdefault(dd['LabelName'], True)
+    return list(all_cats)
+
+def parse_open_images(annotation_csv, columnar=False, chunk_rows=250000):
     """
     Parse open images and produce a list of annotations.
     :param annotation_csv:
+    :param columnar: If True, return an OpenImagesTable (typed column arrays) instead of a list of dicts.
+        Use this for the train CSV, where the list of dicts needs tens of GB.
+    :param chunk_rows: Rows converted to arrays at a time, when columnar=True.
     :return:
     """
+    if columnar:
+        return parse_open_images_columnar(annotation_csv, chunk_rows=chunk_rows)
     annotations = []
 
     assert os.path.isfile(annotation_csv), "File %s does not exist." % annotation_csv
     expected_header = ['ImageID', 'Source', 'LabelName', 'Confidence', 'XMin', 'XMax', 'YMin', 'YMax', 'IsOccluded', 'IsTruncated', 'IsGroupOf', 'IsDepiction', 'IsInside']
 
     rows_read = 0
-    with open(annotation_csv) as csvfile:
+    with instrument.stage('parse_open_images', unit='rows'), open(annotation_csv) as csvfile:
         reader = csv.reader(csvfile)
         header = next(reader)
         for ii, hh in enumerate(header):
@@ -190,9 +181,13 @@ def parse_open_images(annotation_csv):
             ann = parse_open_images_row(row, header)
             annotations.append(ann)
             rows_read += 1
+            if rows_read % 100000 == 0:
+                instrument.count('parse_open_images', 'rows', 100000)
             # if rows_read > 10:
             #     print("DEBUG: Only reading 11 rows.")
             #     break
+        instrument.count('parse_open_images', 'rows', rows_read % 100000)
+        instrument.count('parse_open_images', 'bytes', os.path.getsize(annotation_csv))
     print(" Read", rows_read, "rows from annotation csv", annotation_csv)
     return annotations
 
@@ -226,28 +221,77 @@ def parse_open_images_row(row, header):
             ann[hh] = row[ii]
     return ann
 
-def copy_images(json_file, original_image_dirs, new_image_dir):
-    """Copy files from original_image_dirs to new_iamge_dirs"""
-    if type(original_image_dirs) is not list:
-        original_image_dirs = [original_image_dirs]
-
+def copy_images(json_file, original_image_dirs, new_image_dir, mode='copy', num_workers=8):
+    """
+    Copy files from original_image_dirs to new_iamge_dirs
+    :param mode: copy, hardlink, symlink or reflink. See data_tools.materialize.materialize_images.
+    :param num_workers: Number of files handled in parallel
+    """
     # Open JSON file and get list of images
-    annotations = read_json(json_file, verbose=False)
-    image_filenames = [ann['file_name'] for ann in annotations['images']]
-
-    for img in image_filenames:
-        for img_d in original_image_dirs:
-            orig = os.path.join(img_d, img)
-            if not os.path.isfile(orig):
-                continue
-            new = os.path.join(new_image_dir, img)
-            # Copy
-            shutil.copy(orig, new)
-    print("All %i images in %s copied to %s" % (len(image_filenames), json_file, new_image_dir))
-
-
-def _oidata_entry_to_image_dict(filename, indx, img_dir):
-    width, height = _get_img_width_height(filename, img_dir)
+    image_filenames = load_index(json_file).file_names
+    summary = materialize_images(image_filenames, original_image_dirs, new_image_dir, mode=mode,
+                                 num_workers=num_workers)
+    print("All %i images in %s copied to %s" % (len(image_filenames) - len(summary['missing']), json_file,
+                                                 new_image_dir))
+    return summary
+
+def class_codes(table, catmid2name, class_names):
+    """LabelName codes of an OpenImagesTable whose class name is in class_names"""
+    class_names = set(class_names)
+    return np.array([code for code, mid in enumerate(table.vocab['LabelName']) if catmid2name[mid] in class_names],
+                    dtype=np.int32)
+
+def image_has_class_mask(table, codes):
+    """Row mask: True for every row of each image that has at least one row with a LabelName in codes"""
+    row_has_class = np.isin(table['LabelName'], codes)
+    image_included = np.zeros(len(table.vocab['ImageID']), dtype=bool)
+    image_included[table['ImageID'][row_has_class]] = True
+    return image_included[table['ImageID']]
+
+def box_filter_mask(img_w, img_h, ann_w, ann_h, max_size=None, min_ann_size=None, min_ratio=0.0,
+                    min_width_for_ratio=400):
+    """
+    Evaluate the openimages2coco annotation filters on arrays of annotations. Returns True where kept.
+    :param img_w, img_h: Size of the image of each annotation
+    :param ann_w, ann_h: Size of each annotation box, in pixels
+    :param max_size: If set, min_ann_size applies to boxes after resizing their image to this maximum dimension
+    :param min_ann_size: (min width, min height) of kept boxes
+    :param min_ratio: If > 0, drop annotations of images with width / height >= min_ratio and
+        width >= min_width_for_ratio (and of images with zero height)
+    """
+    include = np.ones(len(ann_w), dtype=bool)
+    if max_size:
+        scale = max_size / np.maximum(img_w, img_h)
+        ann_w = ann_w * scale
+        ann_h = ann_h * scale
+    if min_ann_size is not None:
+        include &= (ann_w >= min_ann_size[0]) & (ann_h >= min_ann_size[1])
+    # Now check whether this annotation exceeds the ratio requriements, if any.
+    if min_ratio > 0:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = img_w / img_h
+        include &= (img_h != 0) & ~((ratio >= min_ratio) & (img_w >= min_width_for_ratio))
+    return include
+
+def _as_table(oidata):
+    """Return oidata as an OpenImagesTable, converting a list of dicts (keeping float64 coordinates)"""
+    if isinstance(oidata, OpenImagesTable):
+        return oidata
+    return OpenImagesTable.from_rows(oidata, float_dtype=np.float64)
+
+def _write_coco(output, output_json, resume, records):
+    """Write (image, annotations) records with a CocoWriter, skipping images already written if resuming"""
+    header = {key: value for key, value in output.items() if key not in ('images', 'annotations')}
+    with CocoWriter(output_json, header, resume=resume) as writer:
+        for img, anns in records:
+            if img['id'] not in writer.written_image_ids:
+                writer.add(img, anns)
+    print(" Wrote %i images and %i annotations to %s" % (writer.num_images, writer.num_annotations, output_json))
+
+def _oidata_entry_to_image_dict(filename, indx, img_dir, size=None):
+    if size is None:
+        size = _get_img_width_height(filename, img_dir)
+    width, height = size
     return {'id': indx, 'width': width, 'height': height, 'file_name': filename,
             'license': None, 'flickr_url': None, 'coco_url': None, 'date_captured': None}
 
@@ -258,21 +302,8 @@ def _get_img_width_height(filename, img_dir):
     for img_d in img_dir:
         filepath = os.path.join(img_d, filename)
         try:
-            image = Image.open(filepath).convert("RGB")
+            with instrument.timer('openimages2coco', 'probe'):
+                return probe_image_size(filepath)
         except FileNotFoundError:
             pass
-        else:
-            return image.size
     raise FileNotFoundError("Image %s not found in any of img_dir" % filename)
-
-def _ann2bbox(dd, img_width, img_height):
-    xmin = dd['XMin'] * img_width
-    xmax = dd['XMax'] * img_width
-    ymin = dd['YMin'] * img_height
-    ymax = dd['YMax'] * img_height
-    seg = [xmin, ymin, xmin, ymax, xmax, ymax, xmax, ymin]
-    w = xmax - xmin
-    h = ymax - ymin
-    bbox = [xmin, ymin, w, h]
-    return bbox, w * h, seg
-